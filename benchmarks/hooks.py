@@ -0,0 +1,105 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hook overhead of the charm, with the host and apt left alone."""
+
+import contextlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from discovery import StorageTopology
+from infinihost import parse_output
+
+from benchmarks.workloads import Benchmark, infinihost_output
+
+
+@contextlib.contextmanager
+def _stubbed_host():
+    """Keep the charm away from the host: files go to a temporary
+    directory, and commands, apt and service calls are no-ops."""
+    import fchba
+    import iscsi
+    from src.charm import InfinidatToolsCharm
+
+    tmpdir = tempfile.mkdtemp()
+    set_filter = InfinidatToolsCharm._set_lvm_conf_global_filter
+
+    def set_lvm_filter(self, lvm_global_filter, lvm_conf=None,
+                       use_devicesfile=''):
+        return set_filter(self, lvm_global_filter,
+                          os.path.join(tmpdir, 'lvm.conf'), use_devicesfile)
+
+    report = parse_output(infinihost_output(10), code=0)
+    patches = [
+        mock.patch('src.charm.MULTIPATH_CONF',
+                   os.path.join(tmpdir, 'multipath.conf')),
+        mock.patch('src.charm.METRICS_CRON_FILE',
+                   os.path.join(tmpdir, 'metrics-cron')),
+        mock.patch('src.charm.QUEUE_RULES_FILE',
+                   os.path.join(tmpdir, 'queue.rules')),
+        mock.patch('src.charm.INFINIHOST_RESULTS_DIR', tmpdir),
+        mock.patch.object(fchba, 'MODPROBE_CONF',
+                          os.path.join(tmpdir, 'fc.conf')),
+        mock.patch.object(iscsi, 'ISCSID_CONF',
+                          os.path.join(tmpdir, 'iscsid.conf')),
+        mock.patch('src.charm.StorageTopology.discover',
+                   return_value=StorageTopology([], [])),
+        mock.patch('charmhelpers.core.host.lsb_release',
+                   return_value={'DISTRIB_CODENAME': 'focal'}),
+        mock.patch('charmhelpers.fetch.add_source'),
+        mock.patch('charmhelpers.fetch.apt_update'),
+        mock.patch('charmhelpers.fetch.apt_install'),
+        mock.patch('src.charm.installed_versions', return_value={}),
+        mock.patch('charmhelpers.core.host.service_restart'),
+        mock.patch('src.charm.run_check', return_value=report),
+        mock.patch('src.charm.initrd.boots_from_san', return_value=False),
+        mock.patch('src.charm.InfinidatToolsCharm._get_repo_key',
+                   return_value=None),
+        mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter',
+                   set_lvm_filter),
+        mock.patch('subprocess.check_call'),
+        mock.patch('subprocess.check_output', return_value=''),
+    ]
+    try:
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch)
+            yield InfinidatToolsCharm
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _harness_install(charm_class):
+    from ops.testing import Harness
+
+    harness = Harness(charm_class)
+    try:
+        harness.begin()
+        harness.charm.on.install.emit()
+        harness.charm.on.config_changed.emit()
+    finally:
+        harness.cleanup()
+
+
+def hook_benchmarks(stack):
+    """Benchmarks of whole hooks run through the ops Harness.
+
+    The host is stubbed for as long as stack is open. Raises ImportError
+    if ops or the charm dependencies are not installed.
+    """
+    charm_class = stack.enter_context(_stubbed_host())
+    return [Benchmark('hook-install', (1,), lambda n: (charm_class,),
+                      _harness_install)]
@@ -0,0 +1,166 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the benchmarks, and check them against previous runs.
+
+    python3 -m benchmarks.run [--history FILE] [--compare] [NAME...]
+
+Each benchmark is timed at several input sizes. The run fails if the run
+time grows faster with the input size than the scaling budget allows,
+which catches quadratic behaviour on any machine, or with --compare if a
+benchmark got slower than in the last run recorded in the history file.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.hooks import hook_benchmarks
+from benchmarks.workloads import BENCHMARKS
+
+# run time growth allowed between the smallest and largest input size,
+# as the exponent of the size ratio: 1 is linear, 2 quadratic
+MAX_EXPONENT = 1.5
+# slowdown against the last recorded run reported as a regression
+MAX_SLOWDOWN = 1.25
+REPEAT = 5
+
+
+def measure(func, args, repeat=REPEAT):
+    """Median wall time of repeat calls, in seconds."""
+    # not timed: lazy imports and template loading
+    func(*args)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run_benchmark(benchmark, repeat=REPEAT):
+    """{size: seconds} of a Benchmark."""
+    return {size: measure(benchmark.func, benchmark.setup(size), repeat)
+            for size in benchmark.sizes}
+
+
+def scaling_exponent(timings):
+    """Growth exponent of the run time between the smallest and the
+    largest size, None with a single size."""
+    sizes = sorted(timings)
+    if len(sizes) < 2 or timings[sizes[0]] <= 0:
+        return None
+    return math.log(timings[sizes[-1]] / timings[sizes[0]]) / \
+        math.log(sizes[-1] / sizes[0])
+
+
+def regressions(results, previous, max_slowdown=MAX_SLOWDOWN):
+    """Benchmarks slower than in previous, e.g. 'lvm-filter[4000]: 0.120s
+    (was 0.080s)'."""
+    found = []
+    for name, timings in sorted(results.items()):
+        for size, seconds in sorted(timings.items()):
+            before = previous.get(name, {}).get(str(size))
+            if before and seconds > before * max_slowdown:
+                found.append('{0}[{1}]: {2:.3f}s (was {3:.3f}s)'.format(
+                    name, size, seconds, before))
+    return found
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run the charm benchmarks')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, all of them by default')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--history',
+                        help='JSON file the results are appended to')
+    parser.add_argument('--compare', action='store_true',
+                        help='fail on regressions against the last run '
+                        'in the history file')
+    parser.add_argument('--max-exponent', type=float, default=MAX_EXPONENT)
+    parser.add_argument('--max-slowdown', type=float, default=MAX_SLOWDOWN)
+    args = parser.parse_args(args)
+    # the hooks log every step
+    logging.disable(logging.CRITICAL)
+
+    failures = []
+    results = {}
+    with contextlib.ExitStack() as stack:
+        benchmarks = list(BENCHMARKS)
+        try:
+            benchmarks += hook_benchmarks(stack)
+        except ImportError as e:
+            print('Skipping hook benchmarks: {0}'.format(e))
+
+        for benchmark in benchmarks:
+            if args.names and benchmark.name not in args.names:
+                continue
+            timings = run_benchmark(benchmark, args.repeat)
+            results[benchmark.name] = timings
+            exponent = scaling_exponent(timings)
+            print('{0:20} {1}{2}'.format(
+                benchmark.name,
+                '  '.join('{0}: {1:.4f}s'.format(size, seconds)
+                          for size, seconds in sorted(timings.items())),
+                '' if exponent is None else
+                '  (scaling {0:.2f})'.format(exponent)))
+            if exponent is not None and exponent > args.max_exponent:
+                failures.append('{0}: run time grows with input size^{1:.2f}'
+                                .format(benchmark.name, exponent))
+
+    if args.history:
+        history = _load_history(args.history)
+        if args.compare and history:
+            failures += regressions(results, history[-1]['results'],
+                                    args.max_slowdown)
+        history.append({
+            'timestamp': int(time.time()),
+            'revision': _git_revision(),
+            'python': sys.version.split()[0],
+            'results': results,
+        })
+        with open(args.history, 'w') as f:
+            json.dump(history, f, indent=1, sort_keys=True)
+
+    for failure in failures:
+        print('FAIL {0}'.format(failure))
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
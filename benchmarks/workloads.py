@@ -0,0 +1,137 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthetic inputs for the config handling and parsing benchmarks."""
+
+import os
+from typing import Callable, NamedTuple, Tuple
+
+from infinihost import parse_output
+from lvmconf import format_filter, get_option, set_option
+from multipath import plan_reconfiguration, render_config
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'templates')
+
+MULTIPATH_SETTINGS = {
+    'path_selector': 'round-robin 0',
+    'rr_min_io_rq': 1,
+    'max_fds': 8192,
+    'fast_io_fail_tmo': 15,
+    'no_path_retry': 'queue',
+    'find_multipaths': 'yes',
+}
+
+ANSI_OK = '\x1b[1m\x1b[32mok\x1b[22m\x1b[39m'
+ANSI_FAIL = '\x1b[1m\x1b[31mfail\x1b[22m\x1b[39m'
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # input sizes, the growth of the run time between the first and the
+    # last one is checked against the scaling budget
+    sizes: Tuple[int, ...]
+    # size -> arguments of func, not timed
+    setup: Callable
+    func: Callable
+
+
+def _wwid(i):
+    return '36742b0f0000004e2{0:015x}'.format(i)
+
+
+def multipath_conf(entries, blacklisted=None):
+    """multipath.conf with a multipaths entry per device and a blacklist
+    entry per local device."""
+    blacklisted = entries if blacklisted is None else blacklisted
+    lines = ['defaults {', '\tuser_friendly_names yes', '}', 'blacklist {']
+    for i in range(blacklisted):
+        lines.append('\twwid "{0}"'.format(_wwid(i + entries)))
+    lines += ['\tdevnode "^(ram|raw|loop|fd|md|dm-|sr|scd|st)[0-9]*"', '}',
+              'multipaths {']
+    for i in range(entries):
+        lines += ['\tmultipath {',
+                  '\t\twwid {0}'.format(_wwid(i)),
+                  '\t\talias volume-{0}'.format(i),
+                  '\t}']
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def lvm_conf(patterns):
+    """lvm.conf with a global_filter of the given number of patterns."""
+    stock = ''.join('\t# Configuration option devices/option{0}.\n'
+                    '\t# option{0} = {0}\n'.format(i) for i in range(200))
+    return ('config {\n\tchecks = 1\n}\n'
+            'devices {\n\tdir = "/dev"\n' + stock +
+            '\tglobal_filter = {0}\n'.format(filter_patterns(patterns)) +
+            '}\nactivation {\n\tudev_sync = 1\n}\n')
+
+
+def filter_patterns(count):
+    return format_filter(
+        ['a|^/dev/disk/by-id/wwn-0x{0:016x}(-part[0-9]+)?$|'.format(i)
+         for i in range(count)] + ['r|.*|'])
+
+
+def infinihost_output(devices):
+    """infinihost output with a failed device check per device."""
+    lines = ['SCSI: Checking that sg3-utils is installed ... ' + ANSI_OK]
+    for i in range(devices):
+        lines.append('Devices: Checking the path count of volume-{0} ... '
+                     '{1}'.format(i, ANSI_FAIL))
+    lines.append('=' * 79)
+    for i in range(devices):
+        lines += ['Fail Devices: Checking the path count of volume-{0}'
+                  .format(i),
+                  'REASON: FAILURE: volume-{0} has 1 path'.format(i),
+                  'INFO: For more information, see '
+                  'https://support.infinidat.com/hc/articles/202319232',
+                  '-' * 79]
+    lines += ['(failures={0}, skips=0)'.format(devices),
+              'This host is NOT ready to work with the InfiniBox']
+    return '\n'.join(lines) + '\n'
+
+
+def _render_multipath(existing):
+    return render_config(TEMPLATE_DIR, MULTIPATH_SETTINGS, existing)
+
+
+def _plan_multipath(old, new):
+    return plan_reconfiguration(old, new)
+
+
+def _set_lvm_filter(text, value):
+    text = set_option(text, 'devices', 'global_filter', value)
+    return get_option(text, 'devices', 'global_filter')
+
+
+BENCHMARKS = [
+    Benchmark(
+        'multipath-render', (500, 2000),
+        lambda n: (multipath_conf(n),),
+        _render_multipath),
+    Benchmark(
+        'multipath-plan', (500, 2000),
+        lambda n: (multipath_conf(n), multipath_conf(n, n + 1)),
+        _plan_multipath),
+    Benchmark(
+        'lvm-filter', (1000, 4000),
+        lambda n: (lvm_conf(n), filter_patterns(n + 1)),
+        _set_lvm_filter),
+    Benchmark(
+        'infinihost-parse', (2500, 10000),
+        lambda n: (infinihost_output(n),),
+        parse_output),
+]
@@ -0,0 +1,77 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Summary of the host storage state shared on the storage-backend
+relation."""
+
+import json
+
+from confutils import content_digest
+from discovery import MIN_PATHS, RECOMMENDED_SCHEDULERS, check_topology
+from infinihost import STATUS_FAIL
+
+# bumped on incompatible changes of the summary layout
+SUMMARY_VERSION = 1
+
+
+def multipath_summary(topology):
+    """{wwid: [running paths, paths]} of the InfiniBox multipath devices."""
+    return {dm.wwid: [topology.running_paths(dm), len(dm.slaves)]
+            for dm in topology.infinibox_multipath_devices}
+
+
+def build_summary(topology, settings, last_check=None, blocked=None,
+                  min_paths=MIN_PATHS, schedulers=RECOMMENDED_SCHEDULERS):
+    """Summary of the host storage state.
+
+    The host is ready for InfiniBox volumes when the unit is not blocked
+    and the sysfs device checks pass. settings are the tuned settings,
+    last_check the outcome of the last infinihost run, if any, and blocked
+    the reason the unit is blocked, if it is. schedulers are the I/O
+    schedulers InfiniBox devices are expected to use.
+    """
+    reasons = []
+    if blocked:
+        reasons.append(blocked)
+    report = check_topology(topology, min_paths, schedulers)
+    reasons.extend(c.reason for c in report.by_status(STATUS_FAIL))
+    return {
+        'version': SUMMARY_VERSION,
+        'ready': not reasons,
+        'reasons': reasons,
+        'multipath': multipath_summary(topology),
+        'settings': {group: {k: str(v) for k, v in values.items()
+                             if v not in (None, '')}
+                     for group, values in settings.items()},
+        'last-check': last_check,
+    }
+
+
+def fingerprint(summary):
+    return content_digest(json.dumps(summary, sort_keys=True))
+
+
+def relation_data(summary):
+    """Relation data publishing the summary.
+
+    Readiness and the fingerprint are set as their own keys, so that
+    principals do not need to parse the summary to act on them.
+    """
+    return {
+        'version': str(summary['version']),
+        'ready': 'true' if summary['ready'] else 'false',
+        'fingerprint': fingerprint(summary),
+        'summary': json.dumps(summary, sort_keys=True,
+                              separators=(',', ':')),
+    }
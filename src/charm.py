@@ -15,10 +15,13 @@
 # limitations under the License.
 
 import os
+import json
 import logging
 import subprocess
-import re
+import sys
 import tempfile
+import time
+import uuid
 from pathlib import Path
 
 from ops_openstack.core import OSBaseCharm
@@ -27,26 +30,83 @@ from ops.main import main
 from ops.model import (
     ActiveStatus,
     BlockedStatus,
+    ModelError,
 )
 
-from charmhelpers.core.host import (
-    lsb_release,
-    service_restart,
+import backendsummary
+import debbundle
+import initrd
+import iscsi
+import localdisks
+from lvmconf import (
+    LvmConfSyntaxError,
+    active_pv_devices,
+    generated_filter,
+    pv_devices,
+    set_option,
 )
-
-from charmhelpers.fetch import (
-    apt_install,
-    apt_update,
-    add_source,
+from confutils import content_digest, write_file_if_changed
+from discovery import (
+    RECOMMENDED_SCHEDULERS,
+    StorageTopology,
+    check_topology,
 )
-
-from charmhelpers.fetch.archiveurl import ArchiveUrlFetchHandler
+import fchba
+from infinihost import (
+    InfinihostReport,
+    STATUS_OK,
+    host_state_fingerprint,
+    job_paths,
+    job_status,
+    remove_job,
+    run_check,
+    running_jobs,
+    start_job,
+)
+from multipath import (
+    ACTION_NONE,
+    ACTION_RECONFIGURE,
+    ACTION_RESTART,
+    plan_reconfiguration,
+    render_config,
+    validate_settings,
+)
+import pathmetrics
+from pkgstate import (
+    installed_versions,
+    missing_packages,
+    package_spec,
+    source_fingerprint,
+)
+from repokeys import (
+    DEFAULT_REPO_KEY_URL,
+    KeyProvider,
+    normalize_fingerprint,
+    source_needs_key,
+)
+import rescan
+from results import ResultsStore
+import rollout
+from timings import PhaseTimer, add_run, phase_summary
+from udevrules import (
+    QUEUE_ATTRS,
+    QUEUE_RULES_FILE,
+    queue_mismatches,
+    render_rules,
+    target_devices,
+    validate_queue_settings,
+)
+import wwids
 
 logger = logging.getLogger(__name__)
 
 INFINIHOST_RESULTS_DIR = '/home/ubuntu/infinihost-results'
+INFINIHOST_JOBS_DIR = os.path.join(INFINIHOST_RESULTS_DIR, 'jobs')
 MULTIPATH_CONF = '/etc/multipath.conf'
-DEFAULT_REPO_KEY_URL = 'https://repo.infinidat.com/packages/gpg.key'
+METRICS_CRON_FILE = '/etc/cron.d/infinidat-tools-metrics'
+OFFLINE_DEBS_RESOURCE = 'offline-debs'
+# where the verified offline-debs resource is extracted, in the charm dir
+OFFLINE_DEBS_CACHE = 'offline-debs'
 
 
 class InfinidatToolsCharm(OSBaseCharm):
@@ -58,6 +118,20 @@ class InfinidatToolsCharm(OSBaseCharm):
         'multipath-tools-boot'
     ]
 
+    # config options pinning the version of a package
+    PACKAGE_VERSION_OPTIONS = {
+        'host-power-tools': 'host_power_tools_version',
+    }
+
+    # config options setting iscsid.conf keys
+    ISCSI_OPTIONS = {
+        'iscsi_cmds_max': iscsi.CMDS_MAX,
+        'iscsi_queue_depth': iscsi.QUEUE_DEPTH,
+        'iscsi_nr_sessions': iscsi.NR_SESSIONS,
+        'iscsi_noop_out_interval': iscsi.NOOP_OUT_INTERVAL,
+        'iscsi_replacement_timeout': iscsi.REPLACEMENT_TIMEOUT,
+    }
+
     MANDATORY_CONFIG = ['install_sources']
     # Overriden from the parent. May be set depending on the charm's properties
 
@@ -74,12 +148,76 @@ class InfinidatToolsCharm(OSBaseCharm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # digest of the multipath.conf last applied to multipathd
+        self._stored.set_default(multipath_conf_digest=None)
+        # fingerprint of the configuration the initrd was last generated with
+        self._stored.set_default(initrd_fingerprint=None)
+        # set when the initrd must be rebuilt whatever its fingerprint
+        self._stored.set_default(initrd_rebuild_forced=None)
+        # apt source and key last configured by install_pkgs
+        self._stored.set_default(apt_source_fingerprint=None)
+        # last infinihost results along with the host state they describe
+        self._stored.set_default(infinihost_cache=None)
+        # phase timings of the last hook runs
+        self._stored.set_default(hook_timings=None)
+        # textfile the path metrics collector currently writes to
+        self._stored.set_default(metrics_textfile=None)
+        # iSCSI settings last applied to the node records
+        self._stored.set_default(iscsi_node_settings=None)
+        # outcome of the last infinihost run, shared with the principal
+        self._stored.set_default(last_infinihost_check=None)
+        # disruptive operations waiting for a rollout grant
+        self._stored.set_default(rollout_pending=None)
+        # local disk blacklist of the last rendered multipath.conf
+        self._stored.set_default(blacklist_wwids=None)
+        # InfiniBox WWIDs multipathd failed to add maps for
+        self._stored.set_default(wwids_failed=None)
+        # status message of the last wwids update
+        self._stored.set_default(wwids_status=None)
+        # whether disruptive operations can run without a rollout grant
+        self._rollout_held = False
+        # storage topology of the host, discovered once per hook
+        self._storage_topology = None
+
+        self._timings = PhaseTimer()
+        self.framework.observe(self.framework.on.pre_commit,
+                               self._record_timings)
+
         self.framework.observe(self.on.start, self.on_start)
+        for event in (self.on.stop, self.on.remove):
+            self.framework.observe(event, self._remove_metrics_collector)
+        self.framework.observe(self.on.update_status, self._on_update_wwids)
+        self.framework.observe(self.on.update_status,
+                               self._on_refresh_blacklist)
+        for event in (self.on.config_changed, self.on.update_status,
+                      self.on.leader_elected,
+                      self.on.cluster_relation_changed,
+                      self.on.cluster_relation_departed):
+            self.framework.observe(event, self._on_rollout_event)
+        # observed after the handlers of the parent, once the unit status
+        # reflects the changes they made
+        for event in (self.on.install, self.on.config_changed,
+                      self.on.update_status,
+                      self.on.storage_backend_relation_joined):
+            self.framework.observe(event, self._on_storage_state_changed)
+        self.framework.observe(self.on.multipath_metrics_relation_joined,
+                               self.on_multipath_metrics_relation_joined)
 
         self.framework.observe(self.on.run_infinidat_settings_check_action,
                                self.on_run_infinidat_settings_check_action)
+        self.framework.observe(self.on.get_infinihost_result_action,
+                               self.on_get_infinihost_result_action)
+        self.framework.observe(self.on.list_infinihost_results_action,
+                               self.on_list_infinihost_results_action)
+        self.framework.observe(self.on.show_timings_action,
+                               self.on_show_timings_action)
+        self.framework.observe(self.on.quick_check_action,
+                               self.on_quick_check_action)
+        self.framework.observe(self.on.rescan_infinibox_action,
+                               self.on_rescan_infinibox_action)
 
-    def _run_infinihost_check(self, auto_fix=True, stdout=subprocess.PIPE):
+    def _run_infinihost_check(self, auto_fix=True, outfile=None,
+                              progress=None):
         """
         host-power-tool utility checks environment for
         the recommended settings and if anything is missing
@@ -89,135 +227,853 @@ class InfinidatToolsCharm(OSBaseCharm):
         - registers itself as a udev handler
         - regenerates initramfs, so that multipath configuration
         is applied to it as well, in case root fs is on SAN
-        """
-        p = None
 
-        cmd = [
-            'infinihost',
-            'settings',
-            'check'
-        ]
-
-        if auto_fix:
-            cmd.append('--auto-fix')
-
-        logging.debug("Executing: {0}".format(' '.join(cmd)))
+        The output is parsed line by line as it is produced. Raw output
+        is copied to outfile (if given) and progress (if given) is called
+        with each CheckResult as soon as the check completes. infinihost
+        is killed if it runs for longer than infinihost_timeout.
 
+        Returns an InfinihostReport.
+        """
         try:
-            # FIXME: Without this there is a dependency conflict:
-            # pkg_resources in charm's venv pythonpath takes precedence over
-            # the system-wide one, and because of the version difference,
-            # it breaks infinihost with "ImportError: cannot import name 'six'"
-            env = os.environ.copy()
-            if 'PYTHONPATH' in env:
-                env.pop('PYTHONPATH')
-
-            p = subprocess.Popen(cmd, shell=False, stdout=stdout, env=env)
+            with self._timings.phase('infinihost'):
+                report = run_check(
+                    auto_fix=auto_fix, outfile=outfile, progress=progress,
+                    timeout=self.config.get('infinihost_timeout'))
         except FileNotFoundError:
             logging.fatal(
                 "Failed to run 'infinihost': is host-power-tools installed?")
             raise
 
-        if stdout == subprocess.PIPE:
-            stdout, _ = p.communicate()
-            logger.debug("infinihost output: {0}".format(stdout))
+        logger.info('infinihost exit code: {0}, results: {1}'
+                    .format(report.code, report.counts))
+        for failure in report.failures:
+            logger.warning('infinihost check failed: {0}: {1}'
+                           .format(failure.name, failure.reason))
 
-        code = p.wait()
+        return report
 
-        logger.info('infinihost exit code: {0}'
-                    .format(code))
+    def _record_infinihost_check(self, report):
+        self._stored.last_infinihost_check = json.dumps({
+            'timestamp': int(time.time()),
+            'code': report.code,
+            'ok': report.ok,
+            'failed': len(report.failures),
+        })
 
-        return code
+    def _multipath_settings(self):
+        return {
+            'path_selector': self.config.get('multipath_path_selector'),
+            'rr_min_io_rq': self.config.get('multipath_rr_min_io_rq'),
+            'max_fds': self.config.get('multipath_max_fds'),
+            'fast_io_fail_tmo': self.config.get('multipath_fast_io_fail_tmo'),
+            'no_path_retry': self.config.get('multipath_no_path_retry'),
+            'find_multipaths': self.config.get('multipath_find_multipaths'),
+            'blacklist_wwids': self._blacklist_wwids(),
+        }
+
+    def _topology(self):
+        """
+        Storage topology of the host, discovered on first use in a hook
+        and shared by its handlers. Changes made by the charm to the
+        multipath maps discard it.
+        """
+        if self._storage_topology is None:
+            self._storage_topology = StorageTopology.discover()
+        return self._storage_topology
+
+    def _blacklist_wwids(self):
+        """Blacklist patterns of the local disks, if they are
+        blacklisted."""
+        if not self.config.get('multipath_blacklist_local_disks'):
+            return []
+        return localdisks.blacklist_patterns(
+            localdisks.local_disks(self._topology()))
 
     def _update_multipath_conf(self, restart=True):
+        """
+        Render multipath.conf from the charm template and config, keeping
+        the blacklist sections of the existing file.
+
+        The file is only rewritten if its content changes, and multipathd
+        is only reconfigured if it does not use this exact configuration
+        yet. 'restart' can be set to False to leave multipathd alone.
+
+        Raises ValueError if the multipath settings in the charm config
+        are invalid.
+        """
+        with self._timings.phase('multipath-conf'):
+            self._do_update_multipath_conf(restart)
+
+    def _do_update_multipath_conf(self, restart):
+        settings = self._multipath_settings()
+        errors = validate_settings(settings)
+        if errors:
+            raise ValueError('; '.join(errors))
+
+        try:
+            with open(MULTIPATH_CONF, 'r') as f:
+                original = f.read()
+        except FileNotFoundError:
+            original = None
+
+        data = render_config(os.path.join(self.charm_dir, 'templates'),
+                             settings, original)
+        self._stored.blacklist_wwids = json.dumps(settings['blacklist_wwids'])
+
+        if write_file_if_changed(MULTIPATH_CONF, data):
+            logger.info("Updated multipath.conf")
+        else:
+            logger.info("multipath.conf is up to date")
+
+        if not restart:
+            return
+
+        digest = content_digest(data)
+        if self._stored.multipath_conf_digest == digest:
+            logger.info("multipathd already uses the current "
+                        "multipath.conf, not reconfiguring")
+            return
+
+        # the configuration multipathd runs with is only known if the
+        # charm applied it and nothing changed the file since then
+        if original is not None and \
+                self._stored.multipath_conf_digest == content_digest(original):
+            running = original
+        else:
+            running = None
+
+        if self._apply_multipath_conf(running, data):
+            self._stored.multipath_conf_digest = digest
+
+    def _apply_multipath_conf(self, running, data):
+        """
+        Make multipathd pick up the new configuration with the least
+        disruption possible: most settings are applied to the running
+        daemon with 'multipathd reconfigure', a full restart (which blocks
+        I/O on all multipath devices for a while) is only done for settings
+        read at startup, or when the running configuration is unknown.
+
+        Returns False if multipathd needs a restart that has to wait for a
+        rollout grant.
+        """
+        plan = plan_reconfiguration(running, data)
+        logger.info("multipathd: {0}, action: {1}".format(
+            plan.describe(), plan.action))
+
+        if plan.action == ACTION_NONE:
+            return True
+
+        # the maps are about to change
+        self._storage_topology = None
+        start = time.monotonic()
+        action = plan.action
+        if action == ACTION_RECONFIGURE:
+            try:
+                with self._timings.phase('multipathd-reconfigure'):
+                    out = subprocess.check_output(
+                        ['multipathd', 'reconfigure'],
+                        stderr=subprocess.STDOUT, universal_newlines=True)
+                if out.strip() == 'fail':
+                    raise subprocess.CalledProcessError(
+                        1, 'multipathd reconfigure', output=out)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning("multipathd reconfigure failed ({0}), "
+                               "restarting multipathd".format(e))
+                action = ACTION_RESTART
+
+        if action == ACTION_RESTART:
+            if not self._rollout_permits(rollout.OP_MULTIPATHD_RESTART):
+                logger.info("multipathd restart waiting for rollout")
+                return False
+            from charmhelpers.core.host import service_restart
+            with self._timings.phase('multipathd-restart'):
+                service_restart('multipathd')
+
+        logger.info("multipathd {0} took {1:.2f}s".format(
+            action, time.monotonic() - start))
+        return True
+
+    def _expected_schedulers(self):
+        """I/O schedulers InfiniBox devices should use: the configured
+        one, or the recommended ones if the kernel default is kept."""
+        scheduler = self.config.get('queue_scheduler')
+        return (scheduler,) if scheduler else RECOMMENDED_SCHEDULERS
+
+    def _update_wwids(self, retry=True):
+        """
+        List the WWIDs of the attached InfiniBox volumes in the multipath
+        wwids file, and prune the ones of volumes that are gone, so that
+        multipathd claims InfiniBox devices without probing them first.
+
+        The listed devices multipathd did not claim yet are added with
+        'multipathd add map', which leaves the other maps alone unlike
+        'multipathd reconfigure'. Devices it failed to add are only tried
+        again if 'retry' is set.
+
+        Returns a status message, empty if all devices are claimed.
+        """
+        messages = []
+        with self._timings.phase('wwids'):
+            topology = self._topology()
+            try:
+                with open(wwids.WWIDS_FILE) as f:
+                    current = wwids.parse_wwids(f.read())
+            except FileNotFoundError:
+                current = []
+            except OSError as e:
+                logger.error('Failed to read {0}: {1}'.format(
+                    wwids.WWIDS_FILE, e))
+                current = []
+
+            update = wwids.update_wwids(current,
+                                        wwids.infinibox_wwids(topology))
+            if update.added or update.removed:
+                logger.info('Updating {0}: adding {1}, pruning {2}'.format(
+                    wwids.WWIDS_FILE, ', '.join(update.added) or 'none',
+                    ', '.join(update.removed) or 'none'))
+                try:
+                    os.makedirs(os.path.dirname(wwids.WWIDS_FILE),
+                                exist_ok=True)
+                    write_file_if_changed(wwids.WWIDS_FILE,
+                                          wwids.render_wwids(update.wwids))
+                except OSError as e:
+                    logger.error('Failed to update {0}: {1}'.format(
+                        wwids.WWIDS_FILE, e))
+                    messages.append('failed to update {0}'.format(
+                        wwids.WWIDS_FILE))
+
+            mapped = {d.wwid for d in topology.dm.values() if d.multipath}
+            unmapped = [w for w in update.wwids
+                        if wwids.is_infinibox(w) and w not in mapped]
+            previous = set(json.loads(self._stored.wwids_failed or '[]'))
+            skipped = [] if retry else [w for w in unmapped if w in previous]
+            added = [w for w in unmapped if w not in skipped]
+            failed = wwids.add_maps(added) + skipped
+            if added:
+                self._storage_topology = None
+        self._stored.wwids_failed = json.dumps(sorted(failed)) \
+            if failed else None
+        if failed:
+            messages.append('multipathd add map failed on {0} device(s)'
+                            .format(len(failed)))
+        message = '; '.join(messages)
+        self._stored.wwids_status = message or None
+        return message
+
+    def _on_update_wwids(self, event):
+        """
+        Keep the wwids file up to date as volumes come and go, reporting
+        a change of its outcome in the unit status. Devices multipathd
+        failed to add maps for are left alone until the config changes.
+        """
+        # nothing to claim devices before multipath is configured
+        if self._stored.multipath_conf_digest is None:
+            return
+        previous = self._stored.wwids_status or ''
+        message = self._update_wwids(retry=False)
+        status = self.unit.status
+        if message == previous or not isinstance(status, ActiveStatus):
+            return
+        messages = [m for m in status.message.split('; ')
+                    if m and m != previous]
+        if message:
+            messages.append(message)
+        self.unit.status = ActiveStatus('; '.join(messages))
+
+    def _on_refresh_blacklist(self, event):
+        """
+        Render multipath.conf again when local disks were added or
+        removed, the local disk blacklist is otherwise only refreshed along
+        with the charm config.
+        """
+        if self._stored.multipath_conf_digest is None:
+            return
+        if json.dumps(self._blacklist_wwids()) == \
+                self._stored.blacklist_wwids:
+            return
+        logger.info('Local disks changed, updating the multipath blacklist')
+        try:
+            self._update_multipath_conf()
+        except ValueError as e:
+            logger.error('Invalid multipath settings: {0}'.format(e))
 
-        replacements = (
-            # Ensure that multipathd config file has skip_kpartx set to yes
-            # (causes issues with volumes detaching if set to no)
-            (re.compile(
-                r'(skip_kpartx[ \t]+).*$', re.MULTILINE), 'yes'),
-            (re.compile(
-                r'(user_friendly_names[ \t]+).*$', re.MULTILINE), 'no'),
-        )
-
-        with open(MULTIPATH_CONF, 'r') as f:
-            data = f.read()
-            for pat, new_value in replacements:
-                data = re.sub(
-                    pat,
-                    lambda m: '{0}"{1}"'.format(str(m.group(1)), new_value),
-                    data
-                )
-
-        logger.info("Updating multipath.conf")
-        with open(MULTIPATH_CONF, 'w') as f:
-            f.write(data)
-
-        logger.info("Restarting multipathd")
-        if restart:
-            service_restart('multipathd')
+    def _queue_settings(self):
+        return {attr: self.config.get('queue_{0}'.format(attr))
+                for attr in QUEUE_ATTRS}
+
+    def _update_queue_settings(self):
+        """
+        Write the udev rules setting the block queue attributes of InfiniBox
+        devices, and apply them to the existing devices if the rules changed
+        or the devices do not have the expected values. Only InfiniBox
+        devices are triggered.
+
+        Returns a status message, empty if the settings are in effect.
+        Raises ValueError if the queue settings in the charm config are
+        invalid.
+        """
+        settings = self._queue_settings()
+        errors = validate_queue_settings(settings)
+        if errors:
+            raise ValueError('; '.join(errors))
+
+        data = render_rules(os.path.join(self.charm_dir, 'templates'),
+                            settings)
+        changed = write_file_if_changed(QUEUE_RULES_FILE, data, perms=0o644)
+        if changed:
+            logger.info('Updated {0}'.format(QUEUE_RULES_FILE))
+
+        devices = target_devices(self._topology())
+        if not devices:
+            return ''
+        if not changed and not queue_mismatches(devices, settings):
+            return ''
+
+        if not self._rollout_permits(rollout.OP_UDEV_TRIGGER):
+            logger.info('Queue settings waiting for rollout')
+            return ''
+
+        logger.info('Applying queue settings to {0}'.format(
+            ', '.join(devices)))
+        try:
+            with self._timings.phase('udev-trigger'):
+                subprocess.check_call(['udevadm', 'control', '--reload'])
+                subprocess.check_call(
+                    ['udevadm', 'trigger', '--action=change', '--settle'] +
+                    [os.path.join('/sys/block', d) for d in devices])
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.error('Failed to apply queue settings: {0}'.format(e))
+            return 'failed to apply queue settings'
+
+        mismatches = queue_mismatches(devices, settings)
+        for mismatch in mismatches:
+            logger.warning('Queue setting not applied: {0}'.format(mismatch))
+        if mismatches:
+            return 'queue settings not applied on {0} device(s)'.format(
+                len(set(m.split(':')[0] for m in mismatches)))
+        return ''
+
+    def _update_fc_settings(self):
+        """
+        Set the queue depth options of the FC HBA drivers in modprobe.d,
+        and the queue depth of the InfiniBox LUNs behind the FC HBAs.
+
+        The LUN queue depth is changed in place. The driver options only
+        apply when the driver is loaded: the initrd is regenerated when they
+        change, and the drivers in use need a reboot to pick them up.
+
+        Returns a status message, empty if the settings are in effect.
+        Raises ValueError if the FC settings in the charm config are
+        invalid.
+        """
+        lun_queue_depth = self.config.get('fc_lun_queue_depth')
+        hba_queue_depth = self.config.get('fc_hba_queue_depth')
+        errors = fchba.validate_fc_settings(lun_queue_depth, hba_queue_depth)
+        if errors:
+            raise ValueError('; '.join(errors))
+
+        options = fchba.module_options(lun_queue_depth, hba_queue_depth)
+        data = fchba.render_modprobe(options)
+        if data:
+            changed = write_file_if_changed(fchba.MODPROBE_CONF, data,
+                                            perms=0o644)
+        else:
+            changed = os.path.exists(fchba.MODPROBE_CONF)
+            if changed:
+                os.unlink(fchba.MODPROBE_CONF)
+        if changed:
+            logger.info('Updated {0}'.format(fchba.MODPROBE_CONF))
+
+        hosts = fchba.fc_hosts()
+        if not hosts:
+            return ''
+        if changed:
+            # the HBA drivers are loaded from the initrd, which is rebuilt
+            # once all of its inputs are written
+            self._stored.initrd_rebuild_forced = True
+
+        messages = []
+        pending = fchba.pending_options(options, hosts)
+        for option in pending:
+            logger.warning('FC HBA driver option not in effect: {0}'.format(
+                option))
+        if pending:
+            messages.append('reboot required to apply FC HBA driver options')
+
+        luns = fchba.lun_depth_mismatches(
+            fchba.fc_luns(self._topology(), hosts), lun_queue_depth)
+        if luns:
+            logger.info('Setting the queue depth of {0} to {1}'.format(
+                ', '.join(lun.hcil for lun in luns), lun_queue_depth))
+            failed = fchba.apply_lun_queue_depth(luns, lun_queue_depth)
+            for lun in failed:
+                logger.warning('Failed to set the queue depth of {0}'.format(
+                    lun.hcil))
+            if failed and not pending:
+                messages.append('FC queue depth not applied on {0} '
+                                'device(s)'.format(len(failed)))
+        return '; '.join(messages)
+
+    def _lvm_global_filter(self):
+        """
+        global_filter to set in lvm.conf, None if the unit is blocked.
+
+        The generated filter accepts the devices holding PVs, even on
+        InfiniBox. If they can not all be listed and the host boots from
+        SAN, the filter is not generated: hiding the root VG from a filter
+        baked into the initrd would leave the host unable to boot.
+        """
+        if not self.config.get('lvm_generate_filter'):
+            return self.config.get('lvm_global_filter')
+
+        topology = self._topology()
+        pvs = active_pv_devices(topology)
+        try:
+            pvs += pv_devices()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning('Failed to list the LVM PVs: {0}'.format(e))
+            if initrd.boots_from_san():
+                self.unit.status = BlockedStatus(
+                    'lvm filter not generated: failed to list the PVs')
+                return None
+        return generated_filter(topology=topology, pvs=pvs)
+
+    def _iscsi_settings(self):
+        return {key: self.config.get(option)
+                for option, key in self.ISCSI_OPTIONS.items()}
+
+    def _update_iscsi_conf(self):
+        """
+        Set the iSCSI options of the charm config in iscsid.conf, and in
+        the node records of the already discovered targets, which do not
+        pick up iscsid.conf changes. Only the settings that changed since
+        they were last applied are updated.
+
+        The active sessions are then checked: the replacement timeout and
+        the LUN queue depth are changed in place, other settings need the
+        sessions to log in again, which the charm does not do.
+
+        Returns a status message, empty if the settings are in effect.
+        Raises ValueError if the iSCSI settings in the charm config are
+        invalid.
+        """
+        settings = self._iscsi_settings()
+        errors = iscsi.validate_settings(settings)
+        if errors:
+            raise ValueError('; '.join(errors))
+        settings = {k: str(v) for k, v in settings.items() if v}
+        if not settings:
+            return ''
+
+        try:
+            with open(iscsi.ISCSID_CONF) as f:
+                original = f.read()
+        except FileNotFoundError:
+            logger.warning('{0} not found, is open-iscsi installed?'.format(
+                iscsi.ISCSID_CONF))
+            return ''
+
+        if write_file_if_changed(iscsi.ISCSID_CONF,
+                                 iscsi.set_options(original, settings)):
+            logger.info('Updated {0}'.format(iscsi.ISCSID_CONF))
+
+        applied = json.loads(self._stored.iscsi_node_settings or '{}')
+        changed = [k for k in iscsi.ISCSI_KEYS
+                   if k in settings and settings[k] != applied.get(k)]
+        if changed:
+            try:
+                with self._timings.phase('iscsi-nodes'):
+                    iscsi.update_node_records(changed, settings)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.error('Failed to update iSCSI node records: '
+                             '{0}'.format(e))
+                return 'failed to update iSCSI node records'
+            self._stored.iscsi_node_settings = json.dumps(settings)
+
+        mismatches = iscsi.session_mismatches(settings)
+        if mismatches:
+            iscsi.apply_live(mismatches)
+            mismatches = iscsi.session_mismatches(settings)
+        for mismatch in mismatches:
+            logger.warning('iSCSI setting not in effect: {0}'.format(
+                mismatch.describe()))
+        if mismatches:
+            return 'iSCSI sessions must log in again to apply settings'
+        return ''
 
     def _set_lvm_conf_global_filter(self, lvm_global_filter,
-                                    lvm_conf='/etc/lvm/lvm.conf'):
+                                    lvm_conf='/etc/lvm/lvm.conf',
+                                    use_devicesfile=''):
+        """
+        Set devices/global_filter, and devices/use_devicesfile if not
+        empty, in lvm.conf. Empty values remove the settings previously
+        made by the charm.
+
+        Returns False, and blocks the unit, if lvm.conf could not be
+        updated.
+        """
         # Ensure we have a lvm.conf filter in place to stop lvm groups
         # present on instance/VM being discovered by the host
 
         logging.info('Setting lvm.conf global_filter')
 
-        with open(lvm_conf, 'r') as file:
-            d = file.read()
+        with self._timings.phase('lvm-conf'):
+            return self._do_set_lvm_conf_global_filter(
+                lvm_global_filter, lvm_conf, use_devicesfile)
 
-        p = re.compile(r'(# global_filter = \[[^\n]*\n)')
+    def _do_set_lvm_conf_global_filter(self, lvm_global_filter, lvm_conf,
+                                       use_devicesfile):
+        if use_devicesfile not in ('', '0', '1'):
+            logging.error('Invalid lvm_use_devicesfile: {0}'.format(
+                use_devicesfile))
+            self.unit.status = BlockedStatus(
+                'invalid lvm config: use_devicesfile must be 0 or 1')
+            return False
 
-        p_split = p.split(d, maxsplit=1)
-        if len(p_split) == 3:
-            the_rest = p_split.pop(2)
+        try:
+            with open(lvm_conf, 'r') as file:
+                d = file.read()
+        except FileNotFoundError:
+            d = ''
 
-            the_next_line, nl, the_rest = the_rest.partition('\n')
-            tmp = []
-            if lvm_global_filter:
-                tmp.append('global_filter = {0} # __infinidat_tools__'
-                           .format(lvm_global_filter))
+        try:
+            d = set_option(d, 'devices', 'global_filter',
+                           lvm_global_filter or None)
+            d = set_option(d, 'devices', 'use_devicesfile',
+                           use_devicesfile or None)
+        except LvmConfSyntaxError as e:
+            logging.fatal('Error while modifying lvm.conf: {0}'.format(e))
+            self.unit.status = BlockedStatus('Failed to update lvm.conf')
+            return False
 
-            if '__infinidat_tools__' not in the_next_line:
-                tmp.append(the_next_line + nl + the_rest)
-            else:
-                tmp.append(the_rest)
+        if write_file_if_changed(lvm_conf, d):
+            logging.info('Updated lvm.conf')
+        return True
+
+    def on_start(self, event):
+        self._stored.is_started = True
+
+    def _metrics_textfile(self):
+        textfile_dir = self.config.get('metrics_textfile_dir')
+        if not textfile_dir:
+            return None
+        return os.path.join(textfile_dir, pathmetrics.METRICS_FILE)
+
+    def _validate_metrics_settings(self):
+        errors = pathmetrics.validate_interval(
+            self.config.get('metrics_interval'))
+        if errors:
+            raise ValueError('; '.join(errors))
 
-            p_split.append('\n'.join(tmp))
+    def _update_metrics_collector(self):
+        """
+        Install, update or remove the cron job writing the multipath path
+        metrics to the node-exporter textfile directory, and advertise the
+        textfile on the multipath-metrics relation.
+
+        Metrics are not essential to the unit: failures are only logged.
+        """
+        textfile = self._metrics_textfile()
+        old_textfile = self._stored.metrics_textfile
+        try:
+            with self._timings.phase('metrics'):
+                if textfile:
+                    self._install_metrics_collector(textfile)
+                elif os.path.exists(METRICS_CRON_FILE):
+                    logger.info('Removing the path metrics collector')
+                    os.unlink(METRICS_CRON_FILE)
+                if old_textfile and old_textfile != textfile and \
+                        os.path.exists(old_textfile):
+                    os.unlink(old_textfile)
+        except OSError as e:
+            logger.warning('Failed to update the path metrics collector: '
+                           '{0}'.format(e))
+            return
 
-            with open(lvm_conf, 'w') as file:
-                file.write(''.join(p_split))
+        self._stored.metrics_textfile = textfile
+        for relation in self.model.relations['multipath-metrics']:
+            self._publish_metrics(relation)
+
+    def _remove_metrics_collector(self, event):
+        """
+        Remove the cron job and the textfile of the path metrics
+        collector, which would otherwise outlive the unit.
+        """
+        for path in (METRICS_CRON_FILE, self._stored.metrics_textfile):
+            if not path or not os.path.exists(path):
+                continue
+            logger.info('Removing {0}'.format(path))
+            try:
+                os.unlink(path)
+            except OSError as e:
+                logger.warning('Failed to remove {0}: {1}'.format(path, e))
+        self._stored.metrics_textfile = None
+
+    def _install_metrics_collector(self, textfile):
+        os.makedirs(os.path.dirname(textfile), exist_ok=True)
+        cron = ('# Managed by the infinidat-tools charm\n'
+                '*/{0} * * * * root {1} {2} {3} >/dev/null 2>&1\n'.format(
+                    self.config.get('metrics_interval'), sys.executable,
+                    os.path.join(self.charm_dir, 'src', 'pathmetrics.py'),
+                    textfile))
+        if write_file_if_changed(METRICS_CRON_FILE, cron, perms=0o644) or \
+                not os.path.exists(textfile):
+            logger.info('Path metrics are written to {0}'.format(textfile))
+            # don't wait for cron to run it
+            pathmetrics.write_metrics(textfile)
+
+    def _publish_metrics(self, relation):
+        data = relation.data[self.unit]
+        textfile = self._stored.metrics_textfile
+        if textfile:
+            data['textfile'] = textfile
+            data['interval'] = str(self.config.get('metrics_interval') * 60)
         else:
-            logging.fatal(
-                'Error while modifying lvm.conf: '
-                'expected pattern not found'
-            )
-            self.unit.status = BlockedStatus('Failed to update lvm.conf')
+            data.pop('textfile', None)
+            data.pop('interval', None)
+
+    def on_multipath_metrics_relation_joined(self, event):
+        self._publish_metrics(event.relation)
+
+    def _rollout_relation(self):
+        return self.model.get_relation('cluster')
+
+    def _rollout_permits(self, op):
+        """
+        Whether a disruptive operation can run now. Unless rollouts are
+        disabled or the unit holds a grant, the operation is recorded as
+        pending and a grant is requested from the leader: the operation is
+        run once the grant is received.
+        """
+        relation = self._rollout_relation()
+        if self._rollout_held or relation is None or \
+                not self.config.get('rollout_concurrency'):
+            return True
+
+        pending = set(json.loads(self._stored.rollout_pending or '[]'))
+        pending.add(op)
+        self._stored.rollout_pending = json.dumps(sorted(pending))
+        data = relation.data[self.unit]
+        if not data.get('request'):
+            data['request'] = rollout.new_request_id()
+            logger.info('Requested a rollout grant for {0}'.format(op))
+        return False
+
+    def _rollout_status(self):
+        pending = json.loads(self._stored.rollout_pending or '[]')
+        return rollout.describe_pending(pending) if pending else ''
+
+    def _schedule_rollout(self, relation):
+        """
+        Release the grants of the units done with their operations, and
+        grant the oldest requests, at most rollout_concurrency at once and
+        rollout_backoff seconds after the last release. Leader only.
+        """
+        app_data = relation.data[self.app]
+        requests = {}
+        done = {}
+        for unit in relation.units | {self.unit}:
+            data = relation.data[unit]
+            if data.get('request'):
+                requests[unit.name] = data['request']
+            if data.get('done'):
+                done[unit.name] = data['done']
+
+        grants = rollout.load_grants(app_data)
+        last_release = app_data.get('last-release')
+        new_grants, last_release = rollout.schedule(
+            requests, done, grants, self.config.get('rollout_concurrency'),
+            self.config.get('rollout_backoff'),
+            float(last_release) if last_release else None)
+        if new_grants != grants:
+            logger.info('Rollout grants: {0}'.format(
+                ', '.join(sorted(new_grants)) or 'none'))
+            app_data['grants'] = rollout.dump_grants(new_grants)
+        if last_release is not None:
+            app_data['last-release'] = str(last_release)
+
+    def _on_rollout_event(self, event):
+        relation = self._rollout_relation()
+        if relation is None:
             return
+        if self.unit.is_leader():
+            self._schedule_rollout(relation)
 
-    def on_start(self, event):
-        self._stored.is_started = True
+        data = relation.data[self.unit]
+        request = data.get('request')
+        if not request:
+            return
+        grant = rollout.load_grants(relation.data[self.app]).get(
+            self.unit.name)
+        if self.config.get('rollout_concurrency') and \
+                (grant is None or grant.request != request):
+            return
 
-    def _regenerate_initrd(self):
-        # Regenerate initrd
+        logger.info('Rollout granted, running {0}'.format(
+            self._stored.rollout_pending))
+        self._apply_rollout(event)
+        data['done'] = request
+        del data['request']
+        if self.unit.is_leader():
+            # release the grant right away
+            self._schedule_rollout(relation)
+
+    def _apply_rollout(self, event):
+        self._stored.rollout_pending = None
+        self._rollout_held = True
         try:
-            logging.info('Regenerating initrd')
-            subprocess.check_call("update-initramfs -u -k all", shell=True)
-        except subprocess.CalledProcessError as e:
+            # the config is applied again, disruptive operations included
+            self.on_config(event)
+        finally:
+            self._rollout_held = False
+
+    def _backend_summary(self):
+        status = self.unit.status
+        last_check = self._stored.last_infinihost_check
+        return backendsummary.build_summary(
+            self._topology(),
+            {
+                'queue': self._queue_settings(),
+                'fc': {
+                    'lun_queue_depth': self.config.get('fc_lun_queue_depth'),
+                    'hba_queue_depth': self.config.get('fc_hba_queue_depth'),
+                },
+                'iscsi': self._iscsi_settings(),
+            },
+            last_check=json.loads(last_check) if last_check else None,
+            blocked=status.message if isinstance(status, BlockedStatus)
+            else None,
+            schedulers=self._expected_schedulers())
+
+    def _publish_backend_summary(self):
+        """
+        Publish the summary of the host storage state on the
+        storage-backend relations, for the principal to only use InfiniBox
+        volumes once the host is ready for them.
+
+        Relation data is only changed along with the fingerprint of the
+        summary, so that the principal does not get relation-changed
+        events when nothing changed.
+        """
+        relations = self.model.relations['storage-backend']
+        if not relations:
+            return
+        data = backendsummary.relation_data(self._backend_summary())
+        for relation in relations:
+            unit_data = relation.data[self.unit]
+            if unit_data.get('fingerprint') == data['fingerprint']:
+                continue
+            logger.info('Publishing the storage state on {0}: ready={1}'
+                        .format(relation.name, data['ready']))
+            unit_data.update(data)
+
+    def _on_storage_state_changed(self, event):
+        self._publish_backend_summary()
+
+    def _regenerate_initrd(self, force=False):
+        """
+        Regenerate the initrd of the running and default kernels, so that
+        multipath, udev and lvm configuration is applied to it as well.
+
+        This is only needed if the host boots from SAN, and only when the
+        configuration baked into the initrd changed since the last time
+        it was regenerated by the charm, unless a rebuild was forced by
+        force or by an earlier hook whose rebuild did not happen yet.
+
+        Returns False if the initrd could not be regenerated.
+        """
+        fingerprint = initrd.inputs_fingerprint()
+        if not (force or self._stored.initrd_rebuild_forced):
+            if not initrd.boots_from_san():
+                logging.info('Root filesystem is not on a multipath device, '
+                             'not regenerating initrd')
+                return True
+            if fingerprint == self._stored.initrd_fingerprint:
+                logging.info('initrd configuration did not change, '
+                             'not regenerating initrd')
+                return True
+
+        if not self._rollout_permits(rollout.OP_INITRD):
+            logging.info('initrd rebuild waiting for rollout')
+            return True
+
+        kernels = initrd.target_kernels()
+        cmds = [['update-initramfs', '-u', '-k', k] for k in kernels]
+        if not cmds:
+            # let update-initramfs pick the newest kernel
+            cmds = [['update-initramfs', '-u']]
+
+        start = time.monotonic()
+        try:
+            for cmd in cmds:
+                logging.info('Regenerating initrd: {0}'.format(' '.join(cmd)))
+                with self._timings.phase('initrd'):
+                    subprocess.check_call(cmd)
+        except (OSError, subprocess.CalledProcessError) as e:
             logging.fatal('Error regenerating initrd: {0}'.format(e))
             self.unit.status = BlockedStatus('error regenerating initrd')
-            return
+            return False
+
+        logging.info('Regenerated initrd for {0} in {1:.2f}s'.format(
+            ', '.join(kernels) or 'the newest kernel',
+            time.monotonic() - start))
+        self._stored.initrd_fingerprint = fingerprint
+        self._stored.initrd_rebuild_forced = None
+        return True
+
+    def _update_settings(self):
+        """
+        Apply the multipath, queue, FC and iSCSI settings of the charm
+        config, and check the metrics settings.
+
+        Returns their status messages, or None if the config is invalid,
+        in which case the unit is blocked.
+        """
+        # listed before multipathd may switch to strict mode
+        messages = [self._update_wwids()]
+        # name, label, update and whether it returns a status message
+        for name, label, update, reports in (
+                ('multipath', 'multipath', self._update_multipath_conf,
+                 False),
+                ('queue', 'queue', self._update_queue_settings, True),
+                ('fc', 'FC', self._update_fc_settings, True),
+                ('iscsi', 'iSCSI', self._update_iscsi_conf, True),
+                # applied once the unit is otherwise ready
+                ('metrics', 'metrics', self._validate_metrics_settings,
+                 False)):
+            try:
+                message = update()
+            except ValueError as e:
+                logger.error('Invalid {0} settings: {1}'.format(label, e))
+                self.unit.status = BlockedStatus(
+                    'invalid {0} config: {1}'.format(name, e))
+                return None
+            if reports:
+                messages.append(message)
+        return [m for m in messages if m]
 
     def on_install(self, event):
         logging.info('Preparing Infinidat tools package installation')
+        # nothing uses the storage of a unit being installed yet
+        self._rollout_held = True
 
         # initial installation, this is not called after reboot
         try:
             self.install_pkgs()
-            code = self._run_infinihost_check(auto_fix=True)
-            self._update_multipath_conf()
-            self._regenerate_initrd()
+            report = self._run_infinihost_check(auto_fix=True)
+            self._record_infinihost_check(report)
+            messages = self._update_settings()
+            if messages is None:
+                # not retried, config-changed applies the fixed config
+                return
+        except debbundle.BundleError as e:
+            logger.fatal("Invalid offline-debs resource: {0}".format(e))
+            # retried once a valid resource is attached
+            self.unit.status = BlockedStatus(
+                'invalid offline-debs resource: {0}'.format(e))
+            event.defer()
+            return
         except Exception as e:
             logger.fatal("Failed to install packages: {0}".format(str(e)))
             # something failed, attempt rerunning the hook later
@@ -225,47 +1081,208 @@ class InfinidatToolsCharm(OSBaseCharm):
             event.defer()
             return
 
-        self._set_lvm_conf_global_filter(
-            self.config.get('lvm_global_filter'))
+        lvm_global_filter = self._lvm_global_filter()
+        if lvm_global_filter is None or not self._set_lvm_conf_global_filter(
+                lvm_global_filter,
+                use_devicesfile=self.config.get('lvm_use_devicesfile')):
+            return
+        self._update_metrics_collector()
+        # once all of its inputs are written
+        if not self._regenerate_initrd():
+            return
 
-        if code != 0:
-            self.unit.status = ActiveStatus(
-                "review infinihost settings status")
-        else:
-            self.unit.status = ActiveStatus()
+        self.unit.status = ActiveStatus('; '.join(
+            m for m in [report.status_message()] + messages if m))
 
     def _get_default_repo_key(self):
-        url_fetcher = ArchiveUrlFetchHandler()
-        with tempfile.NamedTemporaryFile() as outfile:
-            outfile.close()
-            dest_path = os.path.join(tempfile.gettempdir(), outfile.name)
+        provider = KeyProvider(
+            mirror_url=self.model.config.get('install_key_url'),
+            fingerprint=self.model.config.get('install_key_fingerprint'))
+        with self._timings.phase('repo-key'):
+            return provider.get()
+
+    def _get_repo_key(self, source):
+        """
+        Key to add along with the source: the configured one, or the default
+        Infinidat key if the source needs one. The default key is only
+        looked up when it is actually going to be used.
+        """
+        install_keys = self.model.config.get('install_keys')
+        if install_keys:
+            return install_keys
+        if not source_needs_key(source):
+            return None
+        return self._get_default_repo_key()
 
-            url_fetcher.download(DEFAULT_REPO_KEY_URL,
-                                 dest_path)
-            with open(dest_path) as f:
-                return f.read()
+    def _repo_key_id(self, source):
+        """Identify the key _get_repo_key() returns, without resolving it."""
+        install_keys = self.model.config.get('install_keys')
+        if install_keys:
+            return install_keys
+        if not source_needs_key(source):
+            return None
+        return normalize_fingerprint(
+            self.model.config.get('install_key_fingerprint')) or \
+            self.model.config.get('install_key_url') or DEFAULT_REPO_KEY_URL
+
+    def _package_pins(self):
+        pins = {}
+        for pkg, option in self.PACKAGE_VERSION_OPTIONS.items():
+            if self.model.config.get(option):
+                pins[pkg] = self.model.config[option]
+        return pins
 
     def install_pkgs(self):
-        install_keys = self.model.config.get('install_keys')
-        if not install_keys:
-            install_keys = self._get_default_repo_key()
+        """
+        Configure the apt source and install the packages.
+
+        The source is only added, and apt_update only run, if the source or
+        its key changed since they were last configured. apt_install is
+        skipped if all the packages are installed at the desired version.
+        """
+        with self._timings.phase('install-pkgs'):
+            self._do_install_pkgs()
 
-        # we implement $codename expansion here
-        # see the default value for 'source' in config.yaml
-        if self.model.config.get('install_sources'):
+    def _do_install_pkgs(self):
+        bundle = self._offline_bundle()
+        if bundle is not None:
+            self._install_bundle(bundle)
+            return
+
+        # charmhelpers.fetch and charmhelpers.core.host are slow to import,
+        # only the hooks installing packages need them
+        from charmhelpers.core.host import lsb_release
+        from charmhelpers.fetch import add_source
+
+        updated = False
+        source = self.model.config.get('install_sources')
+        if source:
+            # we implement $codename expansion here
+            # see the default value for 'source' in config.yaml
             distrib_codename = lsb_release()['DISTRIB_CODENAME'].lower()
-            add_source(
-                self.model.config['install_sources']
-                    .format(distrib_codename=distrib_codename),
-                self.model.config.get('install_keys'))
-        apt_update(fatal=True)
-        apt_install(self.PACKAGES, fatal=True)
+            source = source.format(distrib_codename=distrib_codename)
+            source_id = source_fingerprint(source, self._repo_key_id(source))
+            if source_id != self._stored.apt_source_fingerprint:
+                add_source(source, self._get_repo_key(source))
+                self._apt_update()
+                updated = True
+                self._stored.apt_source_fingerprint = source_id
+            else:
+                logger.info('apt source is already configured')
+
+        pins = self._package_pins()
+        missing = missing_packages(self.PACKAGES, pins,
+                                   installed_versions(self.PACKAGES))
+        if not missing:
+            logger.info('Packages are already installed: {0}'.format(
+                ', '.join(self.PACKAGES)))
+            return
+
+        specs = [package_spec(pkg, pins.get(pkg)) for pkg in missing]
+        try:
+            self._apt_install(specs)
+        except subprocess.CalledProcessError:
+            if updated:
+                raise
+            # package lists may be out of date
+            self._apt_update()
+            self._apt_install(specs)
+
+    def _offline_bundle(self):
+        """
+        Return the DebBundle of the offline-debs resource, or None if it is
+        not attached. It is verified the first time it is seen.
+
+        Raises BundleError if the resource is not a valid bundle.
+        """
+        try:
+            path = self.model.resources.fetch(OFFLINE_DEBS_RESOURCE)
+        except (ModelError, NameError):
+            return None
+        # charm stores serve an empty file until a resource is attached
+        if not os.path.getsize(path):
+            return None
+        with self._timings.phase('offline-debs'):
+            return debbundle.load_bundle(
+                path, os.path.join(self.charm_dir, OFFLINE_DEBS_CACHE))
+
+    def _install_bundle(self, bundle):
+        """
+        Install the packages from the offline-debs bundle, with a single apt
+        transaction that does not download anything. The apt source is left
+        alone.
+        """
+        missing = [pkg for pkg in self.PACKAGES if pkg not in bundle.versions]
+        if missing:
+            raise debbundle.BundleError('no {0} package'.format(
+                ', '.join(missing)))
+        pins = self._package_pins()
+        for pkg, version in pins.items():
+            if bundle.versions[pkg] != version:
+                raise debbundle.BundleError(
+                    '{0} {1} does not match {2} {3}'.format(
+                        pkg, bundle.versions[pkg],
+                        self.PACKAGE_VERSION_OPTIONS[pkg], version))
+
+        if not missing_packages(self.PACKAGES, bundle.versions,
+                                installed_versions(self.PACKAGES)):
+            logger.info('Packages of the offline bundle are already '
+                        'installed')
+            return
+
+        logger.info('Installing {0} packages from the offline bundle'.format(
+            len(bundle.debs)))
+        env = dict(os.environ, DEBIAN_FRONTEND='noninteractive')
+        with self._timings.phase('apt-install'):
+            subprocess.check_call(
+                ['apt-get', 'install', '--yes', '--no-download',
+                 '--no-install-recommends',
+                 '--option=Dpkg::Options::=--force-confold'] + bundle.debs,
+                env=env)
+
+    def _apt_update(self):
+        from charmhelpers.fetch import apt_update
+
+        with self._timings.phase('apt-update'):
+            apt_update(fatal=True)
+
+    def _apt_install(self, specs):
+        from charmhelpers.fetch import apt_install
+
+        with self._timings.phase('apt-install'):
+            apt_install(specs, fatal=True)
 
     def on_config(self, event):
-        self._set_lvm_conf_global_filter(
-            self.config.get('lvm_global_filter'))
+        try:
+            # cheap if packages and source are already in place
+            self.install_pkgs()
+        except debbundle.BundleError as e:
+            logger.error("Invalid offline-debs resource: {0}".format(e))
+            self.unit.status = BlockedStatus(
+                'invalid offline-debs resource: {0}'.format(e))
+            return
+        except Exception as e:
+            logger.error("Failed to install packages: {0}".format(str(e)))
+            self.unit.status = BlockedStatus("Installation failed")
+            return
 
-        self.unit.status = ActiveStatus()
+        messages = self._update_settings()
+        if messages is None:
+            return
+
+        lvm_global_filter = self._lvm_global_filter()
+        if lvm_global_filter is None or not self._set_lvm_conf_global_filter(
+                lvm_global_filter,
+                use_devicesfile=self.config.get('lvm_use_devicesfile')):
+            return
+        self._update_metrics_collector()
+        # the files written above end up in the initrd, it is only
+        # regenerated if they changed
+        if not self._regenerate_initrd():
+            return
+
+        self.unit.status = ActiveStatus('; '.join(
+            messages + [m for m in (self._rollout_status(),) if m]))
 
     def on_run_infinidat_settings_check_action(self, event):
         Path(INFINIHOST_RESULTS_DIR).mkdir(parents=True, exist_ok=True)
@@ -275,29 +1292,339 @@ class InfinidatToolsCharm(OSBaseCharm):
         else:
             auto_fix = False
 
+        if event.params.get('cached') and not event.params.get('force') \
+                and not auto_fix:
+            cached = self._get_cached_infinihost_report()
+            if cached is not None:
+                report, path, age = cached
+                event.log("Using infinihost results from {0:.0f}s ago"
+                          .format(age))
+                results = self._infinihost_action_results(report, path)
+                results["cached"] = True
+                results["age"] = int(age)
+                event.set_results(results)
+                return
+
+        if event.params.get('background'):
+            self._start_infinihost_job(event, auto_fix)
+            return
+
+        def progress(result):
+            event.log("{0} ... {1}".format(result.name, result.status))
+
+        report = None
         with tempfile.NamedTemporaryFile(mode="w+b", prefix='infinihost-out-',
                                          dir=INFINIHOST_RESULTS_DIR,
                                          delete=False) as outfile:
             try:
                 event.log("Running 'infinihost settings check'")
-                code = self._run_infinihost_check(auto_fix=auto_fix,
-                                                  stdout=outfile)
+                report = self._run_infinihost_check(auto_fix=auto_fix,
+                                                    outfile=outfile,
+                                                    progress=progress)
                 Path(outfile.name).chmod(0o644)
-            except subprocess.CalledProcessError as e:
+            except (OSError, subprocess.SubprocessError) as e:
                 msg = "Failed to run infinihost: {0}".format(str(e))
                 logger.fatal(msg)
                 event.fail(msg)
+                return
+
+        self._complete_infinihost_run(
+            event, report, os.path.join(INFINIHOST_RESULTS_DIR, outfile.name),
+            auto_fix)
 
+    def _complete_infinihost_run(self, event, report, path, auto_fix):
+        self._record_infinihost_check(report)
         if auto_fix:
             event.log("--auto-fix is enabled, updating multipath.conf")
-            self._update_multipath_conf()
+            try:
+                self._update_multipath_conf()
+            except ValueError as e:
+                event.fail("Invalid multipath settings: {0}".format(e))
+                return
+
+        try:
+            self._results_store().add(path, report)
+        except OSError as e:
+            logger.warning("Failed to update infinihost results index: "
+                           "{0}".format(e))
+
+        if not auto_fix:
+            # results of --auto-fix runs describe the state before the fixes
+            self._cache_infinihost_report(report, path)
+
+        event.set_results(self._infinihost_action_results(report, path))
+        self._publish_backend_summary()
+
+    def _start_infinihost_job(self, event, auto_fix):
+        running = running_jobs(INFINIHOST_JOBS_DIR)
+        if running:
+            event.log("infinihost is already running in the background")
+            job_id = running[0]
+        else:
+            job_id = '{0}-{1}'.format(time.strftime('%Y%m%d%H%M%S'),
+                                      uuid.uuid4().hex[:8])
+            start_job(INFINIHOST_JOBS_DIR, job_id, auto_fix=auto_fix,
+                      timeout=self.config.get('infinihost_timeout'))
+            logger.info("Started infinihost job {0}".format(job_id))
 
         event.set_results({
+            "job-id": job_id,
+            "result": "infinihost is running in the background, use the "
+                      "get-infinihost-result action with job-id={0} to "
+                      "get its results".format(job_id),
+        })
+
+    def on_get_infinihost_result_action(self, event):
+        job_id = event.params['job-id']
+        state, data = job_status(INFINIHOST_JOBS_DIR, job_id)
+
+        if state == 'unknown':
+            event.fail("No infinihost job {0}, completed jobs are listed "
+                       "by list-infinihost-results".format(job_id))
+            return
+        if state == 'running':
+            event.set_results({
+                "state": state,
+                "completed-checks": len(data.checks),
+                "summary": data.counts,
+            })
+            return
+
+        out, _, _ = job_paths(INFINIHOST_JOBS_DIR, job_id)
+        path = os.path.join(INFINIHOST_RESULTS_DIR,
+                            'infinihost-out-{0}'.format(job_id))
+        if os.path.exists(out):
+            os.chmod(out, 0o644)
+            os.rename(out, path)
+        remove_job(INFINIHOST_JOBS_DIR, job_id)
+
+        if state == 'failed' or 'error' in data:
+            msg = data.get('error') if data else \
+                "infinihost job {0} died".format(job_id)
+            event.fail(msg)
+            return
+
+        self._complete_infinihost_run(
+            event, InfinihostReport.from_dict(data['report']), path,
+            data.get('auto-fix', False))
+
+    def _infinihost_fingerprint(self):
+        version = installed_versions(['host-power-tools']).get(
+            'host-power-tools')
+        return host_state_fingerprint(MULTIPATH_CONF, version)
+
+    def _cache_infinihost_report(self, report, path):
+        self._stored.infinihost_cache = json.dumps({
+            'timestamp': time.time(),
+            'fingerprint': self._infinihost_fingerprint(),
+            'path': path,
+            'report': report.to_dict(),
+        })
+
+    def _get_cached_infinihost_report(self):
+        """
+        Return (report, path, age) of the last infinihost run, or None if
+        there is none, it is older than infinihost_cache_ttl or the host
+        storage state changed since.
+        """
+        if not self._stored.infinihost_cache:
+            return None
+        cache = json.loads(self._stored.infinihost_cache)
+
+        age = time.time() - cache['timestamp']
+        if age > self.config.get('infinihost_cache_ttl'):
+            logger.info('Cached infinihost results expired')
+            return None
+        if cache['fingerprint'] != self._infinihost_fingerprint():
+            logger.info('Host state changed since the last infinihost run')
+            return None
+
+        path = cache['path']
+        if not os.path.exists(path) and os.path.exists(path + '.gz'):
+            # compressed by the results store since
+            path += '.gz'
+
+        return (InfinihostReport.from_dict(cache['report']), path, age)
+
+    def _results_store(self):
+        return ResultsStore(
+            INFINIHOST_RESULTS_DIR,
+            keep_count=self.config.get('infinihost_results_keep'),
+            max_age=self.config.get('infinihost_results_max_age'))
+
+    def _record_timings(self, event):
+        """Add the phase timings of this hook run to the history."""
+        if not self._timings.phases:
+            return
+        hook = os.environ.get('JUJU_HOOK_NAME') or \
+            os.environ.get('JUJU_ACTION_NAME') or 'unknown'
+        logger.info('{0} timings: {1}'.format(hook, self._timings.describe()))
+        runs = json.loads(self._stored.hook_timings or '[]')
+        self._stored.hook_timings = json.dumps(
+            add_run(runs, hook, self._timings.phases))
+        self._timings = PhaseTimer()
+
+    def on_show_timings_action(self, event):
+        runs = json.loads(self._stored.hook_timings or '[]')
+        hook = event.params.get('hook')
+        if hook:
+            runs = [r for r in runs if r['hook'] == hook]
+        limit = event.params.get('runs')
+        if limit:
+            runs = runs[-limit:]
+
+        lines = []
+        for run in reversed(runs):
+            phases = sorted(run['phases'].items(),
+                            key=lambda p: p[1][0], reverse=True)
+            lines.append("{0} {1} {2}".format(
+                time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                              time.gmtime(run['timestamp'])),
+                run['hook'],
+                ' '.join('{0}={1:.2f}s'.format(name, wall)
+                         for name, (wall, _) in phases)))
+
+        results = {
+            "count": len(runs),
+            "runs": "\n".join(lines),
+        }
+        summary = phase_summary(runs)
+        if summary:
+            results["phases"] = summary
+        event.set_results(results)
+
+    def on_list_infinihost_results_action(self, event):
+        entries = self._results_store().entries()
+        limit = event.params.get('limit')
+        if limit:
+            entries = entries[-limit:]
+
+        lines = []
+        for e in reversed(entries):
+            summary = e.get('summary') or {}
+            lines.append("{0} exit-code={1} ok={2} fail={3} skip={4} {5}"
+                         .format(time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                               time.gmtime(e['timestamp'])),
+                                 e.get('exit-code'),
+                                 summary.get('ok', '-'),
+                                 summary.get('fail', '-'),
+                                 summary.get('skip', '-'),
+                                 os.path.join(INFINIHOST_RESULTS_DIR,
+                                              e['file'])))
+        event.set_results({
+            "count": len(lines),
+            "results": "\n".join(lines),
+        })
+
+    def _infinihost_action_results(self, report, path):
+        results = {
             "result":
                 "exit code={0}\n"
-                "see 'juju ssh -m {1} {2} cat {3}' for more details"
-                .format(code, self.unit.name, self.model.name,
-                        os.path.join(INFINIHOST_RESULTS_DIR, outfile.name))})
+                "see 'juju ssh -m {1} {2} {3} {4}' for more details"
+                .format(report.code, self.model.name, self.unit.name,
+                        'zcat' if path.endswith('.gz') else 'cat', path),
+            "exit-code": report.code,
+            "summary": report.counts,
+        }
+        if report.verdict:
+            results["verdict"] = report.verdict
+        details = self._report_details(report)
+        if details:
+            results["details"] = details
+
+        return results
+
+    def _report_details(self, report):
+        return "\n".join(
+            "{0}: {1}{2}".format(
+                c.name, c.reason or c.status,
+                " ({0})".format(c.kb_link) if c.kb_link else "")
+            for c in report.checks if c.status != STATUS_OK)
+
+    def on_quick_check_action(self, event):
+        start = time.monotonic()
+        topology = StorageTopology.discover()
+        report = check_topology(topology,
+                                min_paths=event.params.get('min-paths'),
+                                schedulers=self._expected_schedulers())
+        elapsed = time.monotonic() - start
+
+        if report.ok:
+            result = "ok"
+        else:
+            result = "{0} failed check(s)".format(len(report.failures))
+        results = {
+            "result": result,
+            "summary": report.counts,
+            "infinibox-luns": len(topology.infinibox_luns),
+            "multipath-devices":
+                len(topology.infinibox_multipath_devices),
+            "duration-ms": int(elapsed * 1000),
+        }
+        details = self._report_details(report)
+        if details:
+            results["details"] = details
+        event.set_results(results)
+
+    def on_rescan_infinibox_action(self, event):
+        try:
+            luns = rescan.parse_luns(event.params.get('luns'))
+        except ValueError as e:
+            event.fail(str(e))
+            return
+        jobs = event.params.get('jobs')
+
+        start = time.monotonic()
+        topology = StorageTopology.discover()
+        targets = rescan.infinibox_targets(topology)
+        if not targets:
+            event.set_results({"result": "no InfiniBox targets",
+                               "targets": 0})
+            return
+
+        before = rescan.target_devices(topology, targets, luns)
+        with self._timings.phase('rescan'):
+            errors = rescan.scan_targets(targets, luns, jobs)
+            # one sysfs write per known device, only done when asked
+            if event.params.get('resize'):
+                errors.update(rescan.rescan_devices(sorted(before), jobs))
+        after = rescan.target_devices(StorageTopology.discover(), targets,
+                                      luns)
+        changes = rescan.compare(before, after)
+
+        # only wait for the events of the devices that changed
+        blocks = rescan.affected_blocks(before, after)
+        if blocks:
+            try:
+                with self._timings.phase('udev-settle'):
+                    subprocess.run(
+                        ['udevadm', 'trigger', '--action=change',
+                         '--settle'] +
+                        [os.path.join('/sys/block', b) for b in blocks],
+                        check=True,
+                        timeout=event.params.get('settle-timeout'))
+            except (OSError, subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired) as e:
+                logger.warning('udev did not settle: {0}'.format(e))
+                errors['udev'] = 'did not settle: {0}'.format(e)
+
+        results = {
+            "result": "{0} new, {1} removed, {2} resized device(s)".format(
+                len(changes.new), len(changes.removed),
+                len(changes.resized)),
+            "targets": len(targets),
+            "duration-ms": int((time.monotonic() - start) * 1000),
+        }
+        for key, lines in (("new", changes.new),
+                           ("removed", changes.removed),
+                           ("resized", changes.resized)):
+            if lines:
+                results[key] = "\n".join(lines)
+        if errors:
+            results["errors"] = rescan.describe_errors(errors)
+        event.set_results(results)
+        if errors:
+            event.fail('rescan incomplete: {0} error(s)'.format(len(errors)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,93 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for idempotent updates of configuration files."""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def content_digest(content):
+    """Return the sha256 hex digest of str or bytes content."""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of a file, or None if it is missing."""
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def atomic_write(path, content, perms=None):
+    """Atomically replace path with content.
+
+    The data is written to a temporary file in the same directory which is
+    then renamed over the target, so readers never see a partially written
+    file. Mode and ownership of an existing file are preserved unless perms
+    is given.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+
+    fd, tmp = tempfile.mkstemp(dir=dirname,
+                               prefix='.{0}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if perms is not None:
+            os.chmod(tmp, perms)
+        elif st is not None:
+            os.chmod(tmp, st.st_mode & 0o7777)
+            if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+                os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_file_if_changed(path, content, perms=None):
+    """Write content to path unless the file already has this content.
+
+    Returns True if the file was written.
+    """
+    if file_digest(path) == content_digest(content):
+        logger.debug('{0} is up to date'.format(path))
+        return False
+
+    logger.info('Writing {0}'.format(path))
+    atomic_write(path, content, perms=perms)
+    return True
@@ -0,0 +1,185 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bundles of .deb packages attached as a charm resource.
+
+A bundle is a tarball of .deb files along with a SHA256SUMS manifest, as
+written by 'sha256sum *.deb > SHA256SUMS'. It is verified and extracted
+once, later hooks use the extracted copy.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+from typing import Dict, List, NamedTuple
+
+from confutils import atomic_write, file_digest
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'SHA256SUMS'
+# package versions of a verified bundle, written once it is extracted
+INDEX = 'index.json'
+
+# '<sha256>  <file>', '*' marks files hashed in binary mode
+MANIFEST_LINE_RE = re.compile(r'^(?P<digest>[0-9a-f]{64}) [ *](?P<name>.+)$')
+
+
+class BundleError(ValueError):
+    """The bundle is not a valid tarball of verified .deb files."""
+
+
+class DebBundle(NamedTuple):
+    digest: str
+    # paths of the extracted .deb files
+    debs: List[str]
+    # {package: version}
+    versions: Dict[str, str]
+
+
+def parse_manifest(text):
+    """{file name: sha256} of a SHA256SUMS manifest."""
+    digests = {}
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        m = MANIFEST_LINE_RE.match(line.strip())
+        if not m:
+            raise BundleError('invalid {0} line {1}'.format(MANIFEST, number))
+        digests[os.path.basename(m.group('name'))] = m.group('digest')
+    return digests
+
+
+def deb_fields(path):
+    """(package, version) of a .deb file."""
+    try:
+        out = subprocess.check_output(
+            ['dpkg-deb', '--field', path, 'Package', 'Version'],
+            universal_newlines=True)
+    except subprocess.CalledProcessError:
+        raise BundleError('{0} is not a valid package'.format(
+            os.path.basename(path)))
+    fields = {}
+    for line in out.splitlines():
+        key, _, value = line.partition(':')
+        fields[key.strip()] = value.strip()
+    if not fields.get('Package') or not fields.get('Version'):
+        raise BundleError('{0} is not a valid package'.format(
+            os.path.basename(path)))
+    return fields['Package'], fields['Version']
+
+
+def _extract(tarball, target):
+    """Extract the .deb files and the manifest of the tarball, flattened
+    into target. Returns the manifest text."""
+    manifest = None
+    try:
+        with tarfile.open(tarball) as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                name = os.path.basename(member.name)
+                if name != MANIFEST and not name.endswith('.deb'):
+                    continue
+                if not member.isfile():
+                    raise BundleError('{0} is not a regular file'.format(
+                        member.name))
+                path = os.path.join(target, name)
+                if os.path.exists(path):
+                    raise BundleError('duplicate {0}'.format(name))
+                with tar.extractfile(member) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                if name == MANIFEST:
+                    with open(path) as f:
+                        manifest = f.read()
+    except (tarfile.TarError, EOFError) as e:
+        raise BundleError('invalid tarball: {0}'.format(e))
+    if manifest is None:
+        raise BundleError('no {0} manifest'.format(MANIFEST))
+    return manifest
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def verify(target, manifest):
+    """Check the extracted .deb files against the manifest.
+
+    Returns the sorted names of the .deb files.
+    """
+    digests = parse_manifest(manifest)
+    debs = sorted(n for n in os.listdir(target) if n.endswith('.deb'))
+    if not debs:
+        raise BundleError('no .deb files')
+    unlisted = [n for n in debs if n not in digests]
+    if unlisted:
+        raise BundleError('not in {0}: {1}'.format(
+            MANIFEST, ', '.join(unlisted)))
+    missing = sorted(set(digests) - set(debs))
+    if missing:
+        raise BundleError('missing: {0}'.format(', '.join(missing)))
+    bad = [n for n in debs if _sha256(os.path.join(target, n)) != digests[n]]
+    if bad:
+        raise BundleError('checksum mismatch: {0}'.format(', '.join(bad)))
+    return debs
+
+
+def load_bundle(tarball, cache_dir):
+    """Return the DebBundle of a tarball, verifying and extracting it to
+    cache_dir unless it already was.
+
+    Raises BundleError if the tarball is not a valid bundle.
+    """
+    digest = file_digest(tarball)
+    target = os.path.join(cache_dir, digest)
+    index = os.path.join(target, INDEX)
+    if os.path.exists(index):
+        with open(index) as f:
+            versions = json.load(f)
+        debs = sorted(os.path.join(target, n) for n in os.listdir(target)
+                      if n.endswith('.deb'))
+        return DebBundle(digest, debs, versions)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.extract-')
+    try:
+        debs = verify(tmp, _extract(tarball, tmp))
+        versions = {}
+        for name in debs:
+            package, version = deb_fields(os.path.join(tmp, name))
+            versions[package] = version
+        atomic_write(os.path.join(tmp, INDEX), json.dumps(versions))
+        # only keep the bundle in use
+        for old in os.listdir(cache_dir):
+            if not old.startswith('.'):
+                shutil.rmtree(os.path.join(cache_dir, old))
+        os.rename(tmp, target)
+    except BaseException:
+        shutil.rmtree(tmp)
+        raise
+
+    logger.info('Verified {0} packages of {1}'.format(len(debs), tarball))
+    return DebBundle(digest, [os.path.join(target, n) for n in debs],
+                     versions)
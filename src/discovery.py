@@ -0,0 +1,249 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Discovery of InfiniBox devices from sysfs, and checks of their setup.
+
+The checks mirror the Devices and Performance checks of infinihost, and
+run in milliseconds as they only read sysfs.
+"""
+
+import glob
+import os
+from typing import List, NamedTuple, Optional
+
+from infinihost import (
+    CheckResult,
+    InfinihostReport,
+    STATUS_FAIL,
+    STATUS_OK,
+    STATUS_SKIP,
+)
+
+INFINIBOX_VENDOR = 'NFINIDAT'
+INFINIBOX_MODEL = 'InfiniBox'
+# schedulers recommended for InfiniBox devices, 'noop' on legacy block
+# layer kernels and 'none' on blk-mq ones
+RECOMMENDED_SCHEDULERS = ('noop', 'none')
+MIN_PATHS = 2
+# prefixes multipath gives WWIDs after the type of the SCSI identifier
+WWID_TYPE_PREFIXES = {'naa.': '3', 'eui.': '2'}
+
+
+def read_attr(path, default=''):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def read_scheduler(device, sysfs='/sys'):
+    """Active I/O scheduler of a block device, e.g. 'mq-deadline'."""
+    data = read_attr(os.path.join(sysfs, 'block', device, 'queue',
+                                  'scheduler'))
+    for sched in data.split():
+        if sched.startswith('['):
+            return sched.strip('[]')
+    # devices with a single scheduler may not bracket it
+    return data
+
+
+def multipath_wwid(device_wwid):
+    """WWID multipath uses for a SCSI device, from its sysfs 'wwid'
+    attribute, e.g. 'naa.6742b0f...' -> '36742b0f...'. Empty for
+    identifier types multipath does not derive the WWID from."""
+    for prefix, wwid_type in WWID_TYPE_PREFIXES.items():
+        if device_wwid.startswith(prefix):
+            return wwid_type + device_wwid[len(prefix):].lower()
+    return ''
+
+
+class ScsiDevice(NamedTuple):
+    hcil: str
+    vendor: str
+    model: str
+    state: str
+    # block device name, e.g. 'sdb', None if there is none
+    block: Optional[str]
+    scheduler: str
+    queue_depth: str
+    # multipath WWID, empty if the device does not report one
+    wwid: str = ''
+
+    @property
+    def infinibox(self):
+        return self.vendor == INFINIBOX_VENDOR and \
+            self.model.startswith(INFINIBOX_MODEL)
+
+
+class DmDevice(NamedTuple):
+    device: str
+    name: str
+    uuid: str
+    scheduler: str
+    slaves: List[str]
+
+    @property
+    def multipath(self):
+        return self.uuid.startswith('mpath-')
+
+    @property
+    def wwid(self):
+        return self.uuid[len('mpath-'):] if self.multipath else None
+
+
+class StorageTopology(object):
+    """SCSI and device-mapper devices, indexed by HCTL and device name."""
+
+    def __init__(self, scsi, dm):
+        self.scsi = {s.hcil: s for s in scsi}
+        self.dm = {d.device: d for d in dm}
+        self.by_block = {s.block: s for s in scsi if s.block}
+        # block device name -> dm device it is a slave of
+        self.holders = {}
+        for d in dm:
+            for slave in d.slaves:
+                self.holders[slave] = d
+
+    @classmethod
+    def discover(cls, sysfs='/sys'):
+        scsi = []
+        for dev in glob.glob(os.path.join(sysfs, 'class', 'scsi_device',
+                                          '*', 'device')):
+            hcil = os.path.basename(os.path.dirname(dev))
+            try:
+                blocks = os.listdir(os.path.join(dev, 'block'))
+            except OSError:
+                blocks = []
+            block = blocks[0] if blocks else None
+            scsi.append(ScsiDevice(
+                hcil,
+                read_attr(os.path.join(dev, 'vendor')),
+                read_attr(os.path.join(dev, 'model')),
+                read_attr(os.path.join(dev, 'state')),
+                block,
+                read_scheduler(block, sysfs) if block else '',
+                read_attr(os.path.join(dev, 'queue_depth')),
+                multipath_wwid(read_attr(os.path.join(dev, 'wwid')))))
+
+        dm = []
+        for path in glob.glob(os.path.join(sysfs, 'block', 'dm-*')):
+            device = os.path.basename(path)
+            try:
+                slaves = sorted(os.listdir(os.path.join(path, 'slaves')))
+            except OSError:
+                slaves = []
+            dm.append(DmDevice(
+                device,
+                read_attr(os.path.join(path, 'dm', 'name')),
+                read_attr(os.path.join(path, 'dm', 'uuid')),
+                read_scheduler(device, sysfs),
+                slaves))
+
+        return cls(scsi, dm)
+
+    @property
+    def infinibox_luns(self):
+        return sorted((s for s in self.scsi.values() if s.infinibox),
+                      key=lambda s: s.hcil)
+
+    @property
+    def infinibox_multipath_devices(self):
+        """Multipath devices with at least one InfiniBox path."""
+        devices = set()
+        for lun in self.infinibox_luns:
+            holder = self.holders.get(lun.block)
+            if holder is not None and holder.multipath:
+                devices.add(holder.device)
+        return [self.dm[d] for d in sorted(devices)]
+
+    def running_paths(self, dm):
+        """Number of paths of a dm device in the SCSI running state."""
+        return sum(self.by_block[s].state == 'running'
+                   for s in dm.slaves if s in self.by_block)
+
+
+CHECK_NO_MULTIPATH = "Checking for volumes that don't have a multipath device"
+CHECK_NO_BLOCK = \
+    'Checking that all reported InfiniBox LUNs have a block device'
+CHECK_PATH_COUNT = 'Checking the path count for all InfiniBox MPIO devices'
+CHECK_SCHEDULER = \
+    "Checking that the current I/O scheduler for all InfiniBox " \
+    "scsi-disks is 'noop' and for all InfiniBox dm-disks is 'none'"
+
+
+def _check(category, name, failures, reason):
+    if failures:
+        return CheckResult(category, name, STATUS_FAIL,
+                           reason='{0}: {1}'.format(reason,
+                                                    ', '.join(failures)))
+    return CheckResult(category, name, STATUS_OK)
+
+
+def check_topology(topology, min_paths=MIN_PATHS,
+                   schedulers=RECOMMENDED_SCHEDULERS):
+    """Run the device checks, return an InfinihostReport.
+
+    schedulers are the I/O schedulers InfiniBox devices are expected to
+    use.
+    """
+    luns = topology.infinibox_luns
+    if not luns:
+        reason = 'no InfiniBox LUNs found'
+        return InfinihostReport(0, [
+            CheckResult('Devices', CHECK_NO_MULTIPATH, STATUS_SKIP,
+                        reason=reason),
+            CheckResult('Devices', CHECK_NO_BLOCK, STATUS_SKIP,
+                        reason=reason),
+            CheckResult('Devices', CHECK_PATH_COUNT, STATUS_SKIP,
+                        reason=reason),
+            CheckResult('Performance', CHECK_SCHEDULER, STATUS_SKIP,
+                        reason=reason),
+        ])
+
+    no_block = []
+    no_multipath = []
+    device_schedulers = []
+    for lun in luns:
+        if not lun.block:
+            no_block.append(lun.hcil)
+            continue
+        holder = topology.holders.get(lun.block)
+        if holder is None or not holder.multipath:
+            no_multipath.append(lun.block)
+        device_schedulers.append((lun.block, lun.scheduler))
+
+    few_paths = []
+    for dm in topology.infinibox_multipath_devices:
+        running = topology.running_paths(dm)
+        if running < min_paths:
+            few_paths.append('{0} ({1}/{2})'.format(
+                dm.name, running, len(dm.slaves)))
+        device_schedulers.append((dm.name, dm.scheduler))
+
+    bad_schedulers = ['{0}={1}'.format(name, sched)
+                      for name, sched in device_schedulers
+                      if sched and sched not in schedulers]
+
+    checks = [
+        _check('Devices', CHECK_NO_MULTIPATH, no_multipath,
+               'not part of a multipath device'),
+        _check('Devices', CHECK_NO_BLOCK, no_block, 'no block device'),
+        _check('Devices', CHECK_PATH_COUNT, few_paths,
+               'fewer than {0} running paths'.format(min_paths)),
+        _check('Performance', CHECK_SCHEDULER, bad_schedulers,
+               'unexpected scheduler'),
+    ]
+    code = 0 if all(c.status == STATUS_OK for c in checks) else 1
+    return InfinihostReport(code, checks)
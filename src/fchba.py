@@ -0,0 +1,151 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queue depth settings of FC HBA drivers and of the LUNs behind them."""
+
+import glob
+import os
+
+from discovery import read_attr
+
+MODPROBE_CONF = '/etc/modprobe.d/infinidat-tools-fc.conf'
+
+# driver module parameters set by each setting
+LUN_QUEUE_DEPTH_PARAMS = {
+    'qla2xxx': 'ql2xmaxqdepth',
+    'lpfc': 'lpfc_lun_queue_depth',
+}
+HBA_QUEUE_DEPTH_PARAMS = {
+    'lpfc': 'lpfc_hba_queue_depth',
+}
+
+# ranges accepted by the drivers
+LUN_QUEUE_DEPTH_RANGE = (1, 512)
+HBA_QUEUE_DEPTH_RANGE = (32, 8192)
+
+
+def validate_fc_settings(lun_queue_depth, hba_queue_depth):
+    """Return a list of problems with the FC settings.
+
+    Settings are strings, empty ones are left to the drivers.
+    """
+    errors = []
+    for name, value, (low, high) in (
+            ('lun_queue_depth', lun_queue_depth, LUN_QUEUE_DEPTH_RANGE),
+            ('hba_queue_depth', hba_queue_depth, HBA_QUEUE_DEPTH_RANGE)):
+        value = str(value or '')
+        if not value:
+            continue
+        if not value.isdigit():
+            errors.append('{0} must be a number'.format(name))
+        elif not low <= int(value) <= high:
+            errors.append('{0} must be between {1} and {2}'.format(
+                name, low, high))
+    return errors
+
+
+def module_options(lun_queue_depth, hba_queue_depth):
+    """{driver: {parameter: value}} of the settings set."""
+    options = {}
+    for params, value in ((LUN_QUEUE_DEPTH_PARAMS, lun_queue_depth),
+                          (HBA_QUEUE_DEPTH_PARAMS, hba_queue_depth)):
+        if value in (None, ''):
+            continue
+        for driver, param in params.items():
+            options.setdefault(driver, {})[param] = str(value)
+    return options
+
+
+def render_modprobe(options):
+    """modprobe.d file setting the options, empty if there are none."""
+    if not options:
+        return ''
+    lines = ['# Managed by the infinidat-tools charm']
+    for driver, params in sorted(options.items()):
+        lines.append('options {0} {1}'.format(driver, ' '.join(
+            '{0}={1}'.format(p, v) for p, v in sorted(params.items()))))
+    return '\n'.join(lines) + '\n'
+
+
+def fc_hosts(sysfs='/sys'):
+    """{SCSI host number: driver} of the FC HBA ports, e.g. {'3': 'lpfc'}."""
+    hosts = {}
+    for path in sorted(glob.glob(os.path.join(sysfs, 'class', 'fc_host',
+                                              'host*'))):
+        host = os.path.basename(path)
+        hosts[host[4:]] = read_attr(os.path.join(
+            sysfs, 'class', 'scsi_host', host, 'proc_name'))
+    return hosts
+
+
+def loaded_params(driver, sysfs='/sys'):
+    """{parameter: value} the loaded driver module uses, empty if it is not
+    loaded."""
+    params = {}
+    for path in glob.glob(os.path.join(sysfs, 'module', driver,
+                                       'parameters', '*')):
+        params[os.path.basename(path)] = read_attr(path)
+    return params
+
+
+def pending_options(options, hosts, sysfs='/sys'):
+    """Module options the drivers of the FC HBAs in use were not loaded
+    with, e.g. 'lpfc: lpfc_lun_queue_depth=30 (expected 64)'.
+
+    They only apply once the driver is reloaded, which in practice means
+    a reboot.
+    """
+    pending = []
+    for driver in sorted(set(hosts.values())):
+        loaded = loaded_params(driver, sysfs)
+        for param, value in sorted(options.get(driver, {}).items()):
+            actual = loaded.get(param)
+            if actual is not None and actual != value:
+                pending.append('{0}: {1}={2} (expected {3})'.format(
+                    driver, param, actual, value))
+    return pending
+
+
+def fc_luns(topology, hosts):
+    """InfiniBox LUNs behind the FC HBAs."""
+    return [lun for lun in topology.infinibox_luns
+            if lun.hcil.split(':')[0] in hosts]
+
+
+def lun_depth_mismatches(luns, lun_queue_depth):
+    """LUNs whose queue depth is not lun_queue_depth."""
+    if lun_queue_depth in (None, ''):
+        return []
+    return [lun for lun in luns if lun.queue_depth != str(lun_queue_depth)]
+
+
+def apply_lun_queue_depth(luns, lun_queue_depth, sysfs='/sys'):
+    """Set the queue depth of the running LUNs.
+
+    Returns the LUNs it could not be set on, drivers cap it to the queue
+    depth they were loaded with.
+    """
+    failed = []
+    for lun in luns:
+        path = os.path.join(sysfs, 'class', 'scsi_device', lun.hcil,
+                            'device', 'queue_depth')
+        try:
+            with open(path, 'w') as f:
+                f.write(str(lun_queue_depth))
+        except OSError:
+            failed.append(lun)
+            continue
+        if read_attr(path) != str(lun_queue_depth):
+            failed.append(lun)
+    return failed
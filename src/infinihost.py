@@ -0,0 +1,437 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Running 'infinihost settings check' and parsing its output."""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+from typing import List, NamedTuple, Optional
+
+from confutils import atomic_write, file_digest
+
+logger = logging.getLogger(__name__)
+
+# seconds between SIGTERM and SIGKILL when infinihost times out
+KILL_GRACE = 10
+
+STATUS_OK = 'ok'
+STATUS_FAIL = 'fail'
+STATUS_SKIP = 'skip'
+
+ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+# SCSI: Checking that sg3-utils is installed ... ok
+# Multipath: Checking that multipath-tools is running. ... fail applying fix ok
+CHECK_LINE_RE = re.compile(
+    r'^(?P<category>[^:]+): (?P<check>.+?) \.\.\. (?P<status>\w+)'
+    r'(?: applying fix\s*(?P<fix>\w+))?\s*$')
+
+# Fail Multipath: Checking that multipath-tools is running.
+DETAIL_HEADER_RE = re.compile(
+    r'^(?P<status>[A-Z]\w*) (?P<category>[^:]+): (?P<check>.+?)\s*$')
+
+# (failures=1, skips=11)
+SUMMARY_RE = re.compile(r'^\((?P<counts>\w+=\d+(?:, \w+=\d+)*)\)\s*$')
+
+REASON_PREFIX = 'REASON: '
+INFO_PREFIX = 'INFO: '
+KB_LINK_RE = re.compile(r'(https?://\S+)')
+
+
+def strip_ansi(line):
+    """Remove terminal color codes from a line of infinihost output."""
+    return ANSI_ESCAPE_RE.sub('', line)
+
+
+class CheckResult(NamedTuple):
+    """Outcome of a single infinihost check.
+
+    fix_applied is None if infinihost did not attempt a fix, otherwise it
+    tells whether the fix succeeded.
+    """
+
+    category: str
+    check: str
+    status: str
+    fix_applied: Optional[bool] = None
+    reason: Optional[str] = None
+    kb_link: Optional[str] = None
+
+    @property
+    def name(self):
+        return '{0}: {1}'.format(self.category, self.check)
+
+
+class InfinihostReport(NamedTuple):
+    """All the checks of an infinihost run along with its exit code."""
+
+    code: Optional[int]
+    checks: List[CheckResult]
+    verdict: Optional[str] = None
+
+    def by_status(self, status):
+        return [c for c in self.checks if c.status == status]
+
+    @property
+    def failures(self):
+        """Failed checks that were not fixed by --auto-fix."""
+        return [c for c in self.by_status(STATUS_FAIL) if not c.fix_applied]
+
+    @property
+    def counts(self):
+        counts = {STATUS_OK: 0, STATUS_FAIL: 0, STATUS_SKIP: 0}
+        for c in self.checks:
+            counts[c.status] = counts.get(c.status, 0) + 1
+        return counts
+
+    @property
+    def ok(self):
+        return self.code == 0 and not self.failures
+
+    def status_message(self):
+        """Short, human readable summary suitable for the unit status."""
+        if self.ok:
+            return ''
+
+        failures = self.failures
+        if not failures:
+            return 'review infinihost settings status (exit code {0})'.format(
+                self.code)
+
+        categories = sorted(set(c.category for c in failures))
+        return 'infinihost: {0} failed check(s) ({1})'.format(
+            len(failures), ', '.join(categories))
+
+    def to_dict(self):
+        return {
+            'code': self.code,
+            'verdict': self.verdict,
+            'checks': [c._asdict() for c in self.checks],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(code=d['code'], verdict=d.get('verdict'),
+                   checks=[CheckResult(**c) for c in d['checks']])
+
+
+class InfinihostOutputParser(object):
+    """Incremental parser of 'infinihost settings check' output.
+
+    Lines are fed one at a time as they are produced by the tool, so that
+    results of each check become available as soon as it completes.
+    The output consists of a list of check lines, followed by a detailed
+    section with the REASON and INFO for checks that failed or were skipped.
+    """
+
+    def __init__(self):
+        self.checks = []
+        self.verdict = None
+        self._index = {}
+        self._current = None
+        self._in_details = False
+
+    def feed(self, line):
+        """Process one line of output.
+
+        Returns the CheckResult if the line completed a check, None otherwise.
+        """
+        line = strip_ansi(line).rstrip('\r\n')
+        if not line.strip():
+            return None
+
+        if line.startswith('====='):
+            self._in_details = True
+            return None
+
+        if not self._in_details:
+            m = CHECK_LINE_RE.match(line)
+            if not m:
+                return None
+            fix = m.group('fix')
+            result = CheckResult(
+                category=m.group('category'),
+                check=m.group('check'),
+                status=m.group('status').lower(),
+                fix_applied=None if fix is None else fix.lower() == 'ok')
+            self._index[(result.category, result.check)] = len(self.checks)
+            self.checks.append(result)
+            return result
+
+        if line.startswith('-----'):
+            self._current = None
+        elif line.startswith(REASON_PREFIX):
+            self._update(reason=line[len(REASON_PREFIX):].strip())
+        elif line.startswith(INFO_PREFIX):
+            m = KB_LINK_RE.search(line)
+            if m:
+                self._update(kb_link=m.group(1))
+        elif SUMMARY_RE.match(line):
+            self._current = None
+        else:
+            m = DETAIL_HEADER_RE.match(line)
+            key = m and (m.group('category'), m.group('check'))
+            if key in self._index:
+                self._current = self._index[key]
+            else:
+                self._current = None
+                self.verdict = line.strip()
+        return None
+
+    def _update(self, **kwargs):
+        if self._current is None:
+            return
+        self.checks[self._current] = \
+            self.checks[self._current]._replace(**kwargs)
+
+    def report(self, code):
+        return InfinihostReport(code=code, checks=list(self.checks),
+                                verdict=self.verdict)
+
+
+def parse_output(data, code=None):
+    """Parse complete infinihost output."""
+    parser = InfinihostOutputParser()
+    for line in data.splitlines():
+        parser.feed(line)
+    return parser.report(code)
+
+
+def host_state_fingerprint(multipath_conf, package_version, sysfs='/sys'):
+    """Fingerprint of the host state the infinihost checks depend on.
+
+    It covers the multipath configuration, the set of block devices, the
+    WWPNs of FC HBAs and the version of infinihost itself, and is cheap
+    to compute compared to an actual infinihost run.
+    """
+    h = hashlib.sha256()
+    h.update('multipath.conf={0}\n'.format(
+        file_digest(multipath_conf)).encode())
+    h.update('version={0}\n'.format(package_version).encode())
+    try:
+        devices = sorted(os.listdir(os.path.join(sysfs, 'block')))
+    except OSError:
+        devices = []
+    h.update('block={0}\n'.format(','.join(devices)).encode())
+    for path in sorted(glob.glob(
+            os.path.join(sysfs, 'class', 'fc_host', '*', 'port_name'))):
+        try:
+            with open(path) as f:
+                wwpn = f.read().strip()
+        except OSError:
+            continue
+        h.update('wwpn={0}\n'.format(wwpn).encode())
+    return h.hexdigest()
+
+
+def infinihost_cmd(auto_fix):
+    cmd = ['infinihost', 'settings', 'check']
+    if auto_fix:
+        cmd.append('--auto-fix')
+    return cmd
+
+
+def infinihost_env():
+    # FIXME: Without this there is a dependency conflict:
+    # pkg_resources in charm's venv pythonpath takes precedence over
+    # the system-wide one, and because of the version difference,
+    # it breaks infinihost with "ImportError: cannot import name 'six'"
+    env = os.environ.copy()
+    if 'PYTHONPATH' in env:
+        env.pop('PYTHONPATH')
+    return env
+
+
+def _kill_group(p, grace=KILL_GRACE):
+    """Terminate the process group of p, which includes any rescan or
+    multipath command infinihost is waiting on."""
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        p.wait(grace)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def run_check(auto_fix=True, outfile=None, progress=None, timeout=None):
+    """Run infinihost and parse its output as it is produced.
+
+    Raw output is copied to outfile (if given) and progress (if given) is
+    called with each CheckResult as soon as the check completes.
+    infinihost runs in its own process group, which is killed if it does
+    not complete within timeout seconds, raising subprocess.TimeoutExpired.
+
+    Returns an InfinihostReport.
+    """
+    cmd = infinihost_cmd(auto_fix)
+    logger.debug("Executing: {0}".format(' '.join(cmd)))
+
+    p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE,
+                         env=infinihost_env(), start_new_session=True)
+
+    expired = threading.Event()
+    timer = None
+    if timeout:
+        def expire():
+            logger.error('infinihost did not complete in {0}s, '
+                         'killing it'.format(timeout))
+            expired.set()
+            _kill_group(p)
+
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+
+    parser = InfinihostOutputParser()
+    try:
+        for raw in iter(p.stdout.readline, b''):
+            if outfile is not None:
+                outfile.write(raw)
+                outfile.flush()
+            result = parser.feed(raw.decode('utf-8', errors='replace'))
+            if result is None:
+                continue
+            logger.debug("infinihost: {0} ... {1}".format(
+                result.name, result.status))
+            if progress is not None:
+                progress(result)
+        code = p.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+
+    return parser.report(code)
+
+
+def job_paths(job_dir, job_id):
+    """Output, pid and result files of a background job."""
+    base = os.path.join(job_dir, job_id)
+    return base + '.out', base + '.pid', base + '.json'
+
+
+def run_job(job_dir, job_id, auto_fix=False, timeout=None):
+    """Run infinihost as a background job, see start_job()."""
+    out, _, result_path = job_paths(job_dir, job_id)
+    result = {'auto-fix': auto_fix}
+    with open(out, 'wb') as f:
+        try:
+            result['report'] = run_check(auto_fix, f,
+                                         timeout=timeout).to_dict()
+        except subprocess.TimeoutExpired:
+            result['error'] = 'infinihost timed out after {0}s'.format(
+                timeout)
+        except OSError as e:
+            result['error'] = 'Failed to run infinihost: {0}'.format(e)
+    atomic_write(result_path, json.dumps(result), perms=0o644)
+
+
+def start_job(job_dir, job_id, auto_fix=False, timeout=None):
+    """Start run_job() in a process detached from the hook."""
+    os.makedirs(job_dir, exist_ok=True)
+    cmd = [sys.executable, os.path.abspath(__file__), job_dir, job_id,
+           '--timeout', str(timeout or 0)]
+    if auto_fix:
+        cmd.append('--auto-fix')
+    env = infinihost_env()
+    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True, close_fds=True, env=env)
+    _, pid_path, _ = job_paths(job_dir, job_id)
+    atomic_write(pid_path, str(p.pid), perms=0o644)
+    return p.pid
+
+
+def job_status(job_dir, job_id):
+    """Return (state, data) of a background job.
+
+    state is 'done' with the job result dict, 'running' with the
+    InfinihostReport of the checks completed so far, 'failed' if the job
+    died without a result, or 'unknown' if there is no such job.
+    """
+    out, pid_path, result_path = job_paths(job_dir, job_id)
+    try:
+        with open(result_path) as f:
+            return 'done', json.load(f)
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(pid_path) as f:
+            pid = int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return 'unknown', None
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return 'failed', None
+    except PermissionError:
+        pass
+
+    try:
+        with open(out, 'rb') as f:
+            partial = parse_output(f.read().decode('utf-8', errors='replace'))
+    except FileNotFoundError:
+        partial = InfinihostReport(None, [])
+    return 'running', partial
+
+
+def running_jobs(job_dir):
+    """ids of the background jobs that are still running."""
+    jobs = []
+    for pid_path in sorted(glob.glob(os.path.join(job_dir, '*.pid'))):
+        job_id = os.path.basename(pid_path)[:-len('.pid')]
+        if job_status(job_dir, job_id)[0] == 'running':
+            jobs.append(job_id)
+    return jobs
+
+
+def remove_job(job_dir, job_id):
+    for path in job_paths(job_dir, job_id):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run infinihost settings check as a background job')
+    parser.add_argument('job_dir')
+    parser.add_argument('job_id')
+    parser.add_argument('--auto-fix', action='store_true')
+    parser.add_argument('--timeout', type=int, default=0)
+    args = parser.parse_args(args)
+    run_job(args.job_dir, args.job_id, auto_fix=args.auto_fix,
+            timeout=args.timeout or None)
+
+
+if __name__ == '__main__':
+    main()
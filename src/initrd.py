@@ -0,0 +1,122 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers to decide when and for which kernels the initrd is rebuilt."""
+
+import glob
+import hashlib
+import logging
+import os
+
+from confutils import file_digest
+
+logger = logging.getLogger(__name__)
+
+# Configuration baked into the initrd by multipath-tools-boot,
+# udev and lvm2 initramfs hooks
+INITRD_INPUTS = (
+    '/etc/multipath.conf',
+    '/etc/multipath/wwids',
+    '/etc/multipath/bindings',
+    '/etc/lvm/lvm.conf',
+    '/etc/udev/rules.d/*.rules',
+    '/etc/modprobe.d/*.conf',
+)
+
+BOOT_MOUNTPOINTS = ('/', '/boot')
+
+
+def _devno(path):
+    st = os.stat(path)
+    return '{0}:{1}'.format(os.major(st.st_dev), os.minor(st.st_dev))
+
+
+def _is_multipath(devno, sysfs, seen):
+    if devno in seen:
+        return False
+    seen.add(devno)
+
+    dev = os.path.join(sysfs, 'dev', 'block', devno)
+    try:
+        with open(os.path.join(dev, 'dm', 'uuid')) as f:
+            uuid = f.read().strip()
+    except OSError:
+        uuid = ''
+
+    # kpartx partitions are named part<N>-mpath-<wwid>
+    if uuid.startswith('mpath-') or \
+            (uuid.startswith('part') and '-mpath-' in uuid):
+        return True
+
+    # a partition of a device: check the parent device
+    if os.path.exists(os.path.join(dev, 'partition')):
+        parent = os.path.dirname(os.path.realpath(dev))
+        try:
+            with open(os.path.join(parent, 'dev')) as f:
+                if _is_multipath(f.read().strip(), sysfs, seen):
+                    return True
+        except OSError:
+            pass
+
+    # stacked devices (LVM, dm-crypt, md) on top of multipath devices
+    for slave in glob.glob(os.path.join(dev, 'slaves', '*', 'dev')):
+        with open(slave) as f:
+            if _is_multipath(f.read().strip(), sysfs, seen):
+                return True
+
+    return False
+
+
+def boots_from_san(mountpoints=BOOT_MOUNTPOINTS, sysfs='/sys'):
+    """Whether any of the boot filesystems resides on a multipath device."""
+    for mountpoint in mountpoints:
+        try:
+            devno = _devno(mountpoint)
+        except OSError:
+            continue
+        if _is_multipath(devno, sysfs, set()):
+            logger.info('{0} ({1}) is on a multipath device'.format(
+                mountpoint, devno))
+            return True
+    return False
+
+
+def inputs_fingerprint(patterns=INITRD_INPUTS):
+    """Fingerprint of the configuration files that end up in the initrd."""
+    h = hashlib.sha256()
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            h.update('{0}={1}\n'.format(path, file_digest(path)).encode())
+    return h.hexdigest()
+
+
+def _kernel_version(vmlinuz):
+    target = os.path.basename(os.path.realpath(vmlinuz))
+    if target.startswith('vmlinuz-'):
+        return target[len('vmlinuz-'):]
+    return None
+
+
+def target_kernels(boot='/boot'):
+    """Kernels whose initrd needs to be regenerated.
+
+    The running kernel and the default one, which the host boots into next
+    and differs from the running kernel if a kernel upgrade is pending.
+    """
+    kernels = [os.uname().release]
+    default = _kernel_version(os.path.join(boot, 'vmlinuz'))
+    if default and default not in kernels:
+        kernels.append(default)
+    return [k for k in kernels
+            if os.path.exists(os.path.join(boot, 'vmlinuz-' + k))]
@@ -0,0 +1,211 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""iscsid.conf settings, and their state in the active iSCSI sessions."""
+
+import glob
+import os
+import re
+import subprocess
+from typing import NamedTuple
+
+from discovery import read_attr
+
+ISCSID_CONF = '/etc/iscsi/iscsid.conf'
+
+CMDS_MAX = 'node.session.cmds_max'
+QUEUE_DEPTH = 'node.session.queue_depth'
+NR_SESSIONS = 'node.session.nr_sessions'
+NOOP_OUT_INTERVAL = 'node.conn[0].timeo.noop_out_interval'
+REPLACEMENT_TIMEOUT = 'node.session.timeo.replacement_timeout'
+ISCSI_KEYS = (CMDS_MAX, QUEUE_DEPTH, NR_SESSIONS, NOOP_OUT_INTERVAL,
+              REPLACEMENT_TIMEOUT)
+
+# commands libiscsi reserves for task management out of cmds_max,
+# the SCSI host can queue the rest
+ISCSI_MGMT_CMDS_MAX = 15
+
+# iscsiadm exit code when there are no node records
+ISCSI_ERR_NO_OBJS_FOUND = 21
+
+
+def _line_re(key, commented=False):
+    return re.compile(r'^[ \t]*{0}{1}[ \t]*=[ \t]*(.*?)[ \t]*$'.format(
+        r'#[ \t]*' if commented else '', re.escape(key)), re.M)
+
+
+def get_options(text):
+    """{key: value} of the ISCSI_KEYS set in iscsid.conf."""
+    options = {}
+    for key in ISCSI_KEYS:
+        matches = _line_re(key).findall(text)
+        if matches:
+            options[key] = matches[-1]
+    return options
+
+
+def set_options(text, settings):
+    """Set the options with a value in iscsid.conf, in place.
+
+    An option is set on its existing line, or after its commented default,
+    or at the end of the file. Options without a value are left as is.
+    """
+    for key in ISCSI_KEYS:
+        value = settings.get(key)
+        if value in (None, ''):
+            continue
+        line = '{0} = {1}'.format(key, value)
+
+        matches = list(_line_re(key).finditer(text))
+        for m in reversed(matches[1:]):
+            text = text[:m.start()] + text[m.end() + 1:]
+        if matches:
+            m = matches[0]
+            text = text[:m.start()] + line + text[m.end():]
+            continue
+
+        m = _line_re(key, commented=True).search(text)
+        if m:
+            text = text[:m.end()] + '\n' + line + text[m.end():]
+        else:
+            if text and not text.endswith('\n'):
+                text += '\n'
+            text += line + '\n'
+    return text
+
+
+def validate_settings(settings):
+    """Return a list of problems with the iSCSI settings.
+
+    Settings are strings, empty ones are not managed.
+    """
+    errors = []
+    for key in ISCSI_KEYS:
+        value = str(settings.get(key) or '')
+        if value and not value.isdigit():
+            errors.append('{0} must be a number'.format(key))
+    cmds_max = str(settings.get(CMDS_MAX) or '')
+    if cmds_max.isdigit():
+        n = int(cmds_max)
+        if n < 2 or n > 2048 or n & (n - 1):
+            errors.append('{0} must be a power of 2 between 2 and '
+                          '2048'.format(CMDS_MAX))
+    queue_depth = str(settings.get(QUEUE_DEPTH) or '')
+    if queue_depth.isdigit() and not 1 <= int(queue_depth) <= 1024:
+        errors.append('{0} must be between 1 and 1024'.format(QUEUE_DEPTH))
+    nr_sessions = str(settings.get(NR_SESSIONS) or '')
+    if nr_sessions.isdigit() and int(nr_sessions) < 1:
+        errors.append('{0} must be at least 1'.format(NR_SESSIONS))
+    return errors
+
+
+def update_node_records(keys, settings):
+    """Apply settings to the existing node records, which iscsid.conf
+    changes do not affect. Returns False if there are no records."""
+    for key in keys:
+        p = subprocess.run(
+            ['iscsiadm', '-m', 'node', '-o', 'update', '-n', key,
+             '-v', str(settings[key])],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        if p.returncode == ISCSI_ERR_NO_OBJS_FOUND:
+            return False
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, p.args,
+                                                output=p.stdout)
+    return True
+
+
+class SessionMismatch(NamedTuple):
+    session: str
+    key: str
+    actual: str
+    expected: str
+    # sysfs attribute the value can be changed through without a re-login
+    live_path: str = None
+
+    def describe(self):
+        return '{0}: {1}={2} (expected {3})'.format(
+            self.session, self.key, self.actual, self.expected)
+
+
+def session_mismatches(settings, sysfs='/sys'):
+    """Settings the active iSCSI sessions do not use."""
+    mismatches = []
+    portals = {}
+    sessions = sorted(glob.glob(os.path.join(sysfs, 'class', 'iscsi_session',
+                                             'session*')))
+    for path in sessions:
+        session = os.path.basename(path)
+        conn = os.path.join(sysfs, 'class', 'iscsi_connection',
+                            'connection{0}:0'.format(session[7:]))
+        portal = (read_attr(os.path.join(path, 'targetname')),
+                  read_attr(os.path.join(conn, 'persistent_address')),
+                  read_attr(os.path.join(conn, 'persistent_port')))
+        portals[portal] = portals.get(portal, 0) + 1
+
+        def check(key, attr_path, expected, live=False, name=session):
+            if expected in (None, ''):
+                return
+            actual = read_attr(attr_path)
+            if actual and actual != str(expected):
+                mismatches.append(SessionMismatch(
+                    name, key, actual, str(expected),
+                    attr_path if live else None))
+
+        check(REPLACEMENT_TIMEOUT, os.path.join(path, 'recovery_tmo'),
+              settings.get(REPLACEMENT_TIMEOUT), live=True)
+        check(NOOP_OUT_INTERVAL, os.path.join(conn, 'recv_tmo'),
+              settings.get(NOOP_OUT_INTERVAL))
+
+        # the SCSI host of the session, e.g. .../host3/session1
+        host = os.path.basename(os.path.dirname(
+            os.path.realpath(os.path.join(path, 'device'))))
+        cmds_max = settings.get(CMDS_MAX)
+        if cmds_max not in (None, ''):
+            check(CMDS_MAX, os.path.join(sysfs, 'class', 'scsi_host', host,
+                                         'can_queue'),
+                  int(cmds_max) - ISCSI_MGMT_CMDS_MAX)
+        for depth in sorted(glob.glob(os.path.join(
+                path, 'device', 'target*', '*', 'queue_depth'))):
+            check(QUEUE_DEPTH, depth, settings.get(QUEUE_DEPTH), live=True,
+                  name='{0}/{1}'.format(session, os.path.basename(
+                      os.path.dirname(depth))))
+
+    nr_sessions = settings.get(NR_SESSIONS)
+    if nr_sessions not in (None, ''):
+        for (target, address, port), count in sorted(portals.items()):
+            if count != int(nr_sessions):
+                mismatches.append(SessionMismatch(
+                    '{0} {1}:{2}'.format(target, address, port),
+                    NR_SESSIONS, str(count), str(nr_sessions)))
+    return mismatches
+
+
+def apply_live(mismatches):
+    """Write the values that can be changed in active sessions to sysfs.
+
+    Returns the mismatches that require a re-login.
+    """
+    remaining = []
+    for m in mismatches:
+        if m.live_path is None:
+            remaining.append(m)
+            continue
+        try:
+            with open(m.live_path, 'w') as f:
+                f.write(m.expected)
+        except OSError:
+            remaining.append(m)
+    return remaining
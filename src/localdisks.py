@@ -0,0 +1,142 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Discovery of the local disks multipathd should leave alone.
+
+Local disks are the PCIe NVMe, virtio and non-SAN SCSI disks of the host.
+They are identified by the WWID multipath would give them, read from the
+udev database, so that they can be blacklisted by WWID.
+"""
+
+import os
+import re
+from typing import NamedTuple
+
+from discovery import INFINIBOX_VENDOR, multipath_wwid, read_attr
+
+UDEV_DB = '/run/udev/data'
+
+# SCSI hosts of these classes reach SAN storage
+SAN_HOST_CLASSES = ('fc_host', 'iscsi_host')
+# NVMe transports of local drives, NVMe over fabrics is SAN storage
+LOCAL_NVME_TRANSPORTS = ('pcie',)
+
+TRANSPORT_NVME = 'nvme'
+TRANSPORT_VIRTIO = 'virtio'
+TRANSPORT_SCSI = 'scsi'
+
+# udev properties multipath takes the WWID from, by transport
+UID_ATTRIBUTES = {
+    TRANSPORT_NVME: 'ID_WWN',
+    TRANSPORT_VIRTIO: 'ID_SERIAL',
+    TRANSPORT_SCSI: 'ID_SERIAL',
+}
+
+
+class LocalDisk(NamedTuple):
+    name: str
+    transport: str
+    wwid: str
+
+
+def udev_properties(name, sysfs='/sys', udev_db=UDEV_DB):
+    """{property: value} of a block device in the udev database."""
+    devno = read_attr(os.path.join(sysfs, 'block', name, 'dev'))
+    properties = {}
+    if not devno:
+        return properties
+    try:
+        with open(os.path.join(udev_db, 'b' + devno)) as f:
+            for line in f:
+                if line.startswith('E:'):
+                    key, _, value = line[2:].rstrip('\n').partition('=')
+                    properties[key] = value
+    except OSError:
+        pass
+    return properties
+
+
+def transport(name, sysfs='/sys'):
+    """Transport of a local disk, None for SAN and unknown devices."""
+    device = os.path.join(sysfs, 'block', name, 'device')
+    if name.startswith('vd'):
+        return TRANSPORT_VIRTIO
+    if name.startswith('nvme'):
+        # namespaces of native NVMe multipath devices have no transport
+        if read_attr(os.path.join(device, 'transport')) in \
+                LOCAL_NVME_TRANSPORTS:
+            return TRANSPORT_NVME
+        return None
+    if name.startswith('sd'):
+        host = os.path.basename(os.path.realpath(device)).split(':')[0]
+        if not host.isdigit():
+            return None
+        for cls in SAN_HOST_CLASSES:
+            if os.path.exists(os.path.join(sysfs, 'class', cls,
+                                           'host' + host)):
+                return None
+        return TRANSPORT_SCSI
+    return None
+
+
+def disk_wwid(name, disk_transport, properties, sysfs='/sys'):
+    """WWID multipath gives a disk, from its udev properties, falling back
+    to the identifiers in sysfs as multipath does."""
+    wwid = properties.get(UID_ATTRIBUTES[disk_transport])
+    if wwid:
+        return wwid
+    if disk_transport == TRANSPORT_NVME:
+        return read_attr(os.path.join(sysfs, 'block', name, 'wwid'))
+    if disk_transport == TRANSPORT_SCSI:
+        return multipath_wwid(read_attr(os.path.join(
+            sysfs, 'block', name, 'device', 'wwid')))
+    return ''
+
+
+def local_disks(topology, sysfs='/sys', udev_db=UDEV_DB):
+    """Local disks with a WWID, sorted by name.
+
+    Disks that already are paths of a multipath device are left out,
+    somebody wants them multipathed.
+    """
+    disks = []
+    try:
+        names = sorted(os.listdir(os.path.join(sysfs, 'block')))
+    except OSError:
+        return disks
+    for name in names:
+        disk_transport = transport(name, sysfs)
+        if disk_transport is None:
+            continue
+        holder = topology.holders.get(name)
+        if holder is not None and holder.multipath:
+            continue
+        if read_attr(os.path.join(sysfs, 'block', name, 'device',
+                                  'vendor')) == INFINIBOX_VENDOR:
+            continue
+        wwid = disk_wwid(name, disk_transport,
+                         udev_properties(name, sysfs, udev_db), sysfs)
+        # multipath.conf strings cannot hold double quotes
+        if wwid and '"' not in wwid:
+            disks.append(LocalDisk(name, disk_transport, wwid))
+    return disks
+
+
+def wwid_pattern(wwid):
+    """Blacklist regular expression matching exactly wwid."""
+    return '^{0}$'.format(re.sub(r'([\\.^$*+?()\[\]{}|])', r'\\\1', wwid))
+
+
+def blacklist_patterns(disks):
+    return sorted({wwid_pattern(d.wwid) for d in disks})
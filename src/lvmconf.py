@@ -0,0 +1,359 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In place editing of lvm.conf, and generation of device filters."""
+
+import os
+import re
+import subprocess
+from typing import NamedTuple, Tuple
+
+from discovery import StorageTopology
+
+MARKER = '__infinidat_tools__'
+
+IDENT_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+# '# global_filter = ...' in the stock lvm.conf, new settings go after it
+COMMENTED_RE = r'^[ \t]*#[ \t]*{0}[ \t]*=.*\n'
+
+# block devices that are never local PVs
+IGNORED_DEVICES_RE = re.compile(r'^(loop|ram|zram|sr|fd|nbd)[0-9]')
+# dm devices managed by multipath and LVM itself
+IGNORED_DM_UUID_RE = re.compile(r'^(mpath-|part[0-9]+-mpath-|LVM-)')
+
+
+class LvmConfSyntaxError(ValueError):
+    """lvm.conf could not be parsed."""
+
+
+class Section(NamedTuple):
+    path: Tuple[str, ...]
+    start: int
+    # offsets of the first character after '{' and of the closing '}'
+    body: int
+    close: int
+
+
+class Assignment(NamedTuple):
+    section: Tuple[str, ...]
+    key: str
+    value: str
+    # span of the whole line(s), including any trailing comment
+    start: int
+    end: int
+    comment: str
+
+
+def _line_number(text, pos):
+    return text.count('\n', 0, pos) + 1
+
+
+def _skip_blank(text, i):
+    while i < len(text) and text[i] in ' \t':
+        i += 1
+    return i
+
+
+def _string_end(text, i):
+    """Offset after the string starting at text[i]."""
+    i += 1
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] == '"':
+            return i + 1
+        if text[i] == '\n':
+            break
+        i += 1
+    raise LvmConfSyntaxError('unterminated string at line {0}'.format(
+        _line_number(text, i)))
+
+
+def _value_end(text, i):
+    """Offset after the value starting at text[i]."""
+    if i >= len(text):
+        raise LvmConfSyntaxError('missing value at end of file')
+    if text[i] == '"':
+        return _string_end(text, i)
+    if text[i] != '[':
+        m = re.compile(r'[^\s#}]+').match(text, i)
+        if not m:
+            raise LvmConfSyntaxError('missing value at line {0}'.format(
+                _line_number(text, i)))
+        return m.end()
+
+    start = i
+    i += 1
+    while i < len(text):
+        c = text[i]
+        if c == '"':
+            i = _string_end(text, i)
+        elif c == '#':
+            i = text.find('\n', i)
+            if i < 0:
+                break
+        elif c == ']':
+            return i + 1
+        else:
+            i += 1
+    raise LvmConfSyntaxError('unterminated array at line {0}'.format(
+        _line_number(text, start)))
+
+
+def parse(text):
+    """Return the Sections and Assignments of an lvm.conf file.
+
+    Raises LvmConfSyntaxError if the file can not be parsed.
+    """
+    sections = []
+    assignments = []
+    stack = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in ' \t\r\n':
+            i += 1
+        elif c == '#':
+            i = text.find('\n', i)
+            if i < 0:
+                break
+        elif c == '}':
+            if not stack:
+                raise LvmConfSyntaxError('unexpected "}}" at line {0}'.format(
+                    _line_number(text, i)))
+            path, start, body = stack.pop()
+            sections.append(Section(path, start, body, i))
+            i += 1
+        else:
+            m = IDENT_RE.match(text, i)
+            if not m:
+                raise LvmConfSyntaxError('unexpected "{0}" at line {1}'.format(
+                    c, _line_number(text, i)))
+            path = stack[-1][0] if stack else ()
+            j = _skip_blank(text, m.end())
+            if text.startswith('{', j):
+                stack.append((path + (m.group(),), i, j + 1))
+                i = j + 1
+            elif text.startswith('=', j):
+                vstart = _skip_blank(text, j + 1)
+                vend = _value_end(text, vstart)
+                assignments.append(_assignment(text, path, m.group(), i,
+                                               vstart, vend))
+                i = vend
+            else:
+                raise LvmConfSyntaxError('expected "=" or "{{" after "{0}" '
+                                         'at line {1}'.format(
+                                             m.group(),
+                                             _line_number(text, i)))
+    if stack:
+        raise LvmConfSyntaxError('section "{0}" is not closed'.format(
+            stack[-1][0][-1]))
+    return sections, assignments
+
+
+def _assignment(text, path, key, kstart, vstart, vend):
+    line_start = text.rfind('\n', 0, kstart) + 1
+    start = line_start if not text[line_start:kstart].strip() else kstart
+    eol = text.find('\n', vend)
+    eol = len(text) if eol < 0 else eol
+    rest = text[vend:eol].strip()
+    if not rest or rest.startswith('#'):
+        end = min(eol + 1, len(text))
+        comment = rest
+    else:
+        end = vend
+        comment = ''
+    return Assignment(path, key, text[vstart:vend], start, end, comment)
+
+
+def get_option(text, section, key):
+    """Value of the last assignment of section/key, None if not set."""
+    values = [a.value for a in parse(text)[1]
+              if a.section == (section,) and a.key == key]
+    return values[-1] if values else None
+
+
+def set_option(text, section, key, value):
+    """Set, or unset if value is None, an option of a top level section.
+
+    The option is marked as managed by the charm. Unsetting it only
+    removes a managed assignment. Other assignments of the option in the
+    section are replaced, the rest of the file is left untouched.
+    """
+    sections, assignments = parse(text)
+    existing = [a for a in assignments
+                if a.section == (section,) and a.key == key]
+
+    if value is None:
+        for a in reversed(existing):
+            if MARKER in a.comment:
+                text = text[:a.start] + text[a.end:]
+        return text
+
+    for a in reversed(existing[1:]):
+        text = text[:a.start] + text[a.end:]
+    if existing:
+        a = existing[0]
+        indent = re.match(r'[ \t]*', text[a.start:]).group()
+        return text[:a.start] + _line(indent, key, value) + text[a.end:]
+
+    sect = [s for s in sections if s.path == (section,)]
+    if not sect:
+        if text and not text.endswith('\n'):
+            text += '\n'
+        return text + '{0} {{\n{1}}}\n'.format(
+            section, _line('\t', key, value))
+
+    s = sect[0]
+    # right after the commented default in the stock lvm.conf if any
+    m = re.compile(COMMENTED_RE.format(re.escape(key)), re.M).search(
+        text, s.body, s.close)
+    if m:
+        indent = re.match(r'[ \t]*', m.group()).group()
+        return text[:m.end()] + _line(indent, key, value) + text[m.end():]
+
+    nl = text.rfind('\n', s.body, s.close)
+    if nl < 0:
+        # '{' and '}' on the same line
+        return text[:s.close] + '\n' + _line('\t', key, value) + \
+            text[s.close:]
+    return text[:nl + 1] + _line('\t', key, value) + text[nl + 1:]
+
+
+def _line(indent, key, value):
+    return '{0}{1} = {2} # {3}\n'.format(indent, key, value, MARKER)
+
+
+def format_filter(patterns):
+    """lvm.conf array of filter patterns, e.g. '[ "a|^/dev/sd.*|" ]'."""
+    return '[ {0} ]'.format(', '.join('"{0}"'.format(p) for p in patterns))
+
+
+def _by_id_links(by_id_dir):
+    """{device name: sorted /dev/disk/by-id names pointing to it}"""
+    links = {}
+    try:
+        names = os.listdir(by_id_dir)
+    except OSError:
+        return links
+    for name in sorted(names):
+        try:
+            target = os.path.basename(os.readlink(
+                os.path.join(by_id_dir, name)))
+        except OSError:
+            continue
+        links.setdefault(target, []).append(name)
+    return links
+
+
+def _regex_literal(name):
+    # character classes rather than backslashes, which lvm.conf strings
+    # would need escaped again
+    return re.sub(r'([.+*?()^$])', r'[\1]', name)
+
+
+def _preferred_id(names):
+    # names derived from the device name rather than its identity
+    # change along with it
+    names = [n for n in names if not set(n) & set('|"\\[]')]
+    stable = [n for n in names if not n.startswith(('dm-name-', 'md-name-'))]
+    return (stable or names or [None])[0]
+
+
+def local_devices(sysfs='/sys', topology=None):
+    """Whole block devices that may hold local PVs: all devices but
+    InfiniBox disks, multipath maps and their partitions, LVM volumes and
+    loop, ram or optical devices."""
+    if topology is None:
+        topology = StorageTopology.discover(sysfs)
+    try:
+        names = sorted(os.listdir(os.path.join(sysfs, 'block')))
+    except OSError:
+        return []
+
+    devices = []
+    for name in names:
+        if IGNORED_DEVICES_RE.match(name):
+            continue
+        scsi = topology.by_block.get(name)
+        if scsi is not None and scsi.infinibox:
+            continue
+        dm = topology.dm.get(name)
+        if dm is not None and IGNORED_DM_UUID_RE.match(dm.uuid):
+            continue
+        devices.append(name)
+    return devices
+
+
+def active_pv_devices(topology):
+    """Devices holding the active LVs of the host."""
+    lvs = {d.device: d for d in topology.dm.values()
+           if d.uuid.startswith('LVM-')}
+    return sorted({slave for lv in lvs.values() for slave in lv.slaves
+                   if slave not in lvs})
+
+
+def pv_devices():
+    """Devices listed by pvs.
+
+    Raises OSError or subprocess.CalledProcessError if pvs failed.
+    """
+    out = subprocess.check_output(['pvs', '--noheadings', '-o', 'pv_name'],
+                                  universal_newlines=True)
+    # '[unknown]' for missing PVs
+    return sorted({os.path.basename(os.path.realpath(path))
+                   for path in out.split() if path.startswith('/dev/')})
+
+
+def _whole_device(sysfs, name):
+    part = os.path.join(sysfs, 'class', 'block', name)
+    if os.path.exists(os.path.join(part, 'partition')):
+        return os.path.basename(os.path.dirname(os.path.realpath(part)))
+    return name
+
+
+def generated_filter(sysfs='/sys', by_id_dir='/dev/disk/by-id',
+                     topology=None, pvs=()):
+    """global_filter accepting the local devices, and their partitions,
+    through their /dev/disk/by-id links, and rejecting everything else.
+
+    Devices without a by-id link are accepted by their kernel name. The
+    pvs devices are accepted too, even if they are InfiniBox disks or
+    multipath maps, so that the VGs already in use stay visible.
+    """
+    if topology is None:
+        topology = StorageTopology.discover(sysfs)
+    links = _by_id_links(by_id_dir)
+    patterns = []
+    local = local_devices(sysfs, topology)
+    for name in local:
+        by_id = _preferred_id(links.get(name, []))
+        if by_id:
+            patterns.append('a|^/dev/disk/by-id/{0}(-part[0-9]+)?$|'.format(
+                _regex_literal(by_id)))
+        else:
+            patterns.append('a|^/dev/{0}p?[0-9]*$|'.format(
+                _regex_literal(name)))
+    for name in sorted(set(pvs)):
+        if _whole_device(sysfs, name) in local:
+            continue
+        by_id = _preferred_id(links.get(name, []))
+        if by_id:
+            patterns.append('a|^/dev/disk/by-id/{0}$|'.format(
+                _regex_literal(by_id)))
+        else:
+            patterns.append('a|^/dev/{0}$|'.format(_regex_literal(name)))
+    patterns.append('r|.*|')
+    return format_filter(patterns)
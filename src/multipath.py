@@ -0,0 +1,229 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""multipath.conf rendering, parsing and reconfiguration planning."""
+
+import re
+import shlex
+from typing import NamedTuple, Tuple
+
+MULTIPATH_CONF_TEMPLATE = 'multipath.conf.j2'
+
+PATH_SELECTORS = ('round-robin 0', 'service-time 0', 'queue-length 0')
+# 'strict' only claims the devices listed in the wwids file
+FIND_MULTIPATHS = ('yes', 'strict')
+
+# Sections of multipath.conf maintained by the operator (or by
+# 'infinihost settings check --auto-fix'), which are kept when the
+# file is rendered
+LOCAL_SECTIONS = ('blacklist', 'blacklist_exceptions')
+# on the first line of the blacklist sections the charm generates, which
+# are rendered again rather than kept
+GENERATED_MARKER = 'generated by the infinidat-tools charm'
+
+SECTION_START_RE = re.compile(r'^\s*(?P<name>\w+)\s*\{')
+
+ACTION_NONE = 'none'
+ACTION_RECONFIGURE = 'reconfigure'
+ACTION_RESTART = 'restart'
+
+# Settings that multipathd only reads at startup: changing them
+# requires a restart, everything else is applied by 'multipathd reconfigure'
+RESTART_KEYS = frozenset([
+    ('defaults', 'max_fds'),
+    ('defaults', 'uxsock_timeout'),
+    ('defaults', 'bindings_file'),
+    ('defaults', 'wwids_file'),
+    ('defaults', 'prkeys_file'),
+    ('defaults', 'config_dir'),
+    ('defaults', 'enable_foreign'),
+])
+
+# Keys identifying repeated subsections, e.g. each 'device' in 'devices'
+SECTION_IDENT_KEYS = {
+    'device': ('vendor', 'product'),
+    'multipath': ('wwid',),
+    'protocol': ('type',),
+}
+
+
+def _section_label(name, items):
+    idents = SECTION_IDENT_KEYS.get(name)
+    if not idents:
+        return name
+    values = dict((key, value) for path, key, value in items if not path)
+    return '{0}[{1}]'.format(
+        name, '/'.join(values.get(k, '') for k in idents))
+
+
+def parse_config(data):
+    """Flatten multipath.conf content.
+
+    Returns a dict mapping (section path, key) to a tuple of values, e.g.
+    (('devices', 'device[NFINIDAT/InfiniBox.*]'), 'no_path_retry') ->
+    ('queue',). Keys that are repeated within a section, such as devnode
+    entries of a blacklist, keep all their values.
+    """
+    # each frame is (section name, [(relative path, key, value), ...])
+    stack = [(None, [])]
+    for line in data.splitlines():
+        lex = shlex.shlex(line, posix=True)
+        lex.whitespace_split = True
+        lex.commenters = '#!'
+        try:
+            tokens = list(lex)
+        except ValueError:
+            # unbalanced quotes, let multipathd complain about it
+            tokens = line.split()
+        while tokens:
+            if tokens[0] == '}':
+                tokens.pop(0)
+                if len(stack) == 1:
+                    continue
+                name, items = stack.pop()
+                label = _section_label(name, items)
+                stack[-1][1].extend(
+                    ((label,) + path, key, value)
+                    for path, key, value in items)
+            elif len(tokens) > 1 and tokens[1] == '{':
+                stack.append((tokens.pop(0), []))
+                tokens.pop(0)
+            else:
+                key = tokens.pop(0)
+                value = []
+                while tokens and tokens[0] != '}':
+                    value.append(tokens.pop(0))
+                stack[-1][1].append(((), key, ' '.join(value)))
+
+    # unterminated sections are treated as closed at the end of the file
+    while len(stack) > 1:
+        name, items = stack.pop()
+        label = _section_label(name, items)
+        stack[-1][1].extend(((label,) + path, key, value)
+                            for path, key, value in items)
+
+    settings = {}
+    for path, key, value in stack[0][1]:
+        settings[(path, key)] = settings.get((path, key), ()) + (value,)
+    return settings
+
+
+def _setting_name(path, key):
+    return '/'.join(path + (key,))
+
+
+class ReconfigurePlan(NamedTuple):
+    """How to apply a multipath.conf change to a running multipathd."""
+
+    action: str
+    changed: Tuple[str, ...] = ()
+    restart_keys: Tuple[str, ...] = ()
+
+    def describe(self):
+        if self.action == ACTION_NONE:
+            return 'no multipath settings changed'
+        if self.action == ACTION_RESTART and not self.changed:
+            return 'previous multipath configuration is unknown'
+        msg = 'changed multipath settings: {0}'.format(
+            ', '.join(self.changed))
+        if self.restart_keys:
+            msg += '; restart required by: {0}'.format(
+                ', '.join(self.restart_keys))
+        return msg
+
+
+def plan_reconfiguration(old_data, new_data):
+    """Decide how multipathd should pick up new_data.
+
+    old_data is the configuration multipathd is currently running with, or
+    None if it is unknown, in which case a restart is the only safe option.
+    """
+    if old_data is None:
+        return ReconfigurePlan(ACTION_RESTART)
+
+    old = parse_config(old_data)
+    new = parse_config(new_data)
+    changed = sorted(k for k in set(old) | set(new)
+                     if old.get(k) != new.get(k))
+    if not changed:
+        return ReconfigurePlan(ACTION_NONE)
+
+    restart_keys = [(path, key) for path, key in changed
+                    if len(path) == 1 and (path[0], key) in RESTART_KEYS]
+    return ReconfigurePlan(
+        ACTION_RESTART if restart_keys else ACTION_RECONFIGURE,
+        changed=tuple(_setting_name(*k) for k in changed),
+        restart_keys=tuple(_setting_name(*k) for k in restart_keys))
+
+
+def extract_sections(data, names=LOCAL_SECTIONS):
+    """Return the raw text of top-level sections with the given names."""
+    sections = []
+    current = None
+    depth = 0
+    for line in data.splitlines(keepends=True):
+        code = re.sub(r'[#!].*', '', line)
+        if depth == 0:
+            m = SECTION_START_RE.match(code)
+            if m and m.group('name') in names:
+                current = []
+        if current is not None:
+            current.append(line)
+        depth = max(depth + code.count('{') - code.count('}'), 0)
+        if depth == 0 and current is not None:
+            text = ''.join(current)
+            if not text.endswith('\n'):
+                text += '\n'
+            sections.append(text)
+            current = None
+    return sections
+
+
+def validate_settings(settings):
+    """Return a list of problems with the device settings."""
+    errors = []
+    if settings['path_selector'] not in PATH_SELECTORS:
+        errors.append('path_selector must be one of: {0}'.format(
+            ', '.join(PATH_SELECTORS)))
+    if settings['find_multipaths'] not in FIND_MULTIPATHS:
+        errors.append('find_multipaths must be one of: {0}'.format(
+            ', '.join(FIND_MULTIPATHS)))
+    no_path_retry = str(settings['no_path_retry'])
+    if no_path_retry not in ('queue', 'fail') and \
+            not no_path_retry.isdigit():
+        errors.append('no_path_retry must be "queue", "fail" or a number')
+    for key in ('rr_min_io_rq', 'max_fds', 'fast_io_fail_tmo'):
+        if int(settings[key]) < 0:
+            errors.append('{0} must not be negative'.format(key))
+    return errors
+
+
+def render_config(template_dir, settings, existing=None):
+    """Render multipath.conf from the charm template.
+
+    Local sections (blacklists) of the existing configuration are appended
+    to the rendered template, except the ones generated by the charm.
+    """
+    # imported here as most hooks do not render the configuration
+    import jinja2
+
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                             keep_trailing_newline=True, trim_blocks=True,
+                             lstrip_blocks=True)
+    data = env.get_template(MULTIPATH_CONF_TEMPLATE).render(
+        settings, generated_marker=GENERATED_MARKER)
+    if existing:
+        data += ''.join(s for s in extract_sections(existing)
+                        if GENERATED_MARKER not in s.splitlines()[0])
+    return data
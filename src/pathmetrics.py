@@ -0,0 +1,189 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Multipath path health metrics in the node-exporter textfile format.
+
+Run periodically from cron, the state of all maps and paths is read with
+two multipathd calls, regardless of the number of devices.
+"""
+
+import argparse
+import logging
+import subprocess
+import time
+from typing import List, NamedTuple
+
+from confutils import atomic_write
+from discovery import read_scheduler
+
+logger = logging.getLogger(__name__)
+
+METRICS_FILE = 'infinidat_multipath.prom'
+MULTIPATHD_TIMEOUT = 30
+# minutes, the interval is a step of the cron minute field
+MAX_INTERVAL = 59
+
+FIELD_SEP = '|'
+# map: wwid, alias, dm device, queueing state, vendor,product,revision
+MAPS_FORMAT = FIELD_SEP.join(('%w', '%n', '%d', '%Q', '%s'))
+# path: map wwid, device, dm state, device state, checker state, H:C:T:L
+PATHS_FORMAT = FIELD_SEP.join(('%w', '%d', '%t', '%o', '%T', '%i'))
+
+
+class MultipathPath(NamedTuple):
+    wwid: str
+    device: str
+    dm_state: str
+    device_state: str
+    checker_state: str
+    hcil: str
+
+    @property
+    def active(self):
+        return self.dm_state == 'active'
+
+    @property
+    def failed(self):
+        return self.dm_state == 'failed' or self.checker_state == 'faulty'
+
+
+class MultipathMap(NamedTuple):
+    wwid: str
+    name: str
+    device: str
+    queueing: str
+    product: str
+    scheduler: str
+    paths: List[MultipathPath]
+
+    @property
+    def queue_if_no_path(self):
+        # 'on', or 'N chk' while retrying before failing I/O
+        return self.queueing == 'on' or self.queueing.endswith('chk')
+
+
+def validate_interval(interval):
+    """Return a list of problems with the collection interval."""
+    if not isinstance(interval, int) or not 1 <= interval <= MAX_INTERVAL:
+        return ['interval must be between 1 and {0} minutes'.format(
+            MAX_INTERVAL)]
+    return []
+
+
+def _multipathd_show(what, fmt):
+    out = subprocess.check_output(
+        ['multipathd', 'show', what, 'raw', 'format', fmt],
+        universal_newlines=True, timeout=MULTIPATHD_TIMEOUT)
+    rows = []
+    for line in out.splitlines():
+        fields = [f.strip() for f in line.split(FIELD_SEP)]
+        if len(fields) == fmt.count(FIELD_SEP) + 1:
+            rows.append(fields)
+    return rows
+
+
+def collect(sysfs='/sys'):
+    """Return the MultipathMaps with their paths."""
+    paths = {}
+    for fields in _multipathd_show('paths', PATHS_FORMAT):
+        path = MultipathPath(*fields)
+        paths.setdefault(path.wwid, []).append(path)
+
+    maps = []
+    for wwid, name, device, queueing, product in \
+            _multipathd_show('maps', MAPS_FORMAT):
+        maps.append(MultipathMap(
+            wwid, name, device, queueing, product.replace(',', ' '),
+            read_scheduler(device, sysfs), paths.get(wwid, [])))
+    return maps
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+    return '{' + ','.join('{0}="{1}"'.format(k, escape(v))
+                          for k, v in labels.items()) + '}'
+
+
+def _metric(lines, name, help, samples):
+    lines.append('# HELP {0} {1}'.format(name, help))
+    lines.append('# TYPE {0} gauge'.format(name))
+    for labels, value in samples:
+        lines.append('{0}{1} {2}'.format(name, labels, value))
+
+
+def render(maps, success=True, timestamp=None):
+    """Metrics in the Prometheus text exposition format."""
+    lines = []
+    prefix = 'infinidat_multipath_'
+    ids = [(m, _labels(wwid=m.wwid, name=m.name)) for m in maps]
+
+    _metric(lines, prefix + 'paths',
+            'Number of paths of the multipath device.',
+            [(labels, len(m.paths)) for m, labels in ids])
+    _metric(lines, prefix + 'active_paths',
+            'Number of paths in the active state in device-mapper.',
+            [(labels, sum(p.active for p in m.paths)) for m, labels in ids])
+    _metric(lines, prefix + 'failed_paths',
+            'Number of failed or faulty paths.',
+            [(labels, sum(p.failed for p in m.paths)) for m, labels in ids])
+    _metric(lines, prefix + 'queue_if_no_path',
+            'Whether I/O is queued when no path is available.',
+            [(labels, int(m.queue_if_no_path)) for m, labels in ids])
+    _metric(lines, prefix + 'device_info',
+            'Multipath device properties, the value is always 1.',
+            [(_labels(wwid=m.wwid, name=m.name, device=m.device,
+                      product=m.product, scheduler=m.scheduler), 1)
+             for m in maps])
+    _metric(lines, prefix + 'path_up',
+            'Whether the path is active and its checker reports it usable.',
+            [(_labels(wwid=p.wwid, device=p.device, hcil=p.hcil,
+                      dm_state=p.dm_state, device_state=p.device_state,
+                      checker_state=p.checker_state),
+              int(p.active and not p.failed))
+             for m in maps for p in m.paths])
+    _metric(lines, prefix + 'collector_success',
+            'Whether the multipath state could be read.',
+            [('', int(success))])
+    _metric(lines, prefix + 'collector_timestamp_seconds',
+            'Time the metrics were collected at.',
+            [('', int(time.time() if timestamp is None else timestamp))])
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(output, sysfs='/sys'):
+    """Collect the metrics and atomically replace the output file."""
+    try:
+        maps = collect(sysfs)
+        success = True
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.error('Failed to read multipath state: {0}'.format(e))
+        maps = []
+        success = False
+    atomic_write(output, render(maps, success), perms=0o644)
+    return success
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Write multipath path metrics for node-exporter')
+    parser.add_argument('output', help='textfile to write the metrics to')
+    args = parser.parse_args(args)
+    if not write_metrics(args.output):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
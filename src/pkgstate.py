@@ -0,0 +1,69 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Installed package state, used to skip apt work that is not needed."""
+
+import subprocess
+
+from confutils import content_digest
+from repokeys import openpgp_fingerprint
+
+
+def installed_versions(packages):
+    """Return {package: version} for the installed packages.
+
+    All packages are queried with a single dpkg-query call. Packages that
+    are unknown, removed or only partially installed are not returned.
+    """
+    if not packages:
+        return {}
+    cmd = ['dpkg-query', '-W',
+           '-f=${Package}\t${Version}\t${db:Status-Abbrev}\n']
+    cmd.extend(packages)
+    # dpkg-query exits with 1 if any of the packages is unknown,
+    # the output still lists the known ones
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    versions = {}
+    for line in p.stdout.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 3 or not fields[2].startswith('ii'):
+            continue
+        versions[fields[0].split(':')[0]] = fields[1]
+    return versions
+
+
+def missing_packages(packages, pins, installed):
+    """Packages that are not installed, or not at their pinned version."""
+    missing = []
+    for pkg in packages:
+        if pkg not in installed:
+            missing.append(pkg)
+        elif pins.get(pkg) and installed[pkg] != pins[pkg]:
+            missing.append(pkg)
+    return missing
+
+
+def package_spec(pkg, version=None):
+    """apt-get install argument for a package and an optional version."""
+    if version:
+        return '{0}={1}'.format(pkg, version)
+    return pkg
+
+
+def source_fingerprint(source, key):
+    """Identify an apt source along with the key it was added with."""
+    if key:
+        key = openpgp_fingerprint(key) or key.strip()
+    return content_digest('{0}\n{1}'.format(source or '', key or ''))
@@ -0,0 +1,189 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resolution of the apt repository signing key."""
+
+import base64
+import binascii
+import hashlib
+import logging
+import os
+
+from confutils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPO_KEY_URL = 'https://repo.infinidat.com/packages/gpg.key'
+KEY_CACHE_DIR = '/var/cache/infinidat-tools'
+KEY_FETCH_TIMEOUT = 30
+
+# add_source() source types that are signed by a key given along with them
+KEYED_SOURCE_PREFIXES = ('deb ', 'http://', 'https://')
+
+
+class RepoKeyNotFound(Exception):
+    """No valid repository key could be found."""
+
+
+def source_needs_key(source):
+    """Whether add_source() needs a key for the source.
+
+    PPAs and cloud archives come with their own keys.
+    """
+    return bool(source) and source.strip().startswith(KEYED_SOURCE_PREFIXES)
+
+
+def normalize_fingerprint(fingerprint):
+    """Fingerprint in the form openpgp_fingerprint() returns, None if it
+    is empty."""
+    return ''.join((fingerprint or '').split()).upper() or None
+
+
+def openpgp_fingerprint(armored):
+    """Return the v4 fingerprint of the primary key of an armored key block.
+
+    Returns None if the data is not an ASCII armored OpenPGP public key.
+    """
+    lines = armored.strip().splitlines()
+    try:
+        start = lines.index('-----BEGIN PGP PUBLIC KEY BLOCK-----')
+        end = lines.index('-----END PGP PUBLIC KEY BLOCK-----')
+    except ValueError:
+        return None
+
+    # armor headers are separated from the data by an empty line,
+    # the line starting with '=' is the checksum
+    body = lines[start + 1:end]
+    if '' in body:
+        body = body[body.index('') + 1:]
+    try:
+        data = base64.b64decode(
+            ''.join(line.strip() for line in body if not line.startswith('=')))
+    except (binascii.Error, ValueError):
+        return None
+
+    if len(data) < 3 or not data[0] & 0x80:
+        return None
+    if data[0] & 0x40:
+        # new format packet
+        tag = data[0] & 0x3f
+        if data[1] < 192:
+            length, offset = data[1], 2
+        elif data[1] < 224:
+            length, offset = ((data[1] - 192) << 8) + data[2] + 192, 3
+        else:
+            length, offset = int.from_bytes(data[2:6], 'big'), 6
+    else:
+        tag = (data[0] >> 2) & 0x0f
+        length_bytes = (1, 2, 4)[data[0] & 0x03] \
+            if data[0] & 0x03 != 3 else None
+        if length_bytes is None:
+            return None
+        offset = 1 + length_bytes
+        length = int.from_bytes(data[1:offset], 'big')
+
+    # public key packet, version 4
+    packet = data[offset:offset + length]
+    if tag != 6 or not packet or packet[0] != 4:
+        return None
+    return hashlib.sha1(
+        b'\x99' + len(packet).to_bytes(2, 'big') + packet).hexdigest().upper()
+
+
+class KeyProvider(object):
+    """Resolves the default repository key from the cheapest source.
+
+    Sources are tried in order: the on-disk cache, a local mirror and
+    finally the vendor URL. If a fingerprint is given, every
+    candidate key must have it, otherwise any valid key is used. A
+    downloaded key is cached for subsequent hooks.
+    """
+
+    def __init__(self, mirror_url=None, url=DEFAULT_REPO_KEY_URL,
+                 fingerprint=None, cache_dir=KEY_CACHE_DIR,
+                 timeout=KEY_FETCH_TIMEOUT):
+        self.mirror_url = mirror_url
+        self.url = url
+        self.fingerprint = normalize_fingerprint(fingerprint)
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+
+    @property
+    def cache_path(self):
+        # unpinned keys are cached apart from the pinned ones
+        return os.path.join(self.cache_dir, '{0}.asc'.format(
+            self.fingerprint or 'unpinned'))
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _fetch(self, url):
+        # urllib.request pulls in http and email, only load them when used
+        import urllib.request
+
+        logger.info('Downloading repository key from {0}'.format(url))
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as r:
+                return r.read().decode('utf-8', errors='replace')
+        except (OSError, ValueError) as e:
+            logger.warning('Failed to download {0}: {1}'.format(url, e))
+            return None
+
+    def candidates(self):
+        yield 'cache', lambda: self._read(self.cache_path)
+        if self.mirror_url:
+            yield 'mirror', lambda: self._fetch(self.mirror_url)
+        if self.url:
+            yield 'url', lambda: self._fetch(self.url)
+
+    def get(self):
+        """Return the armored key.
+
+        Raises RepoKeyNotFound if no source provides a valid key.
+        """
+        for origin, load in self.candidates():
+            key = load()
+            if not key:
+                continue
+            fingerprint = openpgp_fingerprint(key)
+            if fingerprint is None:
+                logger.warning('Ignoring repository key from {0}: not an '
+                               'OpenPGP public key'.format(origin))
+                continue
+            if self.fingerprint and fingerprint != self.fingerprint:
+                logger.warning(
+                    'Ignoring repository key from {0}: fingerprint {1} does '
+                    'not match {2}'.format(origin, fingerprint,
+                                           self.fingerprint))
+                continue
+
+            logger.info('Using repository key {0} from {1}'.format(
+                fingerprint, origin))
+            if origin in ('mirror', 'url'):
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    atomic_write(self.cache_path, key, perms=0o644)
+                except OSError as e:
+                    logger.warning('Failed to cache repository key: '
+                                   '{0}'.format(e))
+            return key
+
+        if self.fingerprint:
+            raise RepoKeyNotFound('No repository key with fingerprint {0} '
+                                  'found'.format(self.fingerprint))
+        raise RepoKeyNotFound('No repository key found')
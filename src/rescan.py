@@ -0,0 +1,226 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Targeted rescans of the SCSI targets of InfiniBox systems.
+
+Only the targets leading to InfiniBox systems are scanned, in parallel,
+rather than every host adapter one after another as rescan-scsi-bus does.
+"""
+
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from discovery import INFINIBOX_VENDOR, read_attr
+
+# FC port names and iSCSI target names of InfiniBox systems, with the
+# Infinidat IEEE OUI
+INFINIBOX_WWPN_PREFIX = '0x5742b0f'
+INFINIBOX_IQN_PREFIX = 'iqn.2009-11.com.infinidat:'
+FC_TARGET_ROLE = 'FCP Target'
+
+# matches any channel, target or LUN in a scan request
+WILDCARD = '-'
+
+
+def _numeric_key(parts):
+    # wildcards sort first
+    return tuple(int(x) if x.isdigit() else -1 for x in parts)
+
+
+class ScsiTarget(NamedTuple):
+    host: str
+    channel: str
+    target: str
+
+    @property
+    def name(self):
+        return '{0}:{1}:{2}'.format(*self)
+
+    def matches(self, hcil):
+        host, channel, target, _ = hcil.split(':')
+        return host == self.host and \
+            self.channel in (WILDCARD, channel) and \
+            self.target in (WILDCARD, target)
+
+
+class Device(NamedTuple):
+    # block device name, None if there is none
+    block: Optional[str]
+    state: str
+    # in bytes
+    size: int
+
+
+class RescanChanges(NamedTuple):
+    new: List[str]
+    removed: List[str]
+    resized: List[str]
+
+
+def parse_luns(value):
+    """LUN IDs of a comma or space separated list, None if it is empty."""
+    luns = (value or '').replace(',', ' ').split()
+    for lun in luns:
+        if not lun.isdigit():
+            raise ValueError('invalid LUN ID: {0}'.format(lun))
+    return sorted(set(luns), key=int) or None
+
+
+def infinibox_targets(topology, sysfs='/sys'):
+    """SCSI targets leading to InfiniBox systems.
+
+    They are the targets of FC remote ports and iSCSI sessions of InfiniBox
+    systems, which are found even before they have LUNs, and the targets of
+    the InfiniBox devices. iSCSI sessions have their own SCSI host, which
+    is scanned as a whole.
+    """
+    targets = set()
+    for lun in topology.scsi.values():
+        if lun.vendor == INFINIBOX_VENDOR:
+            targets.add(ScsiTarget(*lun.hcil.split(':')[:3]))
+
+    for rport in glob.glob(os.path.join(sysfs, 'class', 'fc_remote_ports',
+                                        'rport-*')):
+        if not read_attr(os.path.join(rport, 'port_name')).lower() \
+                .startswith(INFINIBOX_WWPN_PREFIX):
+            continue
+        if FC_TARGET_ROLE not in read_attr(os.path.join(rport, 'roles')):
+            continue
+        # -1 until the remote port is bound to a SCSI target
+        target = read_attr(os.path.join(rport, 'scsi_target_id'))
+        if not target.isdigit():
+            continue
+        # rport-<host>:<channel>-<number>
+        host, _, channel = os.path.basename(rport)[len('rport-'):] \
+            .split('-')[0].partition(':')
+        targets.add(ScsiTarget(host, channel, target))
+
+    sessions = set()
+    for session in glob.glob(os.path.join(sysfs, 'class', 'iscsi_session',
+                                          'session*')):
+        if not read_attr(os.path.join(session, 'targetname')).startswith(
+                INFINIBOX_IQN_PREFIX):
+            continue
+        host = os.path.basename(os.path.dirname(os.path.realpath(
+            os.path.join(session, 'device'))))
+        if host.startswith('host'):
+            sessions.add(ScsiTarget(host[len('host'):], WILDCARD, WILDCARD))
+
+    hosts = {t.host for t in sessions}
+    return sorted(sessions | {t for t in targets if t.host not in hosts},
+                  key=_numeric_key)
+
+
+def target_devices(topology, targets, luns=None, sysfs='/sys'):
+    """{H:C:T:L: Device} of the SCSI devices of the targets, only the
+    given LUNs if any."""
+    devices = {}
+    for hcil, lun in topology.scsi.items():
+        if luns and hcil.split(':')[3] not in luns:
+            continue
+        if not any(t.matches(hcil) for t in targets):
+            continue
+        size = read_attr(os.path.join(sysfs, 'block', lun.block, 'size'),
+                         '0') if lun.block else '0'
+        # sizes are always in 512 byte sectors
+        devices[hcil] = Device(lun.block, lun.state,
+                               int(size) * 512 if size.isdigit() else 0)
+    return devices
+
+
+def _write(path, value):
+    try:
+        with open(path, 'w') as f:
+            f.write(value)
+    except OSError as e:
+        return str(e)
+    return None
+
+
+def _scan(target, luns, sysfs):
+    path = os.path.join(sysfs, 'class', 'scsi_host',
+                        'host' + target.host, 'scan')
+    for lun in luns or [WILDCARD]:
+        error = _write(path, '{0} {1} {2}'.format(
+            target.channel, target.target, lun))
+        if error:
+            return error
+    return None
+
+
+def _run_parallel(func, items, jobs):
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        return list(pool.map(func, items))
+
+
+def scan_targets(targets, luns=None, jobs=8, sysfs='/sys'):
+    """Scan the targets for new LUNs, jobs of them at once.
+
+    The kernel scans a target synchronously when its scan file is written.
+    Returns {target name: error} of the targets it failed to scan.
+    """
+    errors = _run_parallel(lambda t: _scan(t, luns, sysfs), targets, jobs)
+    return {t.name: e for t, e in zip(targets, errors) if e}
+
+
+def rescan_devices(hcils, jobs=8, sysfs='/sys'):
+    """Have the devices read their capacity again, jobs of them at once.
+
+    Returns {H:C:T:L: error} of the devices it failed to rescan.
+    """
+    errors = _run_parallel(
+        lambda hcil: _write(os.path.join(sysfs, 'class', 'scsi_device', hcil,
+                                         'device', 'rescan'), '1'),
+        hcils, jobs)
+    return {h: e for h, e in zip(hcils, errors) if e}
+
+
+def _describe(hcil, device):
+    return '{0} ({1})'.format(hcil, device.block or 'no block device')
+
+
+def compare(before, after):
+    """Devices found, gone or resized between two target_devices().
+
+    Devices that are no longer running are reported as removed, the kernel
+    only deletes them once told to.
+    """
+    def ordered(devices):
+        return sorted(devices.items(),
+                      key=lambda item: _numeric_key(item[0].split(':')))
+
+    new = [_describe(h, d) for h, d in ordered(after)
+           if h not in before]
+    removed = [_describe(h, d) for h, d in ordered(before)
+               if d.state == 'running' and
+               (h not in after or after[h].state != 'running')]
+    resized = ['{0}: {1} -> {2} bytes'.format(_describe(h, d), d.size,
+                                              after[h].size)
+               for h, d in ordered(before)
+               if h in after and after[h].size != d.size]
+    return RescanChanges(new, removed, resized)
+
+
+def affected_blocks(before, after):
+    """Block devices of the new and resized devices."""
+    return sorted(d.block for h, d in after.items()
+                  if d.block and (h not in before or
+                                  before[h].size != d.size))
+
+
+def describe_errors(errors):
+    return '\n'.join('{0}: {1}'.format(k, v) for k, v in sorted(
+        errors.items()))
@@ -0,0 +1,134 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded storage of infinihost output files."""
+
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+from confutils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+RESULTS_PREFIX = 'infinihost-out-'
+INDEX_FILE = 'index.json'
+
+
+class ResultsStore(object):
+    """infinihost output files along with an index of their summaries.
+
+    The index lists, oldest first, the file name, timestamp, exit code and
+    check counts of each run, so that the history can be listed without
+    reading every file. Files beyond keep_count, or older than max_age
+    days, are removed (0 disables either limit), and all but the latest
+    file are compressed.
+    """
+
+    def __init__(self, directory, keep_count=0, max_age=0):
+        self.directory = directory
+        self.keep_count = keep_count
+        self.max_age = max_age
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def entries(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logger.warning('Ignoring corrupted {0}'.format(self.index_path))
+            return []
+
+    def _save(self, entries):
+        atomic_write(self.index_path, json.dumps(entries, indent=1),
+                     perms=0o644)
+
+    def _adopt_unindexed(self, entries):
+        """Index output files written before the index existed."""
+        known = set(e['file'] for e in entries)
+        adopted = []
+        for path in glob.glob(os.path.join(self.directory,
+                                           RESULTS_PREFIX + '*')):
+            name = os.path.basename(path)
+            if name in known:
+                continue
+            adopted.append({'file': name,
+                            'timestamp': os.stat(path).st_mtime,
+                            'exit-code': None,
+                            'summary': None})
+        if adopted:
+            logger.info('Indexing {0} infinihost output files'.format(
+                len(adopted)))
+        return sorted(entries + adopted, key=lambda e: e['timestamp'])
+
+    def add(self, path, report, timestamp=None):
+        """Record an output file and the report parsed from it."""
+        entries = self._adopt_unindexed(self.entries())
+        name = os.path.basename(path)
+        entries = [e for e in entries if e['file'] != name]
+        entries.append({
+            'file': name,
+            'timestamp': time.time() if timestamp is None else timestamp,
+            'exit-code': report.code,
+            'summary': report.counts,
+        })
+        self._save(self._prune(entries))
+
+    def _remove(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _compress(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as src, \
+                    gzip.open(path + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        except FileNotFoundError:
+            return name
+        os.chmod(path + '.gz', 0o644)
+        os.unlink(path)
+        return name + '.gz'
+
+    def _prune(self, entries):
+        keep = entries
+        if self.max_age:
+            cutoff = time.time() - self.max_age * 86400
+            keep = [e for e in keep if e['timestamp'] >= cutoff]
+        if self.keep_count:
+            keep = keep[-self.keep_count:]
+
+        kept = set(e['file'] for e in keep)
+        removed = [e['file'] for e in entries if e['file'] not in kept]
+        for name in removed:
+            self._remove(name)
+        if removed:
+            logger.info('Removed {0} old infinihost output files'.format(
+                len(removed)))
+
+        for e in keep[:-1]:
+            if not e['file'].endswith('.gz'):
+                e['file'] = self._compress(e['file'])
+        return keep
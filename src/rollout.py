@@ -0,0 +1,107 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Leader driven rate limiting of disruptive operations across units.
+
+Units waiting to run disruptive operations set a request in their peer
+relation data. The leader grants up to a number of requests at once in the
+application data, and waits for a backoff period after a unit is done
+before granting the next one. Units run their operations once granted and
+mark their request as done.
+"""
+
+import json
+import time
+import uuid
+from typing import NamedTuple
+
+# grants of units that do not report back are revoked after this long
+GRANT_TIMEOUT = 3600
+
+# operations waiting for a grant, and how the unit status describes them
+OP_MULTIPATHD_RESTART = 'multipathd-restart'
+OP_UDEV_TRIGGER = 'udev-trigger'
+OP_INITRD = 'initrd'
+OP_DESCRIPTIONS = {
+    OP_MULTIPATHD_RESTART: 'multipathd restart',
+    OP_UDEV_TRIGGER: 'udev trigger',
+    OP_INITRD: 'initrd rebuild',
+}
+
+
+class Grant(NamedTuple):
+    request: str
+    since: float
+
+
+def new_request_id(now=None):
+    """Request id, sorting in the order requests are made."""
+    now = time.time() if now is None else now
+    return '{0:015d}-{1}'.format(int(now * 1000), uuid.uuid4().hex[:8])
+
+
+def load_grants(data):
+    """{unit: Grant} from the application data of the peer relation."""
+    return {unit: Grant(*grant)
+            for unit, grant in json.loads(data.get('grants') or '{}').items()}
+
+
+def dump_grants(grants):
+    return json.dumps({unit: list(grant) for unit, grant in grants.items()},
+                      sort_keys=True)
+
+
+def schedule(requests, done, grants, concurrency, backoff, last_release,
+             now=None, timeout=GRANT_TIMEOUT):
+    """Release the grants units are done with and grant waiting requests.
+
+    requests and done are the {unit: request id} units are waiting for
+    and are done with, grants the current {unit: Grant}. A request is
+    granted when fewer than concurrency units hold a grant and no unit
+    released its grant in the last backoff seconds. Grants older than
+    timeout are revoked, their unit has to wait for the other requests.
+
+    Returns the new grants and the time of the last release.
+    """
+    now = time.time() if now is None else now
+    grants = dict(grants)
+    expired = set()
+    for unit, grant in sorted(grants.items()):
+        if now - grant.since > timeout:
+            expired.add(unit)
+        elif done.get(unit) != grant.request and \
+                requests.get(unit) == grant.request:
+            continue
+        del grants[unit]
+        last_release = now
+
+    if last_release is not None and now - last_release < backoff:
+        return grants, last_release
+
+    # units whose grant expired go after the other waiting units
+    waiting = sorted((unit in expired, request, unit)
+                     for unit, request in requests.items()
+                     if request and unit not in grants and
+                     done.get(unit) != request)
+    for _, request, unit in waiting:
+        if len(grants) >= concurrency:
+            break
+        grants[unit] = Grant(request, now)
+    return grants, last_release
+
+
+def describe_pending(ops):
+    """Unit status of operations waiting for a grant."""
+    return 'waiting for rollout: {0}'.format(', '.join(
+        OP_DESCRIPTIONS.get(op, op) for op in sorted(ops)))
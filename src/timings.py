@@ -0,0 +1,119 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timing of the phases of hook runs."""
+
+import contextlib
+import resource
+import time
+
+# number of hook runs kept in the history
+KEEP_RUNS = 50
+
+# upper bounds, in seconds, of the histogram buckets
+HISTOGRAM_BUCKETS = (1, 5, 30, 120, 600)
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class PhaseTimer(object):
+    """Wall and subprocess CPU time of the phases of a single hook run.
+
+    Phases may be nested, a phase run several times in the same hook
+    accumulates its times.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        cpu_start = _children_cpu()
+        try:
+            yield
+        finally:
+            wall = time.monotonic() - start
+            cpu = _children_cpu() - cpu_start
+            total = self.phases.setdefault(name, [0.0, 0.0])
+            total[0] += wall
+            total[1] += cpu
+
+    def describe(self):
+        return ', '.join('{0} {1:.2f}s'.format(name, wall)
+                         for name, (wall, _) in self.phases.items())
+
+
+def add_run(runs, hook, phases, timestamp=None, keep=KEEP_RUNS):
+    """Append a hook run to the history, dropping the oldest runs."""
+    runs = list(runs)
+    runs.append({
+        'hook': hook,
+        'timestamp': time.time() if timestamp is None else timestamp,
+        'phases': {name: [round(wall, 3), round(cpu, 3)]
+                   for name, (wall, cpu) in phases.items()},
+    })
+    return runs[-keep:]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def histogram(values, buckets=HISTOGRAM_BUCKETS):
+    """Count values per bucket, e.g. '<1s=3 <5s=0 <30s=1 >=600s=0'."""
+    counts = [0] * (len(buckets) + 1)
+    for v in values:
+        for i, bound in enumerate(buckets):
+            if v < bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = ['<{0}s'.format(b) for b in buckets]
+    labels.append('>={0}s'.format(buckets[-1]))
+    return ' '.join('{0}={1}'.format(label, count)
+                    for label, count in zip(labels, counts))
+
+
+def phase_summary(runs):
+    """Statistics of the wall and subprocess time of each phase.
+
+    Returns {phase: {count, min, median, p90, max, subprocess, histogram}},
+    times in seconds. 'subprocess' is the mean CPU time of the child
+    processes of the phase.
+    """
+    walls = {}
+    cpus = {}
+    for run in runs:
+        for name, (wall, cpu) in run['phases'].items():
+            walls.setdefault(name, []).append(wall)
+            cpus.setdefault(name, []).append(cpu)
+
+    summary = {}
+    for name, values in walls.items():
+        summary[name] = {
+            'count': len(values),
+            'min': round(min(values), 2),
+            'median': round(_percentile(values, 0.5), 2),
+            'p90': round(_percentile(values, 0.9), 2),
+            'max': round(max(values), 2),
+            'subprocess': round(sum(cpus[name]) / len(values), 2),
+            'histogram': histogram(values),
+        }
+    return summary
@@ -0,0 +1,96 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""udev rules tuning the block queues of InfiniBox devices."""
+
+import os
+import re
+
+from discovery import INFINIBOX_VENDOR, read_attr, read_scheduler
+
+QUEUE_RULES_TEMPLATE = 'infinidat-queue.rules.j2'
+# sorts after the rules installed by infinihost, so that the charm
+# settings take precedence
+QUEUE_RULES_FILE = '/etc/udev/rules.d/99-infinidat-tools-queue.rules'
+
+# NAA identifiers of InfiniBox volumes, with the Infinidat IEEE OUI
+INFINIBOX_WWID_PREFIX = '36742b0f'
+
+# the scheduler comes first: changing it resets nr_requests
+QUEUE_ATTRS = ('scheduler', 'nr_requests', 'read_ahead_kb', 'rq_affinity',
+               'max_sectors_kb')
+SCHEDULER_RE = re.compile(r'^[a-z0-9-]+$')
+
+
+def validate_queue_settings(settings):
+    """Return a list of problems with the queue settings.
+
+    Settings are strings, empty ones are left to the kernel.
+    """
+    errors = []
+    scheduler = settings.get('scheduler')
+    if scheduler and not SCHEDULER_RE.match(scheduler):
+        errors.append('invalid scheduler "{0}"'.format(scheduler))
+    for attr in QUEUE_ATTRS[1:]:
+        value = str(settings.get(attr) or '')
+        if value and not value.isdigit():
+            errors.append('{0} must be a number'.format(attr))
+    rq_affinity = str(settings.get('rq_affinity') or '')
+    if rq_affinity.isdigit() and int(rq_affinity) > 2:
+        errors.append('rq_affinity must be 0, 1 or 2')
+    return errors
+
+
+def managed_settings(settings):
+    """(attribute, value) pairs of the settings set, in the order to apply
+    them in."""
+    return [(attr, str(settings[attr])) for attr in QUEUE_ATTRS
+            if settings.get(attr) not in (None, '')]
+
+
+def render_rules(template_dir, settings):
+    import jinja2
+
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                             keep_trailing_newline=True)
+    return env.get_template(QUEUE_RULES_TEMPLATE).render(
+        settings=managed_settings(settings),
+        vendor=INFINIBOX_VENDOR,
+        wwid_prefix=INFINIBOX_WWID_PREFIX)
+
+
+def target_devices(topology):
+    """Block devices the rules apply to: InfiniBox SCSI disks and their
+    multipath devices."""
+    devices = [lun.block for lun in topology.infinibox_luns if lun.block]
+    devices.extend(d.device for d in topology.infinibox_multipath_devices
+                   if d.wwid.startswith(INFINIBOX_WWID_PREFIX))
+    return devices
+
+
+def queue_mismatches(devices, settings, sysfs='/sys'):
+    """Settings that do not have the desired value on the devices, e.g.
+    'sdb: nr_requests=64 (expected 256)'."""
+    mismatches = []
+    for device in devices:
+        for attr, value in managed_settings(settings):
+            if attr == 'scheduler':
+                actual = read_scheduler(device, sysfs)
+            else:
+                actual = read_attr(os.path.join(sysfs, 'block', device,
+                                                'queue', attr))
+            if actual != value:
+                mismatches.append('{0}: {1}={2} (expected {3})'.format(
+                    device, attr, actual, value))
+    return mismatches
@@ -0,0 +1,114 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The multipath wwids file, listing the WWIDs multipathd claims.
+
+multipathd claims devices whose WWID is listed right away, without
+probing them first, and with 'find_multipaths strict' it only claims those.
+InfiniBox WWIDs are added and pruned as volumes come and go, other entries
+are left alone.
+"""
+
+import logging
+import subprocess
+from typing import List, NamedTuple
+
+from udevrules import INFINIBOX_WWID_PREFIX
+
+logger = logging.getLogger(__name__)
+
+WWIDS_FILE = '/etc/multipath/wwids'
+
+# as written by multipath, which rewrites files without it
+HEADER = (
+    '# Multipath wwids, Version : 1.0\n'
+    '# NOTE: This file is automatically maintained by multipath and '
+    'multipathd.\n'
+    '# You should not need to edit this file in normal circumstances.\n'
+    '#\n'
+    '# Valid WWIDs:\n'
+)
+
+
+class WwidsUpdate(NamedTuple):
+    wwids: List[str]
+    added: List[str]
+    removed: List[str]
+
+
+def is_infinibox(wwid):
+    return wwid.startswith(INFINIBOX_WWID_PREFIX)
+
+
+def parse_wwids(text):
+    """WWIDs of a wwids file, in file order.
+
+    Entries are '/<wwid>/' lines, anything else is ignored as multipath
+    does.
+    """
+    wwids = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('/') and line.endswith('/') and len(line) > 2 \
+                and line[1:-1] not in wwids:
+            wwids.append(line[1:-1])
+    return wwids
+
+
+def render_wwids(wwids):
+    return HEADER + ''.join('/{0}/\n'.format(w) for w in wwids)
+
+
+def infinibox_wwids(topology):
+    """WWIDs of the InfiniBox volumes attached to the host."""
+    wwids = {lun.wwid for lun in topology.infinibox_luns if lun.wwid}
+    wwids.update(d.wwid for d in topology.infinibox_multipath_devices)
+    return sorted(w for w in wwids if is_infinibox(w))
+
+
+def update_wwids(current, discovered):
+    """Add the discovered InfiniBox WWIDs to the current ones, and prune
+    the InfiniBox WWIDs of volumes that are gone.
+
+    Entries that are kept stay in place, added ones are appended.
+    """
+    discovered = set(discovered)
+    kept = [w for w in current if not is_infinibox(w) or w in discovered]
+    added = sorted(discovered - set(current))
+    removed = [w for w in current if w not in kept]
+    return WwidsUpdate(kept + added, added, removed)
+
+
+def add_maps(wwids):
+    """Have multipathd create the maps of WWIDs it did not claim yet.
+
+    This only acts on the given devices, unlike 'multipathd reconfigure'
+    which reloads every map. Returns the WWIDs it failed for.
+    """
+    failed = []
+    for wwid in wwids:
+        try:
+            out = subprocess.check_output(
+                ['multipathd', 'add', 'map', wwid],
+                stderr=subprocess.STDOUT, universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning('multipathd add map {0} failed: {1}'.format(
+                wwid, e))
+            failed.append(wwid)
+            continue
+        if out.strip() != 'ok':
+            logger.warning('multipathd add map {0}: {1}'.format(
+                wwid, out.strip()))
+            failed.append(wwid)
+    return failed
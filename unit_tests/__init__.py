@@ -11,3 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+import sys
+
+# The charm's own modules in src/ are imported as top-level modules at
+# runtime (the src directory is on sys.path when dispatched by Juju).
+sys.path.append('src')
@@ -0,0 +1,63 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fake sysfs trees shared by the unit tests."""
+
+import os
+
+
+class FakeSysfs(object):
+    """Minimal sysfs tree with the layout of SCSI and dm devices."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, path, value=''):
+        """Write an attribute, path is relative to the root unless it is
+        absolute."""
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(value + '\n')
+
+    def add_block(self, name, scheduler='[none] mq-deadline'):
+        self.write(os.path.join('block', name, 'queue', 'scheduler'),
+                   scheduler)
+
+    def add_scsi(self, hcil, block=None, vendor='NFINIDAT',
+                 model='InfiniBox', state='running', wwid=None, **kwargs):
+        dev = os.path.join('devices', 'target', hcil)
+        self.write(os.path.join(dev, 'vendor'), '{0:8}'.format(vendor))
+        self.write(os.path.join(dev, 'model'), '{0:16}'.format(model))
+        self.write(os.path.join(dev, 'state'), state)
+        self.write(os.path.join(dev, 'queue_depth'), '32')
+        if wwid:
+            self.write(os.path.join(dev, 'wwid'), wwid)
+        if block:
+            os.makedirs(os.path.join(self.root, dev, 'block', block))
+            self.add_block(block, **kwargs)
+        link = os.path.join(self.root, 'class', 'scsi_device', hcil)
+        os.makedirs(link)
+        os.symlink(os.path.join('..', '..', '..', dev),
+                   os.path.join(link, 'device'))
+
+    def add_dm(self, name, alias, uuid, slaves, **kwargs):
+        self.add_block(name, **kwargs)
+        self.write(os.path.join('block', name, 'dm', 'name'), alias)
+        self.write(os.path.join('block', name, 'dm', 'uuid'), uuid)
+        os.makedirs(os.path.join(self.root, 'block', name, 'slaves'))
+        for slave in slaves:
+            os.symlink(os.path.join('..', '..', slave),
+                       os.path.join(self.root, 'block', name, 'slaves',
+                                    slave))
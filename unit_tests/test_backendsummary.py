@@ -0,0 +1,91 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+import backendsummary
+from discovery import DmDevice, ScsiDevice, StorageTopology
+
+WWID = '36742b0f0000004e2000000000000a001'
+
+
+def _topology(states):
+    scsi = [ScsiDevice('{0}:0:0:1'.format(i + 1), 'NFINIDAT', 'InfiniBox',
+                       state, 'sd' + 'bcd'[i], 'none', '32')
+            for i, state in enumerate(states)]
+    dm = [DmDevice('dm-0', 'mpatha', 'mpath-' + WWID, 'none',
+                   [s.block for s in scsi])]
+    return StorageTopology(scsi, dm)
+
+
+class TestBackendSummary(unittest.TestCase):
+
+    def test_ready(self):
+        summary = backendsummary.build_summary(
+            _topology(['running', 'running']),
+            {'queue': {'scheduler': 'none', 'nr_requests': ''},
+             'iscsi': {}},
+            last_check={'code': 0, 'ok': True})
+        self.assertEqual(summary, {
+            'version': backendsummary.SUMMARY_VERSION,
+            'ready': True,
+            'reasons': [],
+            'multipath': {WWID: [2, 2]},
+            'settings': {'queue': {'scheduler': 'none'}, 'iscsi': {}},
+            'last-check': {'code': 0, 'ok': True},
+        })
+
+        # no InfiniBox volume yet
+        summary = backendsummary.build_summary(StorageTopology([], []), {})
+        self.assertTrue(summary['ready'])
+        self.assertEqual(summary['multipath'], {})
+
+    def test_not_ready(self):
+        summary = backendsummary.build_summary(
+            _topology(['running', 'offline']), {})
+        self.assertFalse(summary['ready'])
+        self.assertEqual(summary['reasons'], [
+            'fewer than 2 running paths: mpatha (1/2)'])
+        self.assertEqual(summary['multipath'], {WWID: [1, 2]})
+
+        summary = backendsummary.build_summary(
+            StorageTopology([], []), {}, blocked='Installation failed')
+        self.assertFalse(summary['ready'])
+        self.assertEqual(summary['reasons'], ['Installation failed'])
+
+    def test_relation_data(self):
+        summary = backendsummary.build_summary(
+            _topology(['running', 'running']), {'fc': {'lun_queue_depth': 64}})
+        data = backendsummary.relation_data(summary)
+        self.assertEqual(data['version'], '1')
+        self.assertEqual(data['ready'], 'true')
+        self.assertEqual(json.loads(data['summary']), {
+            'version': 1, 'ready': True, 'reasons': [],
+            'multipath': {WWID: [2, 2]},
+            'settings': {'fc': {'lun_queue_depth': '64'}},
+            'last-check': None})
+
+        # the fingerprint only changes along with the summary
+        same = backendsummary.build_summary(
+            _topology(['running', 'running']),
+            {'fc': {'lun_queue_depth': '64'}})
+        self.assertEqual(backendsummary.relation_data(same)['fingerprint'],
+                         data['fingerprint'])
+        degraded = backendsummary.build_summary(
+            _topology(['running', 'offline']),
+            {'fc': {'lun_queue_depth': '64'}})
+        self.assertNotEqual(
+            backendsummary.relation_data(degraded)['fingerprint'],
+            data['fingerprint'])
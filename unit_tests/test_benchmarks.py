@@ -0,0 +1,65 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from infinihost import STATUS_FAIL, parse_output
+from lvmconf import get_option
+from multipath import ACTION_RECONFIGURE, parse_config, plan_reconfiguration
+
+from benchmarks import run, workloads
+
+
+class TestWorkloads(unittest.TestCase):
+    """The synthetic inputs exercise the code paths they are meant to."""
+
+    def test_multipath_conf(self):
+        settings = parse_config(workloads.multipath_conf(3, 2))
+        self.assertEqual(len(settings[(('blacklist',), 'wwid')]), 2)
+        self.assertEqual(len([path for path, key in settings
+                              if path[0] == 'multipaths' and
+                              key == 'wwid']), 3)
+        plan = plan_reconfiguration(workloads.multipath_conf(3),
+                                    workloads.multipath_conf(3, 4))
+        self.assertEqual(plan.action, ACTION_RECONFIGURE)
+
+    def test_lvm_conf(self):
+        value = get_option(workloads.lvm_conf(3), 'devices', 'global_filter')
+        self.assertEqual(value, workloads.filter_patterns(3))
+        self.assertEqual(value.count('"a|'), 3)
+
+    def test_infinihost_output(self):
+        report = parse_output(workloads.infinihost_output(3), code=1)
+        self.assertEqual(len(report.checks), 4)
+        self.assertEqual(len(report.by_status(STATUS_FAIL)), 3)
+        self.assertEqual(report.checks[3].reason,
+                         'FAILURE: volume-2 has 1 path')
+
+    def test_benchmarks(self):
+        for benchmark in workloads.BENCHMARKS:
+            benchmark.func(*benchmark.setup(2))
+
+
+class TestRun(unittest.TestCase):
+
+    def test_scaling_exponent(self):
+        self.assertIsNone(run.scaling_exponent({1: 0.5}))
+        self.assertAlmostEqual(run.scaling_exponent({10: 1.0, 40: 4.0}), 1)
+        self.assertAlmostEqual(run.scaling_exponent({10: 1.0, 40: 16.0}), 2)
+
+    def test_regressions(self):
+        previous = {'lvm-filter': {'1000': 0.1, '4000': 0.4}}
+        self.assertEqual(run.regressions(
+            {'lvm-filter': {1000: 0.12, 4000: 0.6}, 'new': {1: 1.0}},
+            previous), ['lvm-filter[4000]: 0.600s (was 0.400s)'])
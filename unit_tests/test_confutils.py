@@ -0,0 +1,69 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import confutils
+
+
+class TestConfUtils(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+
+    def test_digests(self):
+        self.assertIsNone(confutils.file_digest(self.path))
+        with open(self.path, 'w') as f:
+            f.write('data')
+        self.assertEqual(confutils.file_digest(self.path),
+                         confutils.content_digest('data'))
+        self.assertEqual(confutils.content_digest(b'data'),
+                         confutils.content_digest('data'))
+
+    def test_atomic_write_preserves_mode(self):
+        with open(self.path, 'w') as f:
+            f.write('old')
+        os.chmod(self.path, 0o600)
+
+        confutils.atomic_write(self.path, 'new')
+
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        # no temporary files are left behind
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+
+    @mock.patch('os.replace')
+    def test_atomic_write_failure(self, replace):
+        with open(self.path, 'w') as f:
+            f.write('old')
+        replace.side_effect = OSError('boom')
+
+        self.assertRaises(OSError, confutils.atomic_write, self.path, 'new')
+
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+
+    def test_write_file_if_changed(self):
+        self.assertTrue(confutils.write_file_if_changed(self.path, 'data'))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        self.assertFalse(confutils.write_file_if_changed(self.path, 'data'))
+        self.assertTrue(confutils.write_file_if_changed(self.path, 'data2'))
@@ -0,0 +1,125 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+import debbundle
+
+DEBS = {
+    'host-power-tools_7.3.0.0_amd64.deb': b'hpt',
+    'scsitools_0.12-3ubuntu1_amd64.deb': b'scsitools',
+}
+
+
+def _manifest(debs):
+    return ''.join(
+        '{0}  {1}\n'.format(hashlib.sha256(data).hexdigest(), name)
+        for name, data in sorted(debs.items()))
+
+
+def _dpkg_deb(cmd, **kwargs):
+    # dpkg-deb --field <name>_<version>_<arch>.deb Package Version
+    package, version, _ = os.path.basename(cmd[2]).split('_')
+    return 'Package: {0}\nVersion: {1}\n'.format(package, version)
+
+
+class TestDebBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = os.path.join(self.tmpdir, 'cache')
+        patcher = mock.patch('subprocess.check_output',
+                             side_effect=_dpkg_deb)
+        self.check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _tarball(self, files, name='bundle.tar.gz'):
+        path = os.path.join(self.tmpdir, name)
+        with tarfile.open(path, 'w:gz') as tar:
+            for member, data in files.items():
+                if isinstance(data, str):
+                    data = data.encode()
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return path
+
+    def test_parse_manifest(self):
+        digest = 'a' * 64
+        self.assertEqual(debbundle.parse_manifest(
+            '{0}  a.deb\n\n{0} *debs/b.deb\n'.format(digest)),
+            {'a.deb': digest, 'b.deb': digest})
+        with self.assertRaisesRegex(debbundle.BundleError, 'line 1'):
+            debbundle.parse_manifest('a.deb\n')
+
+    def test_load_bundle(self):
+        files = {'debs/' + n: d for n, d in DEBS.items()}
+        files['debs/SHA256SUMS'] = _manifest(DEBS)
+        tarball = self._tarball(files)
+
+        bundle = debbundle.load_bundle(tarball, self.cache)
+        self.assertEqual(bundle.versions, {'host-power-tools': '7.3.0.0',
+                                           'scsitools': '0.12-3ubuntu1'})
+        self.assertEqual([os.path.basename(d) for d in bundle.debs],
+                         sorted(DEBS))
+        with open(bundle.debs[0], 'rb') as f:
+            self.assertEqual(f.read(), b'hpt')
+
+        # verified once
+        self.check_output.reset_mock()
+        self.assertEqual(debbundle.load_bundle(tarball, self.cache), bundle)
+        self.check_output.assert_not_called()
+
+        # a new bundle replaces the previous one
+        debs = dict(DEBS)
+        debs['scsitools_0.12-3ubuntu1_amd64.deb'] = b'scsitools 2'
+        debs_files = dict(debs, SHA256SUMS=_manifest(debs))
+        new = debbundle.load_bundle(self._tarball(debs_files, 'new.tar'),
+                                    self.cache)
+        self.assertEqual(os.listdir(self.cache), [new.digest])
+
+    def test_invalid_bundles(self):
+        for files, error in (
+                (DEBS, 'no SHA256SUMS manifest'),
+                ({'SHA256SUMS': ''}, 'no .deb files'),
+                (dict(DEBS, SHA256SUMS=_manifest(
+                    {'scsitools_0.12-3ubuntu1_amd64.deb': b'scsitools'})),
+                 'not in SHA256SUMS: host-power-tools_7.3.0.0_amd64.deb'),
+                (dict(DEBS, SHA256SUMS=_manifest(dict(DEBS, **{
+                    'scsitools_0.12-3ubuntu1_amd64.deb': b'other'}))),
+                 'checksum mismatch: scsitools_0.12-3ubuntu1_amd64.deb'),
+                (dict(DEBS, SHA256SUMS=_manifest(dict(DEBS, **{
+                    'parted_3.3-4_amd64.deb': b'parted'}))),
+                 'missing: parted_3.3-4_amd64.deb'),
+                (dict({'a/' + n: d for n, d in DEBS.items()},
+                      **{'b/host-power-tools_7.3.0.0_amd64.deb': b'hpt'}),
+                 'duplicate host-power-tools_7.3.0.0_amd64.deb')):
+            with self.assertRaisesRegex(debbundle.BundleError, error):
+                debbundle.load_bundle(self._tarball(files), self.cache)
+            # nothing is left behind
+            self.assertEqual(os.listdir(self.cache), [])
+
+        path = os.path.join(self.tmpdir, 'not-a-tarball')
+        with open(path, 'w') as f:
+            f.write('garbage')
+        with self.assertRaisesRegex(debbundle.BundleError, 'invalid tarball'):
+            debbundle.load_bundle(path, self.cache)
@@ -0,0 +1,133 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shutil
+import tempfile
+import unittest
+
+from discovery import (
+    CHECK_NO_BLOCK,
+    CHECK_NO_MULTIPATH,
+    CHECK_PATH_COUNT,
+    CHECK_SCHEDULER,
+    StorageTopology,
+    check_topology,
+    multipath_wwid,
+    read_scheduler,
+)
+from infinihost import STATUS_FAIL, STATUS_OK, STATUS_SKIP
+from unit_tests.sysfs import FakeSysfs
+
+WWID = '36742b0f0000004780000000000012345'
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sysfs = FakeSysfs(self.tmpdir)
+
+        # a local disk and an InfiniBox volume with two paths
+        self.sysfs.add_scsi('0:0:0:0', 'sda', vendor='ATA',
+                            model='Samsung SSD', scheduler='[mq-deadline]')
+        self.sysfs.add_scsi('1:0:0:1', 'sdb', wwid='naa.' + WWID[1:])
+        self.sysfs.add_scsi('2:0:0:1', 'sdc')
+        self.sysfs.add_dm('dm-0', 'mpatha', 'mpath-' + WWID, ['sdb', 'sdc'])
+        # an LVM volume on the multipath device
+        self.sysfs.add_dm('dm-1', 'vg-lv', 'LVM-abc', ['dm-0'])
+
+    def _checks(self, **kwargs):
+        report = check_topology(StorageTopology.discover(self.tmpdir),
+                                **kwargs)
+        return report, {c.check: c for c in report.checks}
+
+    def test_read_scheduler(self):
+        self.assertEqual(read_scheduler('sda', self.tmpdir), 'mq-deadline')
+        self.assertEqual(read_scheduler('sdb', self.tmpdir), 'none')
+        self.assertEqual(read_scheduler('sdz', self.tmpdir), '')
+
+    def test_discover(self):
+        topology = StorageTopology.discover(self.tmpdir)
+
+        self.assertEqual([s.block for s in topology.infinibox_luns],
+                         ['sdb', 'sdc'])
+        self.assertEqual(topology.scsi['0:0:0:0'].vendor, 'ATA')
+        self.assertEqual(topology.scsi['1:0:0:1'].wwid, WWID)
+        self.assertEqual(topology.scsi['2:0:0:1'].wwid, '')
+        mpaths = topology.infinibox_multipath_devices
+        self.assertEqual([d.name for d in mpaths], ['mpatha'])
+        self.assertEqual(mpaths[0].wwid, WWID)
+        self.assertEqual(mpaths[0].slaves, ['sdb', 'sdc'])
+        self.assertEqual(topology.holders['dm-0'].name, 'vg-lv')
+        self.assertEqual(topology.running_paths(mpaths[0]), 2)
+
+    def test_multipath_wwid(self):
+        self.assertEqual(multipath_wwid('naa.6742B0F000000478'),
+                         '36742b0f000000478')
+        self.assertEqual(multipath_wwid('eui.0025385b71b0a0c1'),
+                         '20025385b71b0a0c1')
+        self.assertEqual(multipath_wwid('t10.ATA     Samsung SSD'), '')
+        self.assertEqual(multipath_wwid(''), '')
+
+    def test_checks_ok(self):
+        report, checks = self._checks()
+        self.assertTrue(report.ok)
+        self.assertEqual(len(checks), 4)
+
+    def test_checks_fail(self):
+        # a LUN without block device, one outside of multipath, an offline
+        # path and a path with the wrong scheduler
+        self.sysfs.add_scsi('1:0:0:2')
+        self.sysfs.add_scsi('1:0:0:3', 'sdd', scheduler='[mq-deadline]')
+        self.sysfs.add_scsi('1:0:0:4', 'sde')
+        self.sysfs.add_scsi('2:0:0:4', 'sdf', state='offline')
+        self.sysfs.add_dm('dm-2', 'mpathb', 'mpath-2', ['sde', 'sdf'])
+
+        report, checks = self._checks()
+
+        self.assertEqual(report.code, 1)
+        self.assertEqual(checks[CHECK_NO_BLOCK].reason,
+                         'no block device: 1:0:0:2')
+        self.assertEqual(checks[CHECK_NO_MULTIPATH].reason,
+                         'not part of a multipath device: sdd')
+        self.assertEqual(checks[CHECK_PATH_COUNT].reason,
+                         'fewer than 2 running paths: mpathb (1/2)')
+        self.assertEqual(checks[CHECK_SCHEDULER].reason,
+                         'unexpected scheduler: sdd=mq-deadline')
+        self.assertEqual(checks[CHECK_SCHEDULER].category, 'Performance')
+        # the checks do not fix anything
+        self.assertIsNone(checks[CHECK_SCHEDULER].fix_applied)
+
+        _, checks = self._checks(min_paths=1)
+        self.assertEqual(checks[CHECK_PATH_COUNT].status, STATUS_OK)
+
+        # another scheduler is configured
+        _, checks = self._checks(schedulers=('mq-deadline',))
+        self.assertEqual(
+            checks[CHECK_SCHEDULER].reason,
+            'unexpected scheduler: sdb=none, sde=none, sdc=none, sdf=none, '
+            'mpatha=none, mpathb=none')
+
+    def test_no_infinibox(self):
+        shutil.rmtree(self.tmpdir)
+        self.sysfs.add_scsi('0:0:0:0', 'sda', vendor='ATA')
+
+        report, checks = self._checks()
+        self.assertTrue(report.ok)
+        self.assertEqual(set(c.status for c in checks.values()),
+                         {STATUS_SKIP})
+        self.assertEqual(set(c.fix_applied for c in checks.values()),
+                         {None})
+        self.assertEqual(report.counts[STATUS_FAIL], 0)
@@ -0,0 +1,100 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fchba
+from discovery import ScsiDevice, StorageTopology
+from unit_tests.sysfs import FakeSysfs
+
+
+class TestFcHba(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        self.tree = FakeSysfs(self.sysfs)
+
+    def _add_host(self, host, driver):
+        os.makedirs(os.path.join(self.sysfs, 'class', 'fc_host',
+                                 'host{0}'.format(host)))
+        self.tree.write(os.path.join('class', 'scsi_host',
+                                     'host{0}'.format(host), 'proc_name'),
+                        driver)
+
+    def test_validate_fc_settings(self):
+        self.assertEqual(fchba.validate_fc_settings('', None), [])
+        self.assertEqual(fchba.validate_fc_settings('64', '8192'), [])
+        self.assertEqual(fchba.validate_fc_settings('0', 'x'), [
+            'lun_queue_depth must be between 1 and 512',
+            'hba_queue_depth must be a number'])
+
+    def test_render_modprobe(self):
+        self.assertEqual(fchba.render_modprobe(
+            fchba.module_options('', '')), '')
+        self.assertEqual(fchba.render_modprobe(
+            fchba.module_options('128', '')),
+            '# Managed by the infinidat-tools charm\n'
+            'options lpfc lpfc_lun_queue_depth=128\n'
+            'options qla2xxx ql2xmaxqdepth=128\n')
+        self.assertEqual(fchba.render_modprobe(
+            fchba.module_options('', '4096')),
+            '# Managed by the infinidat-tools charm\n'
+            'options lpfc lpfc_hba_queue_depth=4096\n')
+
+    def test_pending_options(self):
+        self._add_host(3, 'qla2xxx')
+        self._add_host(4, 'qla2xxx')
+        self._add_host(5, 'lpfc')
+        self.tree.write('module/qla2xxx/parameters/ql2xmaxqdepth', '64')
+        self.tree.write('module/lpfc/parameters/lpfc_lun_queue_depth', '30')
+        self.tree.write('module/lpfc/parameters/lpfc_hba_queue_depth', '8192')
+        hosts = fchba.fc_hosts(self.sysfs)
+        self.assertEqual(hosts, {'3': 'qla2xxx', '4': 'qla2xxx', '5': 'lpfc'})
+
+        self.assertEqual(fchba.pending_options(
+            fchba.module_options('64', ''), hosts, self.sysfs),
+            ['lpfc: lpfc_lun_queue_depth=30 (expected 64)'])
+        self.assertEqual(fchba.pending_options(
+            fchba.module_options('64', ''), {'3': 'qla2xxx'}, self.sysfs), [])
+        self.assertEqual(fchba.pending_options({}, hosts, self.sysfs), [])
+
+    def test_lun_queue_depth(self):
+        topology = StorageTopology([
+            ScsiDevice('3:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       'none', '32'),
+            ScsiDevice('3:0:0:2', 'NFINIDAT', 'InfiniBox', 'running', 'sdc',
+                       'none', '64'),
+            ScsiDevice('3:0:1:0', 'OTHER', 'Array', 'running', 'sdd',
+                       'none', '32'),
+            ScsiDevice('6:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sde',
+                       'none', '32')], [])
+        luns = fchba.fc_luns(topology, {'3': 'lpfc'})
+        self.assertEqual([lun.hcil for lun in luns], ['3:0:0:1', '3:0:0:2'])
+        self.assertEqual(fchba.lun_depth_mismatches(luns, ''), [])
+        mismatches = fchba.lun_depth_mismatches(luns, '64')
+        self.assertEqual([lun.hcil for lun in mismatches], ['3:0:0:1'])
+
+        self.tree.write('class/scsi_device/3:0:0:1/device/queue_depth', '32')
+        self.assertEqual(fchba.apply_lun_queue_depth(
+            mismatches, '64', self.sysfs), [])
+        with open(os.path.join(self.sysfs, 'class', 'scsi_device', '3:0:0:1',
+                               'device', 'queue_depth')) as f:
+            self.assertEqual(f.read(), '64')
+        # no such device
+        self.assertEqual(fchba.apply_lun_queue_depth(
+            luns[1:], '64', self.sysfs), luns[1:])
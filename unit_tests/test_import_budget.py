@@ -0,0 +1,117 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+import unittest
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds a fresh interpreter may take to import the charm code on top of
+# the ops framework, which every hook pays for, update-status included.
+# TEST_IMPORT_BUDGET overrides it on slow test runners.
+IMPORT_BUDGET = float(os.environ.get('TEST_IMPORT_BUDGET', '0.25'))
+
+# slow to import, only loaded by the code paths using them
+LAZY_MODULES = ('charmhelpers.fetch', 'charmhelpers.core.host', 'jinja2',
+                'urllib.request')
+
+# what the charm is built on, imported by any hook anyway
+FRAMEWORK = ('ops.main', 'ops.model')
+CHARM_FRAMEWORK = FRAMEWORK + ('ops_openstack.core',)
+
+# stands in for ops_openstack where it is not installed, the charm only
+# needs OSBaseCharm to be defined
+OPS_OPENSTACK_STUB = """
+import types
+import ops.charm
+import ops.framework
+class OSBaseCharm(ops.charm.CharmBase):
+    _stored = ops.framework.StoredState()
+core = types.ModuleType('ops_openstack.core')
+core.OSBaseCharm = OSBaseCharm
+sys.modules['ops_openstack'] = types.ModuleType('ops_openstack')
+sys.modules['ops_openstack.core'] = core
+"""
+
+PROBE = """
+import sys
+import time
+sys.path.insert(0, 'src')
+{stub}
+{framework}
+framework = set(sys.modules)
+start = time.perf_counter()
+{imports}
+print(time.perf_counter() - start)
+print(' '.join(m for m in {lazy!r}
+               if m in sys.modules and m not in framework))
+"""
+
+
+def _imports(modules):
+    return '\n'.join('import {0}'.format(m) for m in modules)
+
+
+def _cold_import(modules, framework=FRAMEWORK):
+    """(seconds, lazy modules loaded) of importing modules in a fresh
+    interpreter, as a hook does, once the framework is imported."""
+    stub = ''
+    if importlib.util.find_spec('ops_openstack') is None:
+        stub = OPS_OPENSTACK_STUB
+    out = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(
+            stub=stub, framework=_imports(framework),
+            imports=_imports(modules), lazy=LAZY_MODULES)],
+        cwd=CHARM_DIR, universal_newlines=True)
+    seconds, loaded = (out.splitlines() + [''])[:2]
+    return float(seconds), loaded.split()
+
+
+def _median_import(modules, framework=FRAMEWORK):
+    return statistics.median(
+        _cold_import(modules, framework)[0] for _ in range(3))
+
+
+class TestImportBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = sorted(
+            os.path.basename(path)[:-3]
+            for path in glob.glob(os.path.join(CHARM_DIR, 'src', '*.py'))
+            if not path.endswith('charm.py'))
+
+    def test_lazy_modules(self):
+        _, loaded = _cold_import(self.modules)
+        self.assertEqual(loaded, [])
+
+    def test_import_budget(self):
+        seconds = _median_import(self.modules)
+        self.assertLess(seconds, IMPORT_BUDGET,
+                        'importing the charm modules took {0:.2f}s'.format(
+                            seconds))
+
+    def test_charm_lazy_modules(self):
+        # only the ones ops_openstack does not load itself
+        _, loaded = _cold_import(['charm'], CHARM_FRAMEWORK)
+        self.assertEqual(loaded, [])
+
+    def test_charm_import_budget(self):
+        seconds = _median_import(['charm'], CHARM_FRAMEWORK)
+        self.assertLess(seconds, IMPORT_BUDGET,
+                        'importing the charm took {0:.2f}s'.format(seconds))
@@ -12,11 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import shutil
 import subprocess
+import tempfile
+import time
 import unittest
-from io import StringIO
+from io import BytesIO
 from unittest import mock
-from src.charm import InfinidatToolsCharm, INFINIHOST_RESULTS_DIR
+from src.charm import (
+    InfinidatToolsCharm,
+    INFINIHOST_JOBS_DIR,
+    INFINIHOST_RESULTS_DIR,
+)
+import confutils
+import debbundle
+import localdisks
+import rescan
+import rollout
+import wwids
+from discovery import DmDevice, ScsiDevice, StorageTopology
+from infinihost import CheckResult, InfinihostReport
 from ops.testing import Harness
 
 from ops.model import (
@@ -52,6 +69,29 @@ fvQnuh37D2P8OcIfMxMfoFXpAMWjrMYc5veyQY1GXD/EOkfjjLne6qWPLfNojA==
 class TestInfinidatToolsCharm(unittest.TestCase):
 
     def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for patcher in (
+                mock.patch('src.charm.METRICS_CRON_FILE',
+                           os.path.join(self.tmpdir, 'metrics-cron')),
+                mock.patch('src.charm.QUEUE_RULES_FILE',
+                           os.path.join(self.tmpdir, 'queue.rules')),
+                # the initrd is left alone unless a test boots from SAN
+                mock.patch('initrd.boots_from_san', return_value=False),
+                mock.patch('fchba.MODPROBE_CONF',
+                           os.path.join(self.tmpdir, 'fc.conf')),
+                mock.patch('wwids.WWIDS_FILE',
+                           os.path.join(self.tmpdir, 'multipath', 'wwids')),
+                # no FC HBA unless a test adds some
+                mock.patch('fchba.fc_hosts', return_value={}),
+                # no local disk unless a test adds some
+                mock.patch('localdisks.local_disks', return_value=[]),
+                # no InfiniBox device unless a test adds some
+                mock.patch('src.charm.StorageTopology.discover',
+                           return_value=StorageTopology([], []))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
         self.harness = Harness(InfinidatToolsCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
@@ -68,10 +108,11 @@ class TestInfinidatToolsCharm(unittest.TestCase):
             codename,
             pocket))
 
-    @mock.patch('src.charm.add_source')
-    @mock.patch('src.charm.apt_update')
-    @mock.patch('src.charm.apt_install')
-    @mock.patch('src.charm.lsb_release')
+    @mock.patch('src.charm.installed_versions', return_value={})
+    @mock.patch('charmhelpers.fetch.add_source')
+    @mock.patch('charmhelpers.fetch.apt_update')
+    @mock.patch('charmhelpers.fetch.apt_install')
+    @mock.patch('charmhelpers.core.host.lsb_release')
     @mock.patch('src.charm.InfinidatToolsCharm._get_default_repo_key')
     @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
     @mock.patch('src.charm.InfinidatToolsCharm._run_infinihost_check')
@@ -81,7 +122,8 @@ class TestInfinidatToolsCharm(unittest.TestCase):
                              _run_infinihost_check,
                              _set_lvm_conf_global_filter,
                              _get_default_repo_key, lsb_release, apt_install,
-                             apt_update, add_source):
+                             apt_update, add_source, installed_versions):
+        _run_infinihost_check.return_value = InfinihostReport(0, [])
 
         dynamic_source = self._get_source('{distrib_codename}', 'main')
 
@@ -116,42 +158,110 @@ class TestInfinidatToolsCharm(unittest.TestCase):
             add_source.assert_called_with(i[2], KEY)
             apt_install.assert_called_with(self.harness.charm.PACKAGES,
                                            fatal=True)
+            self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    @mock.patch('src.charm.installed_versions')
+    @mock.patch('charmhelpers.fetch.add_source')
+    @mock.patch('charmhelpers.fetch.apt_update')
+    @mock.patch('charmhelpers.fetch.apt_install')
+    @mock.patch('charmhelpers.core.host.lsb_release')
+    @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
+    def test_install_pkgs_skips_apt(self, _update_multipath_conf,
+                                    _set_lvm_conf_global_filter,
+                                    lsb_release, apt_install,
+                                    apt_update, add_source,
+                                    installed_versions):
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'focal'}
+        installed_versions.return_value = {}
+        self.harness.update_config({
+            'install_sources': self._get_source('{distrib_codename}', 'main'),
+            'install_keys': KEY,
+        })
+        add_source.assert_called_once_with(
+            self._get_source('focal', 'main'), KEY)
+        apt_update.assert_called_once_with(fatal=True)
+        apt_install.assert_called_once_with(self.harness.charm.PACKAGES,
+                                            fatal=True)
+
+        # same source and key, packages installed: no apt work at all
+        for m in (add_source, apt_update, apt_install):
+            m.reset_mock()
+        installed_versions.return_value = {
+            'host-power-tools': '7.3.0.0',
+            'scsitools': '0.12-3',
+            'multipath-tools-boot': '0.8.3-1',
+        }
+        self.harness.charm.install_pkgs()
+        add_source.assert_not_called()
+        apt_update.assert_not_called()
+        apt_install.assert_not_called()
+
+        # version pin: only the pinned package is installed, from the
+        # already configured source
+        self.harness.update_config({'host_power_tools_version': '7.4.0.0'})
+        add_source.assert_not_called()
+        apt_update.assert_not_called()
+        apt_install.assert_called_once_with(['host-power-tools=7.4.0.0'],
+                                            fatal=True)
+
+        # package lists are refreshed if the install fails
+        apt_install.reset_mock()
+        apt_install.side_effect = [
+            subprocess.CalledProcessError(100, 'apt-get'), None]
+        self.harness.charm.install_pkgs()
+        apt_update.assert_called_once_with(fatal=True)
+        self.assertEqual(apt_install.call_count, 2)
 
     @mock.patch('subprocess.Popen')
-    @mock.patch('subprocess.Popen.communicate')
-    @mock.patch('subprocess.Popen.wait')
-    def test_infinibox_settings_check(self, pwait, pcomm, popen):
+    def test_infinibox_settings_check(self, popen):
         """
         Test basic functionality of _run_infinihost:
         1. Check that method properly handles absense of infinihost
-        2. Check subprocess.PIPE
-        3. Check redirect to file
+        2. Check that output is parsed into per-check results
+        3. Check that output is copied to a file
         4. Check return code 0 1 2
         """
-        with open('unit_tests/infinibox-sample.txt') as f:
+        with open('unit_tests/infinibox-sample.txt', 'rb') as f:
             data = f.read()
 
-        pcomm.return_value = (data, '')
-        pwait.return_value = 2
-
         class p:
             def __init__(self):
-                self.communicate = pcomm
-                self.wait = pwait
+                self.stdout = BytesIO(data)
+                self.wait = mock.MagicMock(return_value=2)
 
         popen.return_value = p()
 
-        code = self.harness.charm.\
-            _run_infinihost_check(auto_fix=False, stdout=subprocess.PIPE)
-        pwait.assert_called_with()
-        self.assertEqual(code, 2)
-
-        # test redirection to a file
-        f = '123'
-        self.harness.charm._run_infinihost_check(auto_fix=True, stdout=f)
+        progress = mock.MagicMock()
+        report = self.harness.charm.\
+            _run_infinihost_check(auto_fix=False, progress=progress)
+        popen.assert_called_with([
+            'infinihost', 'settings', 'check'],
+            stdout=subprocess.PIPE, shell=False, env=mock.ANY,
+            start_new_session=True)
+        self.assertEqual(report.code, 2)
+        self.assertEqual(report.counts, {'ok': 14, 'fail': 1, 'skip': 11})
+        self.assertEqual(progress.call_count, 26)
+        failure = report.failures[0]
+        self.assertEqual(failure.category, 'Multipath')
+        self.assertEqual(failure.check,
+                         'Checking that multipath-tools is running.')
+        self.assertFalse(failure.fix_applied)
+        self.assertEqual(failure.reason,
+                         'FAILURE: service multipath-tools is not running')
+        self.assertEqual(
+            failure.kb_link,
+            'https://support.infinidat.com/hc/articles/202404141')
+
+        # test copying the raw output to a file
+        popen.return_value = p()
+        f = BytesIO()
+        self.harness.charm._run_infinihost_check(auto_fix=True, outfile=f)
         popen.assert_called_with([
             'infinihost', 'settings', 'check', '--auto-fix'],
-            stdout=f, shell=mock.ANY, env=mock.ANY)
+            stdout=subprocess.PIPE, shell=False, env=mock.ANY,
+            start_new_session=True)
+        self.assertEqual(f.getvalue(), data)
 
         # make sure the missing infinihost is handled with re-raise
         popen.side_effect = FileNotFoundError(
@@ -160,10 +270,11 @@ class TestInfinidatToolsCharm(unittest.TestCase):
         self.assertRaises(FileNotFoundError,
                           self.harness.charm._run_infinihost_check)
 
-    @mock.patch('src.charm.add_source')
-    @mock.patch('src.charm.apt_update')
-    @mock.patch('src.charm.apt_install')
-    @mock.patch('src.charm.lsb_release')
+    @mock.patch('src.charm.installed_versions', return_value={})
+    @mock.patch('charmhelpers.fetch.add_source')
+    @mock.patch('charmhelpers.fetch.apt_update')
+    @mock.patch('charmhelpers.fetch.apt_install')
+    @mock.patch('charmhelpers.core.host.lsb_release')
     @mock.patch('src.charm.InfinidatToolsCharm._get_default_repo_key')
     @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
     @mock.patch('src.charm.InfinidatToolsCharm._run_infinihost_check')
@@ -173,37 +284,238 @@ class TestInfinidatToolsCharm(unittest.TestCase):
                              _run_infinihost_check,
                              _set_lvm_conf_global_filter,
                              _get_default_repo_key, lsb_release,
-                             apt_install, apt_update, add_source):
+                             apt_install, apt_update, add_source,
+                             installed_versions):
         _get_default_repo_key.return_value = KEY
+        _run_infinihost_check.return_value = InfinihostReport(0, [])
         self.harness.update_config({
-            'install_sources': self._get_source('focal', 'main')
+            'install_sources': self._get_source('focal', 'main'),
+            'install_keys': '',
         })
         self.harness.charm.on.install.emit()
         add_source.assert_called_with(self._get_source('focal', 'main'), KEY)
+        _get_default_repo_key.assert_called_once_with()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
 
-    def test_multipath_config_patching(self):
-        pass
+        # the default key is not looked up if it is not going to be used
+        _get_default_repo_key.reset_mock()
+        self.harness.update_config({'install_sources': 'ppa:infinidat/ppa'})
+        self.harness.charm.on.install.emit()
+        add_source.assert_called_with('ppa:infinidat/ppa', None)
+        _get_default_repo_key.assert_not_called()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+        self.harness.update_config({
+            'install_sources': self._get_source('focal', 'main'),
+            'install_keys': 'configured key',
+        })
+        self.harness.charm.on.install.emit()
+        add_source.assert_called_with(self._get_source('focal', 'main'),
+                                      'configured key')
+        _get_default_repo_key.assert_not_called()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
 
+    @mock.patch('src.charm.InfinidatToolsCharm.install_pkgs')
     @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
-    def test_on_config_changed(self, _set_lvm_conf_global_filter):
+    @mock.patch('subprocess.check_output')
+    @mock.patch('charmhelpers.core.host.service_restart')
+    def test_multipath_config_rendering(self, service_restart,
+                                        check_output,
+                                        _set_lvm_conf_global_filter,
+                                        install_pkgs):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        multipath_conf = os.path.join(tmpdir, 'multipath.conf')
+        with open(multipath_conf, 'w') as f:
+            f.write('defaults {\n'
+                    '    user_friendly_names yes\n'
+                    '    skip_kpartx no\n'
+                    '}\n'
+                    'blacklist {\n'
+                    '    wwid "36005076305ffc08a0000000000000001"\n'
+                    '}\n')
+
+        with mock.patch('src.charm.MULTIPATH_CONF', multipath_conf):
+            # the running configuration is unknown: restart
+            self.harness.charm._update_multipath_conf()
+            with open(multipath_conf) as f:
+                data = f.read()
+            self.assertIn('    user_friendly_names no\n', data)
+            self.assertIn('    skip_kpartx yes\n', data)
+            self.assertIn('        path_selector "round-robin 0"\n', data)
+            self.assertIn('        no_path_retry "queue"\n', data)
+            self.assertTrue(data.endswith(
+                '}\n'
+                'blacklist {\n'
+                '    wwid "36005076305ffc08a0000000000000001"\n'
+                '}\n'))
+            service_restart.assert_called_once_with('multipathd')
+            check_output.assert_not_called()
+
+            # nothing changed: no write, no restart
+            service_restart.reset_mock()
+            with mock.patch('confutils.atomic_write') as atomic_write:
+                self.harness.charm._update_multipath_conf()
+            atomic_write.assert_not_called()
+            service_restart.assert_not_called()
+            check_output.assert_not_called()
+
+            # tunables are applied with a live reconfigure
+            check_output.return_value = 'ok\n'
+            self.harness.update_config({
+                'multipath_path_selector': 'service-time 0',
+                'multipath_rr_min_io_rq': 4,
+            })
+            with open(multipath_conf) as f:
+                data = f.read()
+            self.assertIn('        path_selector "service-time 0"\n', data)
+            self.assertIn('        rr_min_io_rq 4\n', data)
+            self.assertIn('blacklist {\n', data)
+            check_output.assert_called_once_with(
+                ['multipathd', 'reconfigure'], stderr=subprocess.STDOUT,
+                universal_newlines=True)
+            service_restart.assert_not_called()
+
+            self.harness.update_config({
+                'multipath_path_selector': 'random',
+            })
+            self.assertIsInstance(self.harness.model.unit.status,
+                                  BlockedStatus)
+
+    @mock.patch('subprocess.check_output')
+    @mock.patch('charmhelpers.core.host.service_restart')
+    def test_apply_multipath_conf(self, service_restart, check_output):
+        running = ('defaults {\n'
+                   '    max_fds 8192\n'
+                   '}\n'
+                   'devices {\n'
+                   '    device {\n'
+                   '        vendor "NFINIDAT"\n'
+                   '        product "InfiniBox.*"\n'
+                   '        path_selector "round-robin 0"\n'
+                   '    }\n'
+                   '}\n')
+
+        # comments only
+        self.harness.charm._apply_multipath_conf(running, running + '# x\n')
+        check_output.assert_not_called()
+        service_restart.assert_not_called()
+
+        # device settings are applied live
+        check_output.return_value = 'ok\n'
+        new = running.replace('round-robin 0', 'service-time 0')
+        self.harness.charm._apply_multipath_conf(running, new)
+        check_output.assert_called_once_with(
+            ['multipathd', 'reconfigure'], stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        service_restart.assert_not_called()
+
+        # falls back to a restart if reconfigure fails
+        check_output.return_value = 'fail\n'
+        self.harness.charm._apply_multipath_conf(running, new)
+        service_restart.assert_called_once_with('multipathd')
+
+        # max_fds is only read at startup
+        check_output.reset_mock()
+        service_restart.reset_mock()
+        self.harness.charm._apply_multipath_conf(
+            running, running.replace('8192', '4096'))
+        check_output.assert_not_called()
+        service_restart.assert_called_once_with('multipathd')
+
+    @mock.patch('subprocess.check_call')
+    @mock.patch('initrd.target_kernels')
+    @mock.patch('initrd.inputs_fingerprint')
+    @mock.patch('initrd.boots_from_san')
+    def test_regenerate_initrd(self, boots_from_san, inputs_fingerprint,
+                               target_kernels, check_call):
+        inputs_fingerprint.return_value = 'fp1'
+        target_kernels.return_value = ['5.4.0-100-generic']
+
+        # not booting from SAN
+        boots_from_san.return_value = False
+        self.harness.charm._regenerate_initrd()
+        check_call.assert_not_called()
+
+        boots_from_san.return_value = True
+        self.assertTrue(self.harness.charm._regenerate_initrd())
+        check_call.assert_called_once_with(
+            ['update-initramfs', '-u', '-k', '5.4.0-100-generic'])
+
+        # configuration did not change
+        check_call.reset_mock()
+        self.assertTrue(self.harness.charm._regenerate_initrd())
+        check_call.assert_not_called()
+
+        inputs_fingerprint.return_value = 'fp2'
+        check_call.side_effect = subprocess.CalledProcessError(1, 'cmd')
+        self.assertFalse(self.harness.charm._regenerate_initrd())
+        self.assertEqual(self.harness.model.unit.status,
+                         BlockedStatus('error regenerating initrd'))
+        # failed regeneration is retried next time
+        self.assertEqual(self.harness.charm._stored.initrd_fingerprint, 'fp1')
+
+        # a forced rebuild is retried until it succeeds, even when the
+        # fingerprint no longer changes
+        inputs_fingerprint.return_value = 'fp1'
+        self.harness.charm._stored.initrd_rebuild_forced = True
+        self.assertFalse(self.harness.charm._regenerate_initrd())
+        self.assertTrue(self.harness.charm._stored.initrd_rebuild_forced)
+        check_call.reset_mock()
+        check_call.side_effect = None
+        self.assertTrue(self.harness.charm._regenerate_initrd())
+        check_call.assert_called_once_with(
+            ['update-initramfs', '-u', '-k', '5.4.0-100-generic'])
+        self.assertIsNone(self.harness.charm._stored.initrd_rebuild_forced)
+        inputs_fingerprint.return_value = 'fp2'
+        check_call.side_effect = subprocess.CalledProcessError(1, 'cmd')
+
+        # config changes rewriting the initrd inputs regenerate it, the
+        # failure is not hidden by the status of the other settings
+        with mock.patch('src.charm.InfinidatToolsCharm.install_pkgs'), \
+                mock.patch('src.charm.InfinidatToolsCharm.'
+                           '_update_multipath_conf'), \
+                mock.patch('src.charm.InfinidatToolsCharm.'
+                           '_set_lvm_conf_global_filter'):
+            self.harness.update_config({'lvm_global_filter': ''})
+            self.assertEqual(self.harness.model.unit.status,
+                             BlockedStatus('error regenerating initrd'))
+
+            check_call.reset_mock()
+            check_call.side_effect = None
+            inputs_fingerprint.return_value = 'fp3'
+            self.harness.update_config({'lvm_global_filter': '[ "r|.*|" ]'})
+            check_call.assert_called_once_with(
+                ['update-initramfs', '-u', '-k', '5.4.0-100-generic'])
+            self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    @mock.patch('src.charm.InfinidatToolsCharm.install_pkgs')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
+    @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
+    def test_on_config_changed(self, _set_lvm_conf_global_filter,
+                               _update_multipath_conf, install_pkgs):
         """
-        Make sure that LVM configuration update is called
+        Make sure that multipath and LVM configuration updates are called
         in on_config() handler
         """
         self.harness.update_config({
             'install_sources': self._get_source('focal', 'main')
         })
+        install_pkgs.assert_called_with()
+        _update_multipath_conf.assert_called_with()
         _set_lvm_conf_global_filter.assert_called_with(
-            self.harness.model.config.get('lvm_global_filter'))
+            self.harness.model.config.get('lvm_global_filter'),
+            use_devicesfile='')
 
         self.assertTrue(isinstance(
             self.harness.model.unit.status, ActiveStatus
         ))
 
-    @mock.patch('src.charm.add_source')
-    @mock.patch('src.charm.apt_update')
-    @mock.patch('src.charm.apt_install')
-    @mock.patch('src.charm.lsb_release')
+    @mock.patch('src.charm.installed_versions', return_value={})
+    @mock.patch('charmhelpers.fetch.add_source')
+    @mock.patch('charmhelpers.fetch.apt_update')
+    @mock.patch('charmhelpers.fetch.apt_install')
+    @mock.patch('charmhelpers.core.host.lsb_release')
     @mock.patch('src.charm.InfinidatToolsCharm._get_default_repo_key')
     @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
     @mock.patch('src.charm.InfinidatToolsCharm._run_infinihost_check')
@@ -214,7 +526,8 @@ class TestInfinidatToolsCharm(unittest.TestCase):
                                 _run_infinihost_check,
                                 _set_lvm_conf_global_filter,
                                 _get_default_repo_key, lsb_release,
-                                apt_install, apt_update, add_source):
+                                apt_install, apt_update, add_source,
+                                installed_versions):
         """
         Make sure on_install() handler does all necessary stuff:
         1. Calls infinihost with autofix
@@ -223,6 +536,7 @@ class TestInfinidatToolsCharm(unittest.TestCase):
         4. Sets status to Active if ok
         5. Sets status to Blocked if it fails
         """
+        _run_infinihost_check.return_value = InfinihostReport(0, [])
         self.harness.update_config({
             'install_sources': self._get_source('focal', 'main')
         })
@@ -231,11 +545,18 @@ class TestInfinidatToolsCharm(unittest.TestCase):
         _run_infinihost_check.assert_called_with(auto_fix=True)
         _update_multipath_conf.assert_called_with()
         _set_lvm_conf_global_filter.assert_called_with(
-            self.harness.model.config.get('lvm_global_filter'))
+            self.harness.model.config.get('lvm_global_filter'),
+            use_devicesfile='')
+
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+        _run_infinihost_check.return_value = InfinihostReport(1, [
+            CheckResult('Multipath', 'Checking global parameters', 'fail')])
+        self.harness.charm.on.install.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus('infinihost: 1 failed check(s) (Multipath)'))
 
-        self.assertTrue(isinstance(
-            self.harness.model.unit.status, ActiveStatus
-        ))
         _run_infinihost_check.side_effect = FileNotFoundError(
             "[Errno 2] No such file or directory: 'infinihost'"
         )
@@ -246,77 +567,142 @@ class TestInfinidatToolsCharm(unittest.TestCase):
             self.harness.model.unit.status, BlockedStatus
         ))
 
-    @mock.patch('builtins.open')
-    def test_lvm_config_patching(self, _open):
-
-        tpl = r"""# Configuration option devices/global_filter.
-# Limit the block devices that are used by LVM system components.
-# Because devices/filter may be overridden from the command line, it is
-# not suitable for system-wide device filtering, e.g. udev.
-# Use global_filter to hide devices from these LVM system components.
-# The syntax is the same as devices/filter. Devices rejected by
-# global_filter are not opened by LVM.
-# This configuration option has an automatic default value.
-# global_filter = [ "a|.*|" ]{0}
-# other contents
+        # invalid settings block the unit until the config is fixed
+        _run_infinihost_check.side_effect = None
+        _regenerate_initrd.reset_mock()
+        with mock.patch('src.charm.InfinidatToolsCharm._update_queue_settings',
+                        side_effect=ValueError('rq_affinity must be 0, 1 '
+                                               'or 2')), \
+                mock.patch('ops.framework.EventBase.defer') as defer:
+            self.harness.charm.on.install.emit()
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(
+            'invalid queue config: rq_affinity must be 0, 1 or 2'))
+        defer.assert_not_called()
+        _regenerate_initrd.assert_not_called()
+
+    def test_lvm_config_patching(self):
+
+        tpl = """config {{
+\tchecks = 1
+}}
+devices {{
+\t# Configuration option devices/global_filter.
+\t# Limit the block devices that are used by LVM system components.
+\t# Because devices/filter may be overridden from the command line, it is
+\t# not suitable for system-wide device filtering, e.g. udev.
+\t# Use global_filter to hide devices from these LVM system components.
+\t# The syntax is the same as devices/filter. Devices rejected by
+\t# global_filter are not opened by LVM.
+\t# This configuration option has an automatic default value.
+\t# global_filter = [ "a|.*|" ]{0}
+\t# other contents
+\tfilter = [ "a|.*|" ]
+}}
 """
         input_data = tpl.format('')
 
         value = '[ "a|^/dev/sd.*|", "a|^/dev/vd.*|", "r|.*|" ]'
         updated_data = tpl.format(
-            '\nglobal_filter = ' + value +
+            '\n\tglobal_filter = ' + value +
             ' # __infinidat_tools__'
         )
 
-        self.maxDiff = 1000
+        self.maxDiff = 2000
+        value2 = '[ "a|^/dev/sd.*|", "r|.*|" ]'
         updated_data2 = tpl.format(
-            '\nglobal_filter = ' + value +
-            ' 2 # __infinidat_tools__'
+            '\n\tglobal_filter = ' + value2 +
+            ' # __infinidat_tools__'
         )
 
-        class fake_fh:
-            def __init__(self, expected):
-                self.buf = StringIO(expected)
-                self.newbuf = StringIO('')
-                self.readlines = self.buf.readlines
-                self.read = self.buf.read
-                self.write = self.newbuf.write
-
-            def __enter__(self, *args, **kwargs):
-                return self
-
-            def __exit__(self, *args, **kwargs):
-                pass
-
-        d = fake_fh(input_data)
-        _open.return_value = d
-
-        self.harness.charm._set_lvm_conf_global_filter(value)
-
-        self.assertEqual(d.newbuf.getvalue(), updated_data)
-
-        d = fake_fh(d.newbuf.getvalue())
-        _open.return_value = d
-
-        self.harness.charm._set_lvm_conf_global_filter(value + ' 2')
-
-        self.assertEqual(d.newbuf.getvalue(), updated_data2)
-
-        d = fake_fh(updated_data)
-        _open.return_value = d
-        self.harness.charm._set_lvm_conf_global_filter('')
-
-        self.assertEqual(d.newbuf.getvalue(), input_data)
-
-        d = fake_fh(input_data)
-        _open.return_value = d
-        self.harness.charm._set_lvm_conf_global_filter('')
-
-        self.assertEqual(d.newbuf.getvalue(), input_data)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        lvm_conf = os.path.join(tmpdir, 'lvm.conf')
+
+        def check(initial, new_filter, expected, written=True,
+                  use_devicesfile=''):
+            if initial is not None:
+                with open(lvm_conf, 'w') as f:
+                    f.write(initial)
+            mtime = os.stat(lvm_conf).st_mtime_ns
+            with mock.patch('confutils.atomic_write',
+                            wraps=confutils.atomic_write) as atomic_write:
+                self.assertTrue(self.harness.charm._set_lvm_conf_global_filter(
+                    new_filter, lvm_conf=lvm_conf,
+                    use_devicesfile=use_devicesfile))
+            with open(lvm_conf) as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(atomic_write.called, written)
+            if not written:
+                self.assertEqual(os.stat(lvm_conf).st_mtime_ns, mtime)
+
+        check(input_data, value, updated_data)
+        check(None, value2, updated_data2)
+        # unchanged content is not rewritten
+        check(None, value2, updated_data2, written=False)
+        check(updated_data, '', input_data)
+        check(input_data, '', input_data, written=False)
+
+        # the commented default is missing
+        no_comment = 'devices {\n\tfilter = [ "a|.*|" ]\n}\n'
+        check(no_comment, value,
+              'devices {\n\tfilter = [ "a|.*|" ]\n'
+              '\tglobal_filter = ' + value + ' # __infinidat_tools__\n'
+              '\tuse_devicesfile = 0 # __infinidat_tools__\n}\n',
+              use_devicesfile='0')
+        # ... and so is the devices section
+        check('# empty\n', value,
+              '# empty\ndevices {\n'
+              '\tglobal_filter = ' + value + ' # __infinidat_tools__\n}\n')
+
+        # a multi-line filter set by hand is replaced
+        check('devices {\n\tglobal_filter = [\n\t\t"a|.*|", # all\n\t]\n}\n',
+              value,
+              'devices {\n'
+              '\tglobal_filter = ' + value + ' # __infinidat_tools__\n}\n')
+
+        with open(lvm_conf, 'w') as f:
+            f.write('devices {\n\tglobal_filter = [ "a|.*|"\n')
+        self.assertFalse(self.harness.charm._set_lvm_conf_global_filter(
+            value, lvm_conf=lvm_conf))
+        self.assertEqual(self.harness.model.unit.status,
+                         BlockedStatus('Failed to update lvm.conf'))
+
+    @mock.patch('src.charm.generated_filter')
+    @mock.patch('src.charm.pv_devices')
+    def test_lvm_generated_filter(self, pv_devices, generated_filter):
+        generated_filter.return_value = '[ "r|.*|" ]'
+        with self.harness.hooks_disabled():
+            self.harness.update_config({'lvm_generate_filter': True})
+        self.harness.charm._storage_topology = StorageTopology([], [
+            DmDevice('dm-0', 'mpatha', 'mpath-36742b0f000001', '', ['sdb']),
+            DmDevice('dm-1', 'vg-root', 'LVM-abc', '', ['dm-0'])])
+
+        # the PVs are accepted, active or not
+        pv_devices.return_value = ['sda2']
+        self.assertEqual(self.harness.charm._lvm_global_filter(),
+                         '[ "r|.*|" ]')
+        self.assertEqual(generated_filter.call_args[1]['pvs'],
+                         ['dm-0', 'sda2'])
+
+        # without the full list of PVs the active ones are kept visible
+        pv_devices.side_effect = subprocess.CalledProcessError(5, 'pvs')
+        self.assertEqual(self.harness.charm._lvm_global_filter(),
+                         '[ "r|.*|" ]')
+        self.assertEqual(generated_filter.call_args[1]['pvs'], ['dm-0'])
+
+        # ... unless the filter would end up in the initrd
+        generated_filter.reset_mock()
+        with mock.patch('initrd.boots_from_san', return_value=True):
+            self.assertIsNone(self.harness.charm._lvm_global_filter())
+        generated_filter.assert_not_called()
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(
+            'lvm filter not generated: failed to list the PVs'))
 
     def check_contents(self):
         pass
 
+    @mock.patch('src.charm.ResultsStore')
+    @mock.patch('src.charm.InfinidatToolsCharm._infinihost_fingerprint')
     @mock.patch('src.charm.InfinidatToolsCharm._run_infinihost_check')
     @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
     @mock.patch('tempfile.NamedTemporaryFile')
@@ -324,14 +710,19 @@ class TestInfinidatToolsCharm(unittest.TestCase):
     @mock.patch('pathlib.Path.chmod')
     def test_action_outfile_created(self, p, mkdir, ntf,
                                     _update_multipath_conf,
-                                    _run_infinihost_check):
+                                    _run_infinihost_check,
+                                    _infinihost_fingerprint,
+                                    ResultsStore):
+        _infinihost_fingerprint.return_value = 'fp'
 
         action_event = mock.MagicMock()
         action_event.params = {"auto-fix": "True"}
 
         class fake_ntf:
             def __init__(self, *args, **kwargs):
-                self.name = 'fake named temporary file'
+                # NamedTemporaryFile names are absolute
+                self.name = os.path.join(INFINIHOST_RESULTS_DIR,
+                                         'infinihost-out-fake')
 
             def __enter__(self, *args, **kwargs):
                 return self
@@ -342,10 +733,28 @@ class TestInfinidatToolsCharm(unittest.TestCase):
         ntf_i = fake_ntf()
 
         ntf.return_value = ntf_i
+        _run_infinihost_check.return_value = InfinihostReport(1, [
+            CheckResult('Multipath', 'Checking global parameters', 'skip',
+                        reason='SKIP: Multipath Daemon must be running',
+                        kb_link='https://support.infinidat.com/hc/1'),
+            CheckResult('SCSI', 'Checking that parted is installed', 'ok'),
+        ])
 
         self.harness.charm.on_run_infinidat_settings_check_action(action_event)
 
-        _run_infinihost_check.assert_called_with(auto_fix=True, stdout=ntf_i)
+        _run_infinihost_check.assert_called_with(
+            auto_fix=True, outfile=ntf_i, progress=mock.ANY)
+        ResultsStore.return_value.add.assert_called_with(
+            os.path.join(INFINIHOST_RESULTS_DIR, 'infinihost-out-fake'),
+            _run_infinihost_check.return_value)
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(results['exit-code'], 1)
+        self.assertEqual(results['summary'], {'ok': 1, 'fail': 0, 'skip': 1})
+        self.assertEqual(
+            results['details'],
+            'Multipath: Checking global parameters: '
+            'SKIP: Multipath Daemon must be running '
+            '(https://support.infinidat.com/hc/1)')
 
         ntf.assert_called_with(mode="w+b", prefix="infinihost-out-",
                                dir=INFINIHOST_RESULTS_DIR, delete=False)
@@ -356,4 +765,621 @@ class TestInfinidatToolsCharm(unittest.TestCase):
 
         self.harness.charm.on_run_infinidat_settings_check_action(action_event)
 
-        _run_infinihost_check.assert_called_with(auto_fix=False, stdout=ntf_i)
+        _run_infinihost_check.assert_called_with(
+            auto_fix=False, outfile=ntf_i, progress=mock.ANY)
+
+    @mock.patch('src.charm.ResultsStore')
+    @mock.patch('src.charm.InfinidatToolsCharm._infinihost_fingerprint')
+    @mock.patch('src.charm.InfinidatToolsCharm._run_infinihost_check')
+    @mock.patch('tempfile.NamedTemporaryFile')
+    @mock.patch('pathlib.Path.mkdir')
+    @mock.patch('pathlib.Path.chmod')
+    def test_action_cached_results(self, chmod, mkdir, ntf,
+                                   _run_infinihost_check,
+                                   _infinihost_fingerprint, ResultsStore):
+        ntf.return_value.__enter__.return_value.name = '/tmp/out'
+        _infinihost_fingerprint.return_value = 'fp1'
+        _run_infinihost_check.return_value = InfinihostReport(0, [
+            CheckResult('SCSI', 'Checking that parted is installed', 'ok')])
+
+        action_event = mock.MagicMock()
+        action_event.params = {'cached': True}
+
+        # nothing cached yet
+        self.harness.charm.on_run_infinidat_settings_check_action(
+            action_event)
+        self.assertEqual(_run_infinihost_check.call_count, 1)
+
+        # served from the cache
+        self.harness.charm.on_run_infinidat_settings_check_action(
+            action_event)
+        self.assertEqual(_run_infinihost_check.call_count, 1)
+        results = action_event.set_results.call_args[0][0]
+        self.assertTrue(results['cached'])
+        self.assertEqual(results['summary'], {'ok': 1, 'fail': 0, 'skip': 0})
+
+        # forced run
+        action_event.params = {'cached': True, 'force': True}
+        self.harness.charm.on_run_infinidat_settings_check_action(
+            action_event)
+        self.assertEqual(_run_infinihost_check.call_count, 2)
+
+        # host state changed
+        action_event.params = {'cached': True}
+        _infinihost_fingerprint.return_value = 'fp2'
+        self.harness.charm.on_run_infinidat_settings_check_action(
+            action_event)
+        self.assertEqual(_run_infinihost_check.call_count, 3)
+
+        # expired
+        with mock.patch('time.time', return_value=time.time() + 7200):
+            self.harness.charm.on_run_infinidat_settings_check_action(
+                action_event)
+        self.assertEqual(_run_infinihost_check.call_count, 4)
+
+    @mock.patch('src.charm.ResultsStore')
+    def test_list_infinihost_results_action(self, ResultsStore):
+        ResultsStore.return_value.entries.return_value = [
+            {'file': 'infinihost-out-1.gz', 'timestamp': 0,
+             'exit-code': None, 'summary': None},
+            {'file': 'infinihost-out-2', 'timestamp': 3600,
+             'exit-code': 1, 'summary': {'ok': 14, 'fail': 1, 'skip': 11}},
+        ]
+        action_event = mock.MagicMock()
+        action_event.params = {'limit': 20}
+
+        self.harness.charm.on_list_infinihost_results_action(action_event)
+
+        action_event.set_results.assert_called_with({
+            'count': 2,
+            'results':
+                '1970-01-01T01:00:00Z exit-code=1 ok=14 fail=1 skip=11 '
+                '{0}/infinihost-out-2\n'
+                '1970-01-01T00:00:00Z exit-code=None ok=- fail=- skip=- '
+                '{0}/infinihost-out-1.gz'.format(INFINIHOST_RESULTS_DIR),
+        })
+
+    @mock.patch('src.charm.InfinidatToolsCharm._complete_infinihost_run')
+    @mock.patch('src.charm.start_job')
+    @mock.patch('src.charm.running_jobs')
+    @mock.patch('src.charm.job_status')
+    @mock.patch('pathlib.Path.mkdir')
+    def test_background_action(self, mkdir, job_status, running_jobs,
+                               start_job, _complete_infinihost_run):
+        running_jobs.return_value = []
+        action_event = mock.MagicMock()
+        action_event.params = {'background': True}
+
+        self.harness.charm.on_run_infinidat_settings_check_action(
+            action_event)
+        job_id = start_job.call_args[0][1]
+        start_job.assert_called_once_with(
+            INFINIHOST_JOBS_DIR, job_id, auto_fix=False, timeout=1800)
+        self.assertEqual(action_event.set_results.call_args[0][0]['job-id'],
+                         job_id)
+
+        # a job is already running
+        running_jobs.return_value = ['other']
+        self.harness.charm.on_run_infinidat_settings_check_action(
+            action_event)
+        start_job.assert_called_once()
+        self.assertEqual(action_event.set_results.call_args[0][0]['job-id'],
+                         'other')
+
+        action_event = mock.MagicMock()
+        action_event.params = {'job-id': job_id}
+
+        job_status.return_value = ('running', InfinihostReport(None, [
+            CheckResult('SCSI', 'Checking that parted is installed', 'ok')]))
+        self.harness.charm.on_get_infinihost_result_action(action_event)
+        self.assertEqual(action_event.set_results.call_args[0][0]['state'],
+                         'running')
+        _complete_infinihost_run.assert_not_called()
+
+        job_status.return_value = ('unknown', None)
+        self.harness.charm.on_get_infinihost_result_action(action_event)
+        action_event.fail.assert_called_once()
+
+        report = InfinihostReport(0, [])
+        job_status.return_value = ('done', {'auto-fix': True,
+                                            'report': report.to_dict()})
+        with mock.patch('src.charm.remove_job') as remove_job:
+            self.harness.charm.on_get_infinihost_result_action(action_event)
+        remove_job.assert_called_once_with(INFINIHOST_JOBS_DIR, job_id)
+        _complete_infinihost_run.assert_called_once_with(
+            action_event, report,
+            os.path.join(INFINIHOST_RESULTS_DIR,
+                         'infinihost-out-{0}'.format(job_id)), True)
+
+    @mock.patch.dict(os.environ, {'JUJU_HOOK_NAME': 'config-changed'})
+    def test_show_timings_action(self):
+        # nothing timed, nothing recorded
+        self.harness.charm._record_timings(None)
+        self.assertIsNone(self.harness.charm._stored.hook_timings)
+
+        for wall in (2, 40):
+            self.harness.charm._timings.phases = {
+                'apt-update': [wall, 1], 'lvm-conf': [0.01, 0]}
+            self.harness.charm._record_timings(None)
+        self.assertEqual(self.harness.charm._timings.phases, {})
+
+        action_event = mock.MagicMock()
+        action_event.params = {'runs': 10}
+        with mock.patch('time.gmtime', return_value=time.gmtime(0)):
+            self.harness.charm.on_show_timings_action(action_event)
+
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(results['count'], 2)
+        self.assertEqual(
+            results['runs'].splitlines()[0],
+            '1970-01-01T00:00:00Z config-changed '
+            'apt-update=40.00s lvm-conf=0.01s')
+        self.assertEqual(results['phases']['apt-update']['max'], 40)
+
+        action_event.params = {'runs': 10, 'hook': 'install'}
+        self.harness.charm.on_show_timings_action(action_event)
+        action_event.set_results.assert_called_with({'count': 0, 'runs': ''})
+
+    @mock.patch('pathmetrics.write_metrics')
+    @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
+    @mock.patch('src.charm.InfinidatToolsCharm.install_pkgs')
+    def test_metrics_collector(self, install_pkgs, _update_multipath_conf,
+                               _set_lvm_conf_global_filter, write_metrics):
+        cron = os.path.join(self.tmpdir, 'metrics-cron')
+        textfile_dir = os.path.join(self.tmpdir, 'node-exporter')
+        textfile = os.path.join(textfile_dir, 'infinidat_multipath.prom')
+        rel_id = self.harness.add_relation('multipath-metrics',
+                                           'node-exporter')
+        self.harness.add_relation_unit(rel_id, 'node-exporter/0')
+
+        self.harness.update_config({'metrics_textfile_dir': textfile_dir,
+                                    'metrics_interval': 5})
+
+        with open(cron) as f:
+            entry = f.read().splitlines()[1]
+        self.assertTrue(entry.startswith('*/5 * * * * root '))
+        self.assertIn('src/pathmetrics.py {0} '.format(textfile), entry)
+        write_metrics.assert_called_once_with(textfile)
+        self.assertEqual(
+            self.harness.get_relation_data(rel_id, 'infinidat-tools/0'),
+            {'textfile': textfile, 'interval': '300'})
+
+        # nothing changed
+        open(textfile, 'w').close()
+        self.harness.charm._update_metrics_collector()
+        write_metrics.assert_called_once()
+
+        self.harness.update_config({'metrics_textfile_dir': ''})
+        self.assertFalse(os.path.exists(cron))
+        self.assertFalse(os.path.exists(textfile))
+        self.assertEqual(
+            self.harness.get_relation_data(rel_id, 'infinidat-tools/0'), {})
+
+        self.harness.update_config({'metrics_textfile_dir': textfile_dir,
+                                    'metrics_interval': 0})
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(
+            'invalid metrics config: interval must be between 1 and 59 '
+            'minutes'))
+        self.assertFalse(os.path.exists(cron))
+
+        # the collector does not outlive the unit
+        self.harness.update_config({'metrics_interval': 1})
+        self.assertTrue(os.path.exists(cron))
+        open(textfile, 'w').close()
+        self.harness.charm.on.stop.emit()
+        self.assertFalse(os.path.exists(cron))
+        self.assertFalse(os.path.exists(textfile))
+
+    @mock.patch('src.charm.StorageTopology.discover')
+    def test_quick_check_action(self, discover):
+        discover.return_value = StorageTopology([
+            ScsiDevice('1:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       'none', '32'),
+            ScsiDevice('2:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdc',
+                       'mq-deadline', '32'),
+        ], [DmDevice('dm-0', 'mpatha', 'mpath-1', 'none', ['sdb', 'sdc'])])
+        action_event = mock.MagicMock()
+        action_event.params = {'min-paths': 2}
+
+        self.harness.charm.on_quick_check_action(action_event)
+
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(results['result'], '1 failed check(s)')
+        self.assertEqual(results['summary'], {'ok': 3, 'fail': 1, 'skip': 0})
+        self.assertEqual(results['infinibox-luns'], 2)
+        self.assertEqual(results['multipath-devices'], 1)
+        self.assertIn('unexpected scheduler: sdc=mq-deadline',
+                      results['details'])
+
+        # the configured scheduler is expected
+        with self.harness.hooks_disabled():
+            self.harness.update_config({'queue_scheduler': 'mq-deadline'})
+        self.harness.charm.on_quick_check_action(action_event)
+        results = action_event.set_results.call_args[0][0]
+        self.assertIn('unexpected scheduler: sdb=none, mpatha=none',
+                      results['details'])
+
+    @mock.patch('src.charm.queue_mismatches')
+    @mock.patch('subprocess.check_call')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_metrics_collector')
+    @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
+    @mock.patch('src.charm.InfinidatToolsCharm.install_pkgs')
+    def test_queue_settings(self, install_pkgs, _update_multipath_conf,
+                            _set_lvm_conf_global_filter,
+                            _update_metrics_collector, check_call,
+                            queue_mismatches):
+        rules = os.path.join(self.tmpdir, 'queue.rules')
+        self.harness.update_config({'queue_nr_requests': '256'})
+        queue_mismatches.return_value = []
+        # written by config-changed, while there were no devices to trigger
+        with open(rules) as f:
+            self.assertIn('ATTR{queue/nr_requests}="256"', f.read())
+        os.unlink(rules)
+        # discovered again by the next hook
+        self.harness.charm._storage_topology = None
+
+        with mock.patch('src.charm.StorageTopology.discover') as discover:
+            discover.return_value = StorageTopology([
+                ScsiDevice('1:0:0:1', 'NFINIDAT', 'InfiniBox', 'running',
+                           'sdb', 'none', '32')], [])
+            self.assertEqual(self.harness.charm._update_queue_settings(), '')
+            check_call.assert_called_with(
+                ['udevadm', 'trigger', '--action=change', '--settle',
+                 '/sys/block/sdb'])
+            with open(rules) as f:
+                self.assertIn('ATTR{queue/nr_requests}="256"', f.read())
+
+            # rules did not change, settings are in effect
+            check_call.reset_mock()
+            self.harness.charm._update_queue_settings()
+            check_call.assert_not_called()
+
+            # settings drifted and could not be applied
+            queue_mismatches.return_value = [
+                'sdb: nr_requests=64 (expected 256)']
+            self.assertEqual(self.harness.charm._update_queue_settings(),
+                             'queue settings not applied on 1 device(s)')
+            self.assertEqual(check_call.call_count, 2)
+
+        self.harness.update_config({'queue_rq_affinity': '3'})
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(
+            'invalid queue config: rq_affinity must be 0, 1 or 2'))
+
+    @mock.patch('fchba.apply_lun_queue_depth')
+    @mock.patch('fchba.pending_options')
+    @mock.patch('src.charm.InfinidatToolsCharm._regenerate_initrd')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_queue_settings',
+                return_value='')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_metrics_collector')
+    @mock.patch('src.charm.InfinidatToolsCharm._set_lvm_conf_global_filter')
+    @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
+    @mock.patch('src.charm.InfinidatToolsCharm.install_pkgs')
+    def test_fc_settings(self, install_pkgs, _update_multipath_conf,
+                         _set_lvm_conf_global_filter,
+                         _update_metrics_collector, _update_queue_settings,
+                         _regenerate_initrd, pending_options,
+                         apply_lun_queue_depth):
+        modprobe_conf = os.path.join(self.tmpdir, 'fc.conf')
+        pending_options.return_value = []
+        apply_lun_queue_depth.return_value = []
+
+        # no FC HBA: only the driver options are written
+        self.harness.update_config({'fc_lun_queue_depth': '64'})
+        with open(modprobe_conf) as f:
+            self.assertIn('options lpfc lpfc_lun_queue_depth=64\n', f.read())
+        # only regenerated if the initrd inputs changed
+        _regenerate_initrd.assert_called_once_with()
+        _regenerate_initrd.reset_mock()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus(''))
+        # discovered again by the next hook
+        self.harness.charm._storage_topology = None
+
+        with mock.patch('fchba.fc_hosts', return_value={'3': 'lpfc'}), \
+                mock.patch('src.charm.StorageTopology.discover') as discover:
+            discover.return_value = StorageTopology([
+                ScsiDevice('3:0:0:1', 'NFINIDAT', 'InfiniBox', 'running',
+                           'sdb', 'none', '32'),
+                ScsiDevice('4:0:0:1', 'NFINIDAT', 'InfiniBox', 'running',
+                           'sdc', 'none', '32')], [])
+
+            # options did not change, the LUN behind the FC HBA is updated
+            self.assertEqual(self.harness.charm._update_fc_settings(), '')
+            _regenerate_initrd.assert_not_called()
+            luns = apply_lun_queue_depth.call_args[0][0]
+            self.assertEqual([lun.hcil for lun in luns], ['3:0:0:1'])
+
+            # options changed, the driver needs to be reloaded
+            pending_options.return_value = [
+                'lpfc: lpfc_hba_queue_depth=8192 (expected 4096)']
+            apply_lun_queue_depth.return_value = luns
+            self.harness.update_config({'fc_hba_queue_depth': '4096'})
+            # the HBA drivers are in the initrd, rebuilt once at the end
+            self.assertTrue(self.harness.charm._stored.initrd_rebuild_forced)
+            _regenerate_initrd.assert_called_once_with()
+            _regenerate_initrd.reset_mock()
+            self.harness.charm._stored.initrd_rebuild_forced = None
+            self.assertEqual(self.harness.model.unit.status, ActiveStatus(
+                'reboot required to apply FC HBA driver options'))
+
+            # settings removed
+            pending_options.return_value = []
+            self.harness.update_config({'fc_lun_queue_depth': '',
+                                        'fc_hba_queue_depth': ''})
+            self.assertFalse(os.path.exists(modprobe_conf))
+            self.assertTrue(self.harness.charm._stored.initrd_rebuild_forced)
+            _regenerate_initrd.assert_called_once_with()
+
+        self.harness.update_config({'fc_lun_queue_depth': '1024'})
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(
+            'invalid fc config: lun_queue_depth must be between 1 and 512'))
+
+    def test_storage_backend_summary(self):
+        rel = self.harness.add_relation('storage-backend', 'cinder')
+        self.harness.add_relation_unit(rel, 'cinder/0')
+        data = self.harness.get_relation_data(rel, 'infinidat-tools/0')
+        self.assertEqual(data['version'], '1')
+        self.assertEqual(data['ready'], 'true')
+        self.assertEqual(json.loads(data['summary'])['multipath'], {})
+
+        # nothing changed, the relation data is left alone
+        self.harness.update_relation_data(
+            rel, 'infinidat-tools/0', {'summary': 'unchanged'})
+        self.harness.charm._publish_backend_summary()
+        data = self.harness.get_relation_data(rel, 'infinidat-tools/0')
+        self.assertEqual(data['summary'], 'unchanged')
+
+        self.harness.charm.unit.status = BlockedStatus('Installation failed')
+        self.harness.charm._publish_backend_summary()
+        data = self.harness.get_relation_data(rel, 'infinidat-tools/0')
+        self.assertEqual(data['ready'], 'false')
+        self.assertEqual(json.loads(data['summary'])['reasons'],
+                         ['Installation failed'])
+
+    @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
+    def test_topology_discovered_once(self, _update_multipath_conf):
+        rel = self.harness.add_relation('storage-backend', 'cinder')
+        self.harness.add_relation_unit(rel, 'cinder/0')
+        self.harness.charm._stored.multipath_conf_digest = 'digest'
+        self.harness.charm._storage_topology = None
+        with mock.patch('src.charm.StorageTopology.discover',
+                        return_value=StorageTopology([], [])) as discover:
+            self.harness.charm.on.update_status.emit()
+        # shared by the wwids, blacklist and storage summary handlers
+        discover.assert_called_once_with()
+        _update_multipath_conf.assert_called_once_with()
+
+    @mock.patch('src.charm.InfinidatToolsCharm.on_config')
+    def test_rollout(self, on_config):
+        self.harness.update_config({'rollout_concurrency': 1,
+                                    'rollout_backoff': 0})
+        rel = self.harness.add_relation('cluster', 'infinidat-tools')
+        self.harness.add_relation_unit(rel, 'infinidat-tools/1')
+
+        # another unit gets the only grant
+        self.harness.update_relation_data(
+            rel, 'infinidat-tools/1', {'request': '000000000000001-a'})
+        grants = rollout.load_grants(
+            self.harness.get_relation_data(rel, 'infinidat-tools'))
+        self.assertEqual(list(grants), ['infinidat-tools/1'])
+
+        self.assertFalse(self.harness.charm._rollout_permits(
+            rollout.OP_MULTIPATHD_RESTART))
+        request = self.harness.get_relation_data(
+            rel, 'infinidat-tools/0')['request']
+        self.assertEqual(self.harness.charm._rollout_status(),
+                         'waiting for rollout: multipathd restart')
+        on_config.reset_mock()
+        self.harness.charm._on_rollout_event(None)
+        on_config.assert_not_called()
+
+        # the other unit is done, this unit is granted next
+        self.harness.update_relation_data(
+            rel, 'infinidat-tools/1',
+            {'request': '', 'done': '000000000000001-a'})
+        on_config.assert_called_once()
+        data = self.harness.get_relation_data(rel, 'infinidat-tools/0')
+        self.assertEqual(data.get('done'), request)
+        self.assertNotIn('request', data)
+        self.assertEqual(self.harness.charm._rollout_status(), '')
+        self.assertEqual(rollout.load_grants(
+            self.harness.get_relation_data(rel, 'infinidat-tools')), {})
+
+        # coordination disabled
+        self.harness.update_config({'rollout_concurrency': 0})
+        self.assertTrue(self.harness.charm._rollout_permits(
+            rollout.OP_MULTIPATHD_RESTART))
+
+    @mock.patch('subprocess.check_call')
+    @mock.patch('src.charm.installed_versions')
+    @mock.patch('charmhelpers.fetch.add_source')
+    @mock.patch('charmhelpers.fetch.apt_update')
+    @mock.patch('charmhelpers.fetch.apt_install')
+    @mock.patch('debbundle.load_bundle')
+    def test_offline_debs(self, load_bundle, apt_install, apt_update,
+                          add_source, installed_versions, check_call):
+        debs = ['/cache/host-power-tools_7.3.0.0_amd64.deb',
+                '/cache/libfoo_1.0_amd64.deb']
+        versions = {'host-power-tools': '7.3.0.0', 'scsitools': '0.12',
+                    'multipath-tools-boot': '0.8.3', 'libfoo': '1.0'}
+        load_bundle.return_value = debbundle.DebBundle('digest', debs,
+                                                       versions)
+        installed_versions.return_value = {'scsitools': '0.12'}
+        self.harness.add_resource('offline-debs', b'tarball')
+
+        self.harness.charm.install_pkgs()
+        self.assertEqual(load_bundle.call_args[0][1], os.path.join(
+            self.harness.charm.charm_dir, 'offline-debs'))
+        cmd = check_call.call_args[0][0]
+        self.assertEqual(cmd[:2], ['apt-get', 'install'])
+        self.assertIn('--no-download', cmd)
+        self.assertEqual(cmd[-2:], debs)
+        add_source.assert_not_called()
+        apt_update.assert_not_called()
+        apt_install.assert_not_called()
+
+        # already installed
+        check_call.reset_mock()
+        installed_versions.return_value = dict(versions)
+        self.harness.charm.install_pkgs()
+        check_call.assert_not_called()
+
+        # pinned version not in the bundle
+        self.harness.update_config(
+            {'host_power_tools_version': '7.2.0.0'})
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(
+            'invalid offline-debs resource: host-power-tools 7.3.0.0 does '
+            'not match host_power_tools_version 7.2.0.0'))
+
+    @mock.patch('wwids.add_maps', return_value=[])
+    def test_wwids(self, add_maps):
+        wwids_file = os.path.join(self.tmpdir, 'multipath', 'wwids')
+        local = '3600508b1001c5c0a0000000000000001'
+        gone = '36742b0f000000478000000000000dead'
+        mapped = '36742b0f0000004780000000000012345'
+        unmapped = '36742b0f0000004780000000000012346'
+        os.makedirs(os.path.dirname(wwids_file))
+        with open(wwids_file, 'w') as f:
+            f.write('/{0}/\n/{1}/\n'.format(local, gone))
+
+        topology = StorageTopology([
+            ScsiDevice('1:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       'none', '32', mapped),
+            ScsiDevice('1:0:0:2', 'NFINIDAT', 'InfiniBox', 'running', 'sdc',
+                       'none', '32', unmapped)],
+            [DmDevice('dm-0', mapped, 'mpath-' + mapped, 'none', ['sdb'])])
+        with mock.patch('src.charm.StorageTopology.discover',
+                        return_value=topology):
+            self.assertEqual(self.harness.charm._update_wwids(), '')
+            with open(wwids_file) as f:
+                self.assertEqual(wwids.parse_wwids(f.read()),
+                                 [local, mapped, unmapped])
+            # only the device multipathd did not claim is added
+            add_maps.assert_called_once_with([unmapped])
+
+            add_maps.return_value = [unmapped]
+            self.assertEqual(self.harness.charm._update_wwids(),
+                             'multipathd add map failed on 1 device(s)')
+
+            # failed devices are not tried again on update-status, which
+            # reports the failure
+            add_maps.reset_mock()
+            add_maps.return_value = []
+            self.harness.charm._stored.multipath_conf_digest = 'digest'
+            self.harness.charm._stored.wwids_status = None
+            self.harness.charm.unit.status = ActiveStatus('Unit is ready')
+            self.harness.charm._on_update_wwids(None)
+            add_maps.assert_called_once_with([])
+            self.assertEqual(self.harness.model.unit.status, ActiveStatus(
+                'Unit is ready; multipathd add map failed on 1 device(s)'))
+
+            # and clears it once the device is claimed
+            self.harness.charm._update_wwids()
+            add_maps.assert_called_with([unmapped])
+            self.harness.charm._stored.wwids_status = \
+                'multipathd add map failed on 1 device(s)'
+            self.harness.charm._on_update_wwids(None)
+            self.assertEqual(self.harness.model.unit.status,
+                             ActiveStatus('Unit is ready'))
+
+            # the wwids file cannot be written
+            os.unlink(wwids_file)
+            with mock.patch('src.charm.write_file_if_changed',
+                            side_effect=PermissionError('denied')):
+                self.assertEqual(self.harness.charm._update_wwids(),
+                                 'failed to update {0}'.format(wwids_file))
+
+        # nothing is done until multipath is configured
+        add_maps.reset_mock()
+        self.harness.charm._stored.multipath_conf_digest = None
+        self.harness.charm.on.update_status.emit()
+        add_maps.assert_not_called()
+
+    @mock.patch('src.charm.InfinidatToolsCharm._update_multipath_conf')
+    def test_refresh_blacklist(self, _update_multipath_conf):
+        nvme = localdisks.LocalDisk('nvme0n1', localdisks.TRANSPORT_NVME,
+                                    'eui.0025385b71b0a0c1')
+        self.assertEqual(
+            self.harness.charm._multipath_settings()['blacklist_wwids'], [])
+
+        # multipath is not configured yet
+        with mock.patch('localdisks.local_disks', return_value=[nvme]):
+            self.harness.charm.on.update_status.emit()
+        _update_multipath_conf.assert_not_called()
+
+        self.harness.charm._stored.multipath_conf_digest = 'digest'
+        self.harness.charm._stored.blacklist_wwids = '[]'
+        self.harness.charm.on.update_status.emit()
+        _update_multipath_conf.assert_not_called()
+
+        # a local disk was added
+        with mock.patch('localdisks.local_disks', return_value=[nvme]):
+            self.assertEqual(
+                self.harness.charm._multipath_settings()['blacklist_wwids'],
+                ['^eui\\.0025385b71b0a0c1$'])
+            self.harness.charm.on.update_status.emit()
+        _update_multipath_conf.assert_called_once_with()
+
+        # local disks are not blacklisted
+        self.harness.update_config(
+            {'multipath_blacklist_local_disks': False})
+        with mock.patch('localdisks.local_disks', return_value=[nvme]):
+            self.assertEqual(
+                self.harness.charm._multipath_settings()['blacklist_wwids'],
+                [])
+
+    @mock.patch('subprocess.run')
+    @mock.patch('rescan.rescan_devices', return_value={})
+    @mock.patch('rescan.scan_targets', return_value={})
+    @mock.patch('rescan.target_devices')
+    @mock.patch('rescan.infinibox_targets')
+    def test_rescan_infinibox_action(self, infinibox_targets, target_devices,
+                                     scan_targets, rescan_devices, run):
+        action_event = mock.MagicMock()
+        action_event.params = {'luns': '', 'jobs': 4, 'settle-timeout': 60,
+                               'resize': True}
+
+        infinibox_targets.return_value = []
+        self.harness.charm.on_rescan_infinibox_action(action_event)
+        self.assertEqual(action_event.set_results.call_args[0][0],
+                         {'result': 'no InfiniBox targets', 'targets': 0})
+        scan_targets.assert_not_called()
+
+        targets = [rescan.ScsiTarget('3', '0', '1')]
+        infinibox_targets.return_value = targets
+        target_devices.side_effect = [
+            {'3:0:1:1': rescan.Device('sdb', 'running', 1 << 30)},
+            {'3:0:1:1': rescan.Device('sdb', 'running', 2 << 30),
+             '3:0:1:2': rescan.Device('sdc', 'running', 1 << 30)},
+        ]
+        self.harness.charm.on_rescan_infinibox_action(action_event)
+
+        scan_targets.assert_called_once_with(targets, None, 4)
+        rescan_devices.assert_called_once_with(['3:0:1:1'], 4)
+        run.assert_called_once_with(
+            ['udevadm', 'trigger', '--action=change', '--settle',
+             '/sys/block/sdb', '/sys/block/sdc'], check=True, timeout=60)
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(results['result'],
+                         '1 new, 0 removed, 1 resized device(s)')
+        self.assertEqual(results['new'], '3:0:1:2 (sdc)')
+        self.assertNotIn('errors', results)
+        action_event.fail.assert_not_called()
+
+        # known devices are only rescanned when asked
+        rescan_devices.reset_mock()
+        action_event.params['resize'] = False
+        target_devices.side_effect = [
+            {'3:0:1:1': rescan.Device('sdb', 'running', 1 << 30)},
+            {'3:0:1:1': rescan.Device('sdb', 'running', 1 << 30)},
+        ]
+        self.harness.charm.on_rescan_infinibox_action(action_event)
+        rescan_devices.assert_not_called()
+        self.assertEqual(action_event.set_results.call_args[0][0]['result'],
+                         '0 new, 0 removed, 0 resized device(s)')
+
+        # invalid LUN IDs
+        action_event.params['luns'] = '1,x'
+        self.harness.charm.on_rescan_infinibox_action(action_event)
+        action_event.fail.assert_called_once_with('invalid LUN ID: x')
@@ -0,0 +1,209 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from unittest import mock
+
+import infinihost
+from infinihost import (
+    InfinihostOutputParser,
+    InfinihostReport,
+    host_state_fingerprint,
+    parse_output,
+    strip_ansi,
+    STATUS_FAIL,
+    STATUS_OK,
+    STATUS_SKIP,
+)
+from unit_tests.sysfs import FakeSysfs
+
+
+class TestInfinihostOutputParser(unittest.TestCase):
+
+    def setUp(self):
+        with open('unit_tests/infinibox-sample.txt') as f:
+            self.data = f.read()
+
+    def test_strip_ansi(self):
+        self.assertEqual(
+            strip_ansi('\x1b[1m\x1b[32mok\x1b[22m\x1b[39m'), 'ok')
+
+    def test_incremental(self):
+        """Check results are returned as soon as the check line is fed"""
+        parser = InfinihostOutputParser()
+        lines = self.data.splitlines(keepends=True)
+
+        first = parser.feed(lines[0])
+        self.assertEqual(first.category, 'SCSI')
+        self.assertEqual(first.check, 'Checking that sg3-utils is installed')
+        self.assertEqual(first.status, STATUS_OK)
+        self.assertIsNone(first.fix_applied)
+
+        for line in lines[1:7]:
+            parser.feed(line)
+
+        fix = parser.feed(lines[7])
+        self.assertEqual(fix.status, STATUS_FAIL)
+        self.assertFalse(fix.fix_applied)
+        # REASON is not known until the details section is parsed
+        self.assertIsNone(fix.reason)
+
+        for line in lines[8:]:
+            parser.feed(line)
+
+        report = parser.report(2)
+        self.assertEqual(report.checks[7].reason,
+                         'FAILURE: service multipath-tools is not running')
+
+    def test_parse_output(self):
+        report = parse_output(self.data, 2)
+
+        self.assertEqual(len(report.checks), 26)
+        self.assertEqual(report.counts, {
+            STATUS_OK: 14, STATUS_FAIL: 1, STATUS_SKIP: 11})
+        self.assertFalse(report.ok)
+        self.assertEqual(report.verdict,
+                         'This host is NOT ready to work with the InfiniBox')
+        self.assertEqual(report.status_message(),
+                         'infinihost: 1 failed check(s) (Multipath)')
+
+        skipped = report.by_status(STATUS_SKIP)
+        self.assertTrue(all(c.reason and c.kb_link for c in skipped))
+        self.assertEqual(skipped[-1].name,
+                         'Connectivity: Checking that the host does not have '
+                         'more block devices than the recommended limit')
+        self.assertEqual(
+            skipped[-1].kb_link,
+            'https://support.infinidat.com/hc/articles/202319172')
+
+    def test_fix_applied(self):
+        report = parse_output(
+            'Multipath: Checking global parameters ... '
+            '\x1b[1m\x1b[31mfail\x1b[22m\x1b[39m '
+            '\x1b[1m\x1b[34mapplying fix \x1b[22m\x1b[39m'
+            '\x1b[1m\x1b[32mok\x1b[22m\x1b[39m\n', 0)
+        self.assertTrue(report.checks[0].fix_applied)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.status_message(), '')
+
+    def test_report_serialization(self):
+        report = parse_output(self.data, 2)
+        self.assertEqual(InfinihostReport.from_dict(report.to_dict()),
+                         report)
+
+
+class TestHostStateFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sysfs = os.path.join(self.tmpdir, 'sys')
+        self.multipath_conf = os.path.join(self.tmpdir, 'multipath.conf')
+        for dev in ('sda', 'sdb', 'dm-0'):
+            os.makedirs(os.path.join(self.sysfs, 'block', dev))
+        os.makedirs(os.path.join(self.sysfs, 'class/fc_host/host1'))
+        self.tree = FakeSysfs(self.tmpdir)
+        self.tree.write('sys/class/fc_host/host1/port_name',
+                        '0x21000024ff4b8a2c')
+        self.tree.write('multipath.conf', 'defaults {}')
+
+    def _fingerprint(self, version='7.3.0.0'):
+        return host_state_fingerprint(self.multipath_conf, version,
+                                      sysfs=self.sysfs)
+
+    def test_fingerprint(self):
+        fingerprint = self._fingerprint()
+        self.assertEqual(fingerprint, self._fingerprint())
+        self.assertNotEqual(fingerprint, self._fingerprint('7.4.0.0'))
+
+        os.makedirs(os.path.join(self.sysfs, 'block', 'sdc'))
+        self.assertNotEqual(fingerprint, self._fingerprint())
+        fingerprint = self._fingerprint()
+
+        self.tree.write('sys/class/fc_host/host1/port_name',
+                        '0x21000024ff4b8a2d')
+        self.assertNotEqual(fingerprint, self._fingerprint())
+        fingerprint = self._fingerprint()
+
+        self.tree.write('multipath.conf', 'defaults { max_fds 8192 }')
+        self.assertNotEqual(fingerprint, self._fingerprint())
+
+
+class TestRunCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _fake_infinihost(self, script):
+        patcher = mock.patch('infinihost.infinihost_cmd',
+                             return_value=['sh', '-c', script])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_progress(self):
+        self._fake_infinihost(
+            'echo "SCSI: Checking that parted is installed ... ok"; '
+            'echo "SCSI: Checking that sg3-utils is installed ... fail"; '
+            'exit 1')
+        progress = mock.MagicMock()
+        outfile = BytesIO()
+
+        report = infinihost.run_check(outfile=outfile, progress=progress,
+                                      timeout=30)
+
+        self.assertEqual(report.code, 1)
+        self.assertEqual(progress.call_count, 2)
+        self.assertEqual(report.failures[0].check,
+                         'Checking that sg3-utils is installed')
+        self.assertTrue(outfile.getvalue().startswith(b'SCSI: Checking'))
+
+    @mock.patch('infinihost.KILL_GRACE', 1)
+    def test_timeout(self):
+        # the sleep in the background keeps stdout open: it must be killed
+        # along with the shell for the run to complete
+        self._fake_infinihost(
+            'echo "SCSI: Checking that parted is installed ... ok"; '
+            'sleep 30 & sleep 30')
+        progress = mock.MagicMock()
+
+        self.assertRaises(subprocess.TimeoutExpired, infinihost.run_check,
+                          progress=progress, timeout=0.5)
+        self.assertEqual(progress.call_count, 1)
+
+    def test_background_job(self):
+        job_dir = os.path.join(self.tmpdir, 'jobs')
+        self.assertEqual(infinihost.job_status(job_dir, 'job1'),
+                         ('unknown', None))
+
+        # infinihost itself is not installed here
+        infinihost.start_job(job_dir, 'job1', timeout=30)
+        for _ in range(100):
+            state, data = infinihost.job_status(job_dir, 'job1')
+            if state != 'running':
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(state, 'done')
+        self.assertIn('Failed to run infinihost', data['error'])
+        self.assertEqual(infinihost.running_jobs(job_dir), [])
+
+        infinihost.remove_job(job_dir, 'job1')
+        self.assertEqual(os.listdir(job_dir), [])
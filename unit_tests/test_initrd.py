@@ -0,0 +1,96 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import initrd
+from unit_tests.sysfs import FakeSysfs
+
+
+class TestInitrd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sysfs = os.path.join(self.tmpdir, 'sys')
+        # sys, etc and boot
+        self.tree = FakeSysfs(self.tmpdir)
+
+    def _add_dev(self, name, devno, dm_uuid=None, slaves=()):
+        block = 'sys/devices/virtual/block/{0}'.format(name)
+        self.tree.write(block + '/dev', devno)
+        if dm_uuid is not None:
+            self.tree.write(block + '/dm/uuid', dm_uuid)
+        os.makedirs(os.path.join(self.sysfs, 'dev', 'block'), exist_ok=True)
+        os.symlink(os.path.join(self.sysfs, 'devices/virtual/block', name),
+                   os.path.join(self.sysfs, 'dev', 'block', devno))
+        for slave in slaves:
+            os.makedirs(os.path.join(
+                self.sysfs, 'devices/virtual/block', name, 'slaves'),
+                exist_ok=True)
+            os.symlink(
+                os.path.join(self.sysfs, 'devices/virtual/block', slave),
+                os.path.join(self.sysfs, 'devices/virtual/block', name,
+                             'slaves', slave))
+
+    @mock.patch('initrd._devno')
+    def test_boots_from_san(self, _devno):
+        self._add_dev('sda', '8:0')
+        self._add_dev('dm-0', '253:0', 'mpath-36742b0f00000', ['sda'])
+        self._add_dev('dm-1', '253:1', 'LVM-abc', ['dm-0'])
+        self._add_dev('vda', '252:0')
+        self._add_dev('dm-2', '253:2', 'LVM-def', ['vda'])
+
+        _devno.return_value = '253:1'
+        self.assertTrue(initrd.boots_from_san(['/'], sysfs=self.sysfs))
+
+        _devno.return_value = '253:0'
+        self.assertTrue(initrd.boots_from_san(['/'], sysfs=self.sysfs))
+
+        _devno.return_value = '253:2'
+        self.assertFalse(initrd.boots_from_san(['/'], sysfs=self.sysfs))
+
+        _devno.return_value = '252:0'
+        self.assertFalse(initrd.boots_from_san(['/'], sysfs=self.sysfs))
+
+    def test_inputs_fingerprint(self):
+        self.tree.write('etc/multipath.conf', 'defaults {}')
+        patterns = [os.path.join(self.tmpdir, 'etc/*.conf')]
+
+        fingerprint = initrd.inputs_fingerprint(patterns)
+        self.assertEqual(fingerprint, initrd.inputs_fingerprint(patterns))
+
+        self.tree.write('etc/multipath.conf', 'defaults { max_fds 8192 }')
+        self.assertNotEqual(fingerprint, initrd.inputs_fingerprint(patterns))
+
+    @mock.patch('os.uname')
+    def test_target_kernels(self, uname):
+        uname.return_value = mock.MagicMock(release='5.4.0-100-generic')
+        boot = os.path.join(self.tmpdir, 'boot')
+        self.tree.write('boot/vmlinuz-5.4.0-100-generic')
+        self.tree.write('boot/vmlinuz-5.4.0-99-generic')
+        os.symlink('vmlinuz-5.4.0-100-generic',
+                   os.path.join(boot, 'vmlinuz'))
+        self.assertEqual(initrd.target_kernels(boot), ['5.4.0-100-generic'])
+
+        self.tree.write('boot/vmlinuz-5.4.0-110-generic')
+        os.unlink(os.path.join(boot, 'vmlinuz'))
+        os.symlink('vmlinuz-5.4.0-110-generic',
+                   os.path.join(boot, 'vmlinuz'))
+        self.assertEqual(initrd.target_kernels(boot),
+                         ['5.4.0-100-generic', '5.4.0-110-generic'])
@@ -0,0 +1,173 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import iscsi
+from unit_tests.sysfs import FakeSysfs
+
+ISCSID_CONF = """\
+# To control how many commands the session will queue set
+# node.session.cmds_max to an integer between 2 and 2048 that is also
+# a power of 2. The default is 128.
+node.session.cmds_max = 128
+
+# To control the device's queue depth set node.session.queue_depth
+# to a value between 1 and 1024. The default is 32.
+node.session.queue_depth = 32
+
+#node.session.nr_sessions = 1
+node.conn[0].timeo.noop_out_interval = 5
+"""
+
+TARGET = 'iqn.2009-11.com.infinidat:storage:infinibox-sn-1234'
+
+
+class TestIscsiConf(unittest.TestCase):
+
+    def test_get_options(self):
+        self.assertEqual(iscsi.get_options(ISCSID_CONF), {
+            iscsi.CMDS_MAX: '128',
+            iscsi.QUEUE_DEPTH: '32',
+            iscsi.NOOP_OUT_INTERVAL: '5',
+        })
+
+    def test_set_options(self):
+        text = iscsi.set_options(ISCSID_CONF, {
+            iscsi.CMDS_MAX: '1024',
+            iscsi.QUEUE_DEPTH: '',
+            iscsi.NR_SESSIONS: '2',
+            iscsi.REPLACEMENT_TIMEOUT: '15',
+        })
+        self.assertEqual(text, ISCSID_CONF.replace(
+            'cmds_max = 128', 'cmds_max = 1024').replace(
+            '#node.session.nr_sessions = 1\n',
+            '#node.session.nr_sessions = 1\nnode.session.nr_sessions = 2\n') +
+            'node.session.timeo.replacement_timeout = 15\n')
+        # idempotent
+        self.assertEqual(iscsi.set_options(text, {iscsi.CMDS_MAX: '1024'}),
+                         text)
+
+        # duplicates are removed
+        text = iscsi.set_options('x = 1\nnode.session.cmds_max = 8\n'
+                                 'node.session.cmds_max = 16\ny = 2\n',
+                                 {iscsi.CMDS_MAX: '64'})
+        self.assertEqual(text, 'x = 1\nnode.session.cmds_max = 64\ny = 2\n')
+
+    def test_validate_settings(self):
+        self.assertEqual(iscsi.validate_settings({
+            iscsi.CMDS_MAX: '1024', iscsi.QUEUE_DEPTH: '128',
+            iscsi.NR_SESSIONS: '', iscsi.REPLACEMENT_TIMEOUT: None}), [])
+        self.assertEqual(iscsi.validate_settings({
+            iscsi.CMDS_MAX: '1000', iscsi.QUEUE_DEPTH: '2000',
+            iscsi.NR_SESSIONS: '0', iscsi.NOOP_OUT_INTERVAL: '-1'}), [
+                'node.conn[0].timeo.noop_out_interval must be a number',
+                'node.session.cmds_max must be a power of 2 between 2 and '
+                '2048',
+                'node.session.queue_depth must be between 1 and 1024',
+                'node.session.nr_sessions must be at least 1'])
+
+    @mock.patch('subprocess.run')
+    def test_update_node_records(self, run):
+        run.return_value = subprocess.CompletedProcess([], 0, '')
+        self.assertTrue(iscsi.update_node_records(
+            [iscsi.CMDS_MAX], {iscsi.CMDS_MAX: '1024'}))
+        self.assertEqual(run.call_args[0][0], [
+            'iscsiadm', '-m', 'node', '-o', 'update',
+            '-n', 'node.session.cmds_max', '-v', '1024'])
+
+        run.return_value = subprocess.CompletedProcess(
+            [], iscsi.ISCSI_ERR_NO_OBJS_FOUND, 'No records found')
+        self.assertFalse(iscsi.update_node_records(
+            [iscsi.CMDS_MAX], {iscsi.CMDS_MAX: '1024'}))
+
+        run.return_value = subprocess.CompletedProcess([], 1, 'error')
+        with self.assertRaises(subprocess.CalledProcessError):
+            iscsi.update_node_records([iscsi.CMDS_MAX],
+                                      {iscsi.CMDS_MAX: '1024'})
+
+
+class TestIscsiSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        self.tree = FakeSysfs(self.sysfs)
+        self._add_session(1, 3, '10.0.0.1', recovery_tmo='120',
+                          can_queue='113', recv_tmo='5',
+                          queue_depths={'3:0:0:1': '32', '3:0:0:2': '128'})
+        self._add_session(2, 4, '10.0.0.2', recovery_tmo='15',
+                          can_queue='1009', recv_tmo='5',
+                          queue_depths={'4:0:0:1': '128'})
+
+    def _add_session(self, sid, host, address, recovery_tmo, can_queue,
+                     recv_tmo, queue_depths):
+        session = os.path.join('devices', 'platform',
+                               'host{0}'.format(host),
+                               'session{0}'.format(sid))
+        for hcil, depth in queue_depths.items():
+            self.tree.write(os.path.join(
+                session, 'target{0}:0:0'.format(host), hcil, 'queue_depth'),
+                depth)
+        cls = os.path.join('class', 'iscsi_session', 'session{0}'.format(sid))
+        self.tree.write(os.path.join(cls, 'targetname'), TARGET)
+        self.tree.write(os.path.join(cls, 'recovery_tmo'), recovery_tmo)
+        os.symlink(os.path.join(self.sysfs, session),
+                   os.path.join(self.sysfs, cls, 'device'))
+        conn = os.path.join('class', 'iscsi_connection',
+                            'connection{0}:0'.format(sid))
+        self.tree.write(os.path.join(conn, 'persistent_address'), address)
+        self.tree.write(os.path.join(conn, 'persistent_port'), '3260')
+        self.tree.write(os.path.join(conn, 'recv_tmo'), recv_tmo)
+        self.tree.write(os.path.join('class', 'scsi_host',
+                                     'host{0}'.format(host), 'can_queue'),
+                        can_queue)
+
+    def test_session_mismatches(self):
+        settings = {
+            iscsi.CMDS_MAX: '1024',
+            iscsi.QUEUE_DEPTH: '128',
+            iscsi.NR_SESSIONS: '1',
+            iscsi.NOOP_OUT_INTERVAL: '5',
+            iscsi.REPLACEMENT_TIMEOUT: '15',
+        }
+        mismatches = iscsi.session_mismatches(settings, self.sysfs)
+
+        self.assertEqual([m.describe() for m in mismatches], [
+            'session1: node.session.timeo.replacement_timeout=120 '
+            '(expected 15)',
+            'session1: node.session.cmds_max=113 (expected 1009)',
+            'session1/3:0:0:1: node.session.queue_depth=32 (expected 128)',
+        ])
+        self.assertEqual(iscsi.session_mismatches({}, self.sysfs), [])
+
+        # cmds_max needs a new login, the rest is changed in place
+        remaining = iscsi.apply_live(mismatches)
+        self.assertEqual([m.key for m in remaining], [iscsi.CMDS_MAX])
+        self.assertEqual(iscsi.session_mismatches(settings, self.sysfs),
+                         remaining)
+
+    def test_nr_sessions(self):
+        self._add_session(3, 5, '10.0.0.2', recovery_tmo='15',
+                          can_queue='113', recv_tmo='5', queue_depths={})
+        mismatches = iscsi.session_mismatches({iscsi.NR_SESSIONS: '2'},
+                                              self.sysfs)
+        self.assertEqual([m.describe() for m in mismatches], [
+            '{0} 10.0.0.1:3260: node.session.nr_sessions=1 (expected 2)'
+            .format(TARGET)])
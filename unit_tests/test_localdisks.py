@@ -0,0 +1,105 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import localdisks
+from discovery import DmDevice, StorageTopology
+from unit_tests.sysfs import FakeSysfs
+
+
+class TestLocalDisks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sysfs = os.path.join(self.tmpdir, 'sys')
+        self.tree = FakeSysfs(self.sysfs)
+        self.udev_db = os.path.join(self.tmpdir, 'udev')
+        os.makedirs(self.udev_db)
+        self.devno = 0
+
+    def _add_disk(self, name, device, properties=None, **attrs):
+        """Add a disk whose device is at devices/<device> in sysfs."""
+        self.devno += 1
+        block = os.path.join(self.sysfs, 'block', name)
+        self.tree.write(os.path.join(block, 'dev'), '8:{0}'.format(self.devno))
+        dev = os.path.join(self.sysfs, 'devices', device)
+        os.makedirs(dev)
+        os.symlink(dev, os.path.join(block, 'device'))
+        for attr, value in attrs.items():
+            self.tree.write(os.path.join(dev, attr), value)
+        if properties is not None:
+            self.tree.write(
+                os.path.join(self.udev_db, 'b8:{0}'.format(self.devno)),
+                '\n'.join('E:{0}={1}'.format(k, v)
+                          for k, v in properties.items()))
+
+    def _add_host(self, cls, host):
+        os.makedirs(os.path.join(self.sysfs, 'class', cls, host))
+
+    def _local_disks(self, topology=None):
+        return localdisks.local_disks(topology or StorageTopology([], []),
+                                      self.sysfs, self.udev_db)
+
+    def test_local_disks(self):
+        self._add_host('fc_host', 'host3')
+        self._add_host('iscsi_host', 'host4')
+        self._add_disk('nvme0n1', 'nvme0', {'ID_WWN': 'eui.0025385b71b0a0c1'},
+                       transport='pcie')
+        # NVMe over fabrics
+        self._add_disk('nvme1n1', 'nvme1', {'ID_WWN': 'uuid.1'},
+                       transport='tcp')
+        self._add_disk('sda', '0:0:0:0', {'ID_SERIAL': 'Samsung_SSD_860'},
+                       vendor='ATA')
+        # no udev data, the WWID is read from sysfs
+        self._add_disk('sdb', '1:0:0:0', wwid='naa.5000C500A1B2C3D4',
+                       vendor='SEAGATE')
+        self._add_disk('sdc', '3:0:0:1', {'ID_SERIAL': '36742b0f01'},
+                       vendor='NFINIDAT')
+        self._add_disk('sdd', '4:0:0:1', {'ID_SERIAL': '36742b0f02'},
+                       vendor='NFINIDAT')
+        self._add_disk('vda', 'virtio0', {'ID_SERIAL': 'root-disk'})
+        # virtio disk without serial
+        self._add_disk('vdb', 'virtio1', {})
+        os.makedirs(os.path.join(self.sysfs, 'block', 'dm-0'))
+
+        self.assertEqual(self._local_disks(), [
+            localdisks.LocalDisk('nvme0n1', 'nvme', 'eui.0025385b71b0a0c1'),
+            localdisks.LocalDisk('sda', 'scsi', 'Samsung_SSD_860'),
+            localdisks.LocalDisk('sdb', 'scsi', '35000c500a1b2c3d4'),
+            localdisks.LocalDisk('vda', 'virtio', 'root-disk'),
+        ])
+
+        # local disks someone multipathed are left alone
+        topology = StorageTopology([], [DmDevice(
+            'dm-0', 'mpatha', 'mpath-35000c500a1b2c3d4', 'none', ['sdb'])])
+        self.assertEqual([d.name for d in self._local_disks(topology)],
+                         ['nvme0n1', 'sda', 'vda'])
+
+    def test_local_disks_no_sysfs(self):
+        self.assertEqual(self._local_disks(), [])
+
+    def test_blacklist_patterns(self):
+        disks = [localdisks.LocalDisk('sda', 'scsi', 'Samsung_SSD_860'),
+                 localdisks.LocalDisk('nvme0n1', 'nvme', 'eui.0025385b'),
+                 localdisks.LocalDisk('sdb', 'scsi', 'Samsung_SSD_860')]
+        self.assertEqual(localdisks.blacklist_patterns(disks),
+                         ['^Samsung_SSD_860$', '^eui\\.0025385b$'])
+        self.assertEqual(localdisks.wwid_pattern('a+b (1)'),
+                         '^a\\+b \\(1\\)$')
@@ -0,0 +1,218 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from discovery import DmDevice, ScsiDevice, StorageTopology
+from lvmconf import (
+    LvmConfSyntaxError,
+    active_pv_devices,
+    format_filter,
+    generated_filter,
+    get_option,
+    local_devices,
+    parse,
+    pv_devices,
+    set_option,
+)
+
+LVM_CONF = """\
+# This is an example configuration file for the LVM2 system.
+config {
+\tchecks = 1
+\tprofile_dir = "/etc/lvm/profile"
+}
+devices {
+\tdir = "/dev"
+\t# global_filter = [ "a|.*|" ]
+\tfilter = [ "a|^/dev/sd[a-z]$|", # a comment with ] and "
+\t\t"r|.*|" ]
+\tsubsection {
+\t\tglobal_filter = "not in devices"
+\t}
+}
+allocation { maximise_cling = 1 }
+"""
+
+FILTER = '[ "a|^/dev/sd.*|", "r|.*|" ]'
+
+
+class TestLvmConfParser(unittest.TestCase):
+
+    def test_parse(self):
+        sections, assignments = parse(LVM_CONF)
+
+        self.assertEqual([s.path for s in sections], [
+            ('config',), ('devices', 'subsection'), ('devices',),
+            ('allocation',)])
+        self.assertEqual(
+            [(a.section, a.key) for a in assignments], [
+                (('config',), 'checks'),
+                (('config',), 'profile_dir'),
+                (('devices',), 'dir'),
+                (('devices',), 'filter'),
+                (('devices', 'subsection'), 'global_filter'),
+                (('allocation',), 'maximise_cling'),
+            ])
+        self.assertEqual(get_option(LVM_CONF, 'devices', 'filter'),
+                         '[ "a|^/dev/sd[a-z]$|", # a comment with ] and "\n'
+                         '\t\t"r|.*|" ]')
+        self.assertIsNone(get_option(LVM_CONF, 'devices', 'global_filter'))
+
+    def test_syntax_errors(self):
+        for text in ('devices {\n', 'devices }\n', 'devices {\n\tx\n}\n',
+                     'devices {\n\tx = [ "a"\n}\n', 'x = "abc\n', '%'):
+            with self.assertRaises(LvmConfSyntaxError, msg=text):
+                parse(text)
+
+    def test_set_option(self):
+        text = set_option(LVM_CONF, 'devices', 'global_filter', FILTER)
+        self.assertIn('\t# global_filter = [ "a|.*|" ]\n'
+                      '\tglobal_filter = {0} # __infinidat_tools__\n'
+                      '\tfilter = '.format(FILTER), text)
+        self.assertEqual(get_option(text, 'devices', 'global_filter'),
+                         FILTER)
+        # idempotent
+        self.assertEqual(
+            set_option(text, 'devices', 'global_filter', FILTER), text)
+        # unset
+        self.assertEqual(
+            set_option(text, 'devices', 'global_filter', None), LVM_CONF)
+
+    def test_set_option_replaces(self):
+        text = set_option(LVM_CONF, 'devices', 'filter', FILTER)
+        self.assertIn('\tfilter = {0} # __infinidat_tools__\n\tsubsection'
+                      .format(FILTER), text)
+
+        # options not set by the charm are not removed
+        self.assertEqual(set_option(LVM_CONF, 'devices', 'filter', None),
+                         LVM_CONF)
+
+    def test_set_option_new_section(self):
+        text = set_option(LVM_CONF, 'allocation', 'x', '1')
+        self.assertTrue(text.endswith(
+            'allocation { maximise_cling = 1 \n'
+            '\tx = 1 # __infinidat_tools__\n}\n'))
+        self.assertEqual(get_option(text, 'allocation', 'x'), '1')
+
+        text = set_option('', 'devices', 'use_devicesfile', '0')
+        self.assertEqual(text, 'devices {\n'
+                               '\tuse_devicesfile = 0 # __infinidat_tools__'
+                               '\n}\n')
+
+    def test_format_filter(self):
+        self.assertEqual(format_filter(['a|^/dev/sda$|', 'r|.*|']),
+                         '[ "a|^/dev/sda$|", "r|.*|" ]')
+
+
+class TestGeneratedFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sysfs = os.path.join(self.tmpdir, 'sys')
+        self.by_id = os.path.join(self.tmpdir, 'by-id')
+        for name in ('sda', 'sdb', 'vda', 'dm-0', 'dm-1', 'dm-2', 'dm-3',
+                     'loop0', 'sr0', 'md0'):
+            os.makedirs(os.path.join(self.sysfs, 'block', name))
+        os.makedirs(self.by_id)
+        for link, target in (
+                ('wwn-0x5000c500a1b2c3d4', 'sda'),
+                ('ata-Samsung_SSD_860.EVO+_S3Z9', 'sda'),
+                ('wwn-0x5000c500a1b2c3d4-part1', 'sda1'),
+                ('scsi-36742b0f000001', 'sdb'),
+                ('dm-name-mpatha', 'dm-0'),
+                ('dm-uuid-part1-mpath-36742b0f000001', 'dm-1'),
+                ('dm-uuid-mpath-36742b0f000001', 'dm-0'),
+                ('dm-name-cryptroot', 'dm-2'),
+                ('dm-uuid-CRYPT-LUKS2-abc-cryptroot', 'dm-2'),
+                ('md-name-host:0', 'md0'),
+                ('md-uuid-0a1b2c3d:4e5f', 'md0')):
+            os.symlink(os.path.join('..', '..', target),
+                       os.path.join(self.by_id, link))
+
+        self.topology = StorageTopology([
+            ScsiDevice('0:0:0:0', 'ATA', 'Samsung SSD', 'running', 'sda',
+                       '', ''),
+            ScsiDevice('1:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       '', ''),
+        ], [
+            DmDevice('dm-0', 'mpatha', 'mpath-36742b0f000001', '', ['sdb']),
+            DmDevice('dm-1', 'mpatha-part1', 'part1-mpath-36742b0f000001',
+                     '', ['dm-0']),
+            DmDevice('dm-2', 'cryptroot', 'CRYPT-LUKS2-abc-cryptroot', '',
+                     ['sda']),
+            DmDevice('dm-3', 'vg-lv', 'LVM-abc', '', ['dm-2']),
+        ])
+
+    def test_local_devices(self):
+        self.assertEqual(local_devices(self.sysfs, self.topology),
+                         ['dm-2', 'md0', 'sda', 'vda'])
+
+    def test_generated_filter(self):
+        self.assertEqual(
+            generated_filter(self.sysfs, self.by_id, self.topology),
+            '[ "a|^/dev/disk/by-id/dm-uuid-CRYPT-LUKS2-abc-cryptroot'
+            '(-part[0-9]+)?$|", '
+            '"a|^/dev/disk/by-id/md-uuid-0a1b2c3d:4e5f(-part[0-9]+)?$|", '
+            '"a|^/dev/disk/by-id/ata-Samsung_SSD_860[.]EVO[+]_S3Z9'
+            '(-part[0-9]+)?$|", '
+            '"a|^/dev/vdap?[0-9]*$|", '
+            '"r|.*|" ]')
+        # the generated filter can be written to lvm.conf
+        text = set_option(LVM_CONF, 'devices', 'global_filter',
+                          generated_filter(self.sysfs, self.by_id,
+                                           self.topology))
+        parse(text)
+
+    def test_pv_devices(self):
+        # a root VG on a multipath partition, another one on a local disk
+        self.topology.dm['dm-4'] = DmDevice('dm-4', 'san-root', 'LVM-def',
+                                            '', ['dm-1'])
+        self.topology.dm['dm-5'] = DmDevice('dm-5', 'san-thin', 'LVM-ghi',
+                                            '', ['dm-4'])
+        self.assertEqual(active_pv_devices(self.topology),
+                         ['dm-1', 'dm-2'])
+
+        with mock.patch('subprocess.check_output') as check_output:
+            check_output.return_value = (
+                '  /dev/mapper/mpatha-part1\n  /dev/sda1\n  [unknown]\n')
+            with mock.patch('os.path.realpath',
+                            side_effect=lambda p: p.replace(
+                                '/dev/mapper/mpatha-part1', '/dev/dm-1')):
+                self.assertEqual(pv_devices(), ['dm-1', 'sda1'])
+
+        # PVs on InfiniBox are accepted, PVs on partitions of local disks
+        # already are
+        part = os.path.join(self.sysfs, 'block', 'sda', 'sda1')
+        os.makedirs(part)
+        open(os.path.join(part, 'partition'), 'w').close()
+        os.makedirs(os.path.join(self.sysfs, 'class', 'block'))
+        os.symlink(part, os.path.join(self.sysfs, 'class', 'block', 'sda1'))
+        self.assertEqual(
+            generated_filter(self.sysfs, self.by_id, self.topology,
+                             pvs=['dm-1', 'sda1', 'sdb']),
+            '[ "a|^/dev/disk/by-id/dm-uuid-CRYPT-LUKS2-abc-cryptroot'
+            '(-part[0-9]+)?$|", '
+            '"a|^/dev/disk/by-id/md-uuid-0a1b2c3d:4e5f(-part[0-9]+)?$|", '
+            '"a|^/dev/disk/by-id/ata-Samsung_SSD_860[.]EVO[+]_S3Z9'
+            '(-part[0-9]+)?$|", '
+            '"a|^/dev/vdap?[0-9]*$|", '
+            '"a|^/dev/disk/by-id/dm-uuid-part1-mpath-36742b0f000001$|", '
+            '"a|^/dev/disk/by-id/scsi-36742b0f000001$|", '
+            '"r|.*|" ]')
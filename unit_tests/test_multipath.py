@@ -0,0 +1,129 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import multipath
+
+DEVICE = ('devices', 'device[NFINIDAT/InfiniBox.*]')
+
+
+class TestMultipathConf(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'path_selector': 'round-robin 0',
+            'rr_min_io_rq': 1,
+            'max_fds': 8192,
+            'fast_io_fail_tmo': 15,
+            'no_path_retry': 'queue',
+            'find_multipaths': 'yes',
+        }
+        self.conf = multipath.render_config('templates', self.settings)
+
+    def test_parse_config(self):
+        settings = multipath.parse_config(
+            self.conf + '\n'
+            'blacklist {\n'
+            '    devnode "^nvme.*" # local disks\n'
+            '    devnode "^vd[a-z]"\n'
+            '}\n')
+
+        self.assertEqual(settings[(('defaults',), 'max_fds')], ('8192',))
+        self.assertEqual(settings[(DEVICE, 'path_selector')],
+                         ('round-robin 0',))
+        self.assertEqual(settings[(('blacklist',), 'devnode')],
+                         ('^nvme.*', '^vd[a-z]'))
+
+    def test_plan_reconfiguration(self):
+        plan = multipath.plan_reconfiguration(None, self.conf)
+        self.assertEqual(plan.action, multipath.ACTION_RESTART)
+
+        plan = multipath.plan_reconfiguration(
+            self.conf, '# managed by juju\n' + self.conf)
+        self.assertEqual(plan.action, multipath.ACTION_NONE)
+
+        plan = multipath.plan_reconfiguration(
+            self.conf, self.conf.replace('fast_io_fail_tmo 15',
+                                         'fast_io_fail_tmo 5'))
+        self.assertEqual(plan.action, multipath.ACTION_RECONFIGURE)
+        self.assertEqual(plan.changed, (
+            'devices/device[NFINIDAT/InfiniBox.*]/fast_io_fail_tmo',))
+
+        plan = multipath.plan_reconfiguration(
+            self.conf, self.conf.replace('max_fds 8192', 'max_fds 4096')
+                                .replace('rr_min_io_rq 1', 'rr_min_io_rq 2'))
+        self.assertEqual(plan.action, multipath.ACTION_RESTART)
+        self.assertEqual(plan.restart_keys, ('defaults/max_fds',))
+        self.assertEqual(len(plan.changed), 2)
+
+    def test_render_config(self):
+        existing = (
+            'defaults {\n'
+            '    user_friendly_names yes\n'
+            '}\n'
+            'blacklist { # local disks\n'
+            '    device {\n'
+            '        vendor "QEMU"\n'
+            '    }\n'
+            '}\n'
+            'blacklist_exceptions {\n'
+            '    property "(SCSI_IDENT_|ID_WWN)"\n'
+            '}')
+        self.settings['path_selector'] = 'queue-length 0'
+        data = multipath.render_config('templates', self.settings, existing)
+        settings = multipath.parse_config(data)
+
+        self.assertEqual(settings[(DEVICE, 'path_selector')],
+                         ('queue-length 0',))
+        self.assertEqual(settings[(('defaults',), 'user_friendly_names')],
+                         ('no',))
+        self.assertEqual(
+            settings[(('blacklist', 'device[QEMU/]'), 'vendor')], ('QEMU',))
+        self.assertTrue(data.endswith(
+            'blacklist_exceptions {\n'
+            '    property "(SCSI_IDENT_|ID_WWN)"\n'
+            '}\n'))
+
+    def test_generated_blacklist(self):
+        self.settings['blacklist_wwids'] = ['^eui\\.0025385b71b0a0c1$']
+        local = 'blacklist {\n    devnode "^sd[a-b]"\n}\n'
+        conf = multipath.render_config('templates', self.settings,
+                                       self.conf + local)
+        settings = multipath.parse_config(conf)
+        self.assertEqual(settings[(('blacklist',), 'wwid')],
+                         ('^eui\\.0025385b71b0a0c1$',))
+        self.assertEqual(
+            settings[(('blacklist_exceptions', 'device[NFINIDAT/InfiniBox.*]'),
+                      'vendor')], ('NFINIDAT',))
+        self.assertTrue(conf.endswith(local))
+
+        # generated sections are rendered again rather than kept
+        self.settings['blacklist_wwids'] = []
+        self.assertEqual(
+            multipath.render_config('templates', self.settings, conf),
+            self.conf + local)
+
+    def test_validate_settings(self):
+        self.assertEqual(multipath.validate_settings(self.settings), [])
+        self.settings['no_path_retry'] = '12'
+        self.settings['find_multipaths'] = 'strict'
+        self.assertEqual(multipath.validate_settings(self.settings), [])
+        self.assertIn('find_multipaths strict',
+                      multipath.render_config('templates', self.settings))
+
+        self.settings['path_selector'] = 'round-robin'
+        self.settings['no_path_retry'] = 'forever'
+        self.settings['find_multipaths'] = 'smart'
+        self.assertEqual(len(multipath.validate_settings(self.settings)), 3)
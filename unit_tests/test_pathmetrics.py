@@ -0,0 +1,117 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import pathmetrics
+
+WWID1 = '36742b0f0000004780000000000012345'
+WWID2 = '36742b0f0000004780000000000054321'
+
+MAPS = """\
+{0}|mpatha|dm-0|on|NFINIDAT,InfiniBox,3.0
+{1}|mpathb|dm-1|off|NFINIDAT,InfiniBox,3.0
+""".format(WWID1, WWID2)
+
+PATHS = """\
+{0}|sdb|active|running|ready|1:0:0:1
+{0}|sdc|failed|running|faulty|2:0:0:1
+{1}|sdd|active|running|ready|1:0:0:2
+{1}|sde|active|running|ready|2:0:0:2
+|sda|undef|running|undef|0:0:0:0
+""".format(WWID1, WWID2)
+
+
+def multipathd(cmd, **kwargs):
+    return {'maps': MAPS, 'paths': PATHS}[cmd[2]]
+
+
+class TestPathMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        queue = os.path.join(self.tmpdir, 'block', 'dm-0', 'queue')
+        os.makedirs(queue)
+        with open(os.path.join(queue, 'scheduler'), 'w') as f:
+            f.write('[mq-deadline] none\n')
+
+    @mock.patch('subprocess.check_output', side_effect=multipathd)
+    def test_collect(self, check_output):
+        maps = pathmetrics.collect(self.tmpdir)
+
+        self.assertEqual(check_output.call_count, 2)
+        self.assertEqual([m.name for m in maps], ['mpatha', 'mpathb'])
+        mpatha, mpathb = maps
+        self.assertEqual(mpatha.scheduler, 'mq-deadline')
+        self.assertEqual(mpathb.scheduler, '')
+        self.assertEqual(mpatha.product, 'NFINIDAT InfiniBox 3.0')
+        self.assertTrue(mpatha.queue_if_no_path)
+        self.assertFalse(mpathb.queue_if_no_path)
+        self.assertEqual([p.device for p in mpatha.paths], ['sdb', 'sdc'])
+        self.assertTrue(mpatha.paths[1].failed)
+
+    @mock.patch('subprocess.check_output', side_effect=multipathd)
+    def test_render(self, check_output):
+        data = pathmetrics.render(pathmetrics.collect(self.tmpdir),
+                                  timestamp=1000)
+        lines = data.splitlines()
+        labels = '{{wwid="{0}",name="mpatha"}}'.format(WWID1)
+
+        self.assertIn('infinidat_multipath_paths' + labels + ' 2', lines)
+        self.assertIn('infinidat_multipath_active_paths' + labels + ' 1',
+                      lines)
+        self.assertIn('infinidat_multipath_failed_paths' + labels + ' 1',
+                      lines)
+        self.assertIn('infinidat_multipath_queue_if_no_path' + labels + ' 1',
+                      lines)
+        self.assertIn(
+            'infinidat_multipath_path_up{{wwid="{0}",device="sdc",'
+            'hcil="2:0:0:1",dm_state="failed",device_state="running",'
+            'checker_state="faulty"}} 0'.format(WWID1), lines)
+        self.assertIn('infinidat_multipath_collector_success 1', lines)
+        self.assertIn('infinidat_multipath_collector_timestamp_seconds 1000',
+                      lines)
+        self.assertIn('# TYPE infinidat_multipath_paths gauge', lines)
+
+    def test_label_escaping(self):
+        self.assertEqual(pathmetrics._labels(name='a"b\\c\nd'),
+                         '{name="a\\"b\\\\c\\nd"}')
+
+    def test_write_metrics(self):
+        output = os.path.join(self.tmpdir, 'infinidat_multipath.prom')
+        with mock.patch('subprocess.check_output', side_effect=multipathd):
+            self.assertTrue(pathmetrics.write_metrics(output, self.tmpdir))
+        self.assertEqual(os.stat(output).st_mode & 0o777, 0o644)
+
+        # multipathd is not running
+        with mock.patch('subprocess.check_output',
+                        side_effect=subprocess.CalledProcessError(1, 'x')):
+            self.assertFalse(pathmetrics.write_metrics(output, self.tmpdir))
+        with open(output) as f:
+            data = f.read()
+        self.assertIn('infinidat_multipath_collector_success 0', data)
+        self.assertNotIn('infinidat_multipath_paths{', data)
+
+    def test_validate_interval(self):
+        self.assertEqual(pathmetrics.validate_interval(1), [])
+        self.assertEqual(pathmetrics.validate_interval(59), [])
+        for interval in (0, -5, 60, None):
+            self.assertEqual(pathmetrics.validate_interval(interval),
+                             ['interval must be between 1 and 59 minutes'])
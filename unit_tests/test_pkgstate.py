@@ -0,0 +1,82 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import unittest
+from unittest import mock
+
+import pkgstate
+
+DPKG_QUERY_OUTPUT = """\
+host-power-tools\t7.3.0.0\tii 
+scsitools\t0.12-3\trc 
+multipath-tools-boot:all\t0.8.3-1ubuntu2\tii 
+"""  # noqa: W291
+
+
+class TestPkgState(unittest.TestCase):
+
+    @mock.patch('subprocess.run')
+    def test_installed_versions(self, run):
+        run.return_value = subprocess.CompletedProcess(
+            [], 1, DPKG_QUERY_OUTPUT,
+            'dpkg-query: no packages found matching sg3-utils\n')
+        packages = ['host-power-tools', 'scsitools', 'multipath-tools-boot',
+                    'sg3-utils']
+
+        self.assertEqual(pkgstate.installed_versions(packages), {
+            'host-power-tools': '7.3.0.0',
+            'multipath-tools-boot': '0.8.3-1ubuntu2',
+        })
+        # a single dpkg-query call for all the packages
+        run.assert_called_once_with(
+            ['dpkg-query', '-W',
+             '-f=${Package}\t${Version}\t${db:Status-Abbrev}\n'] + packages,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+
+    def test_missing_packages(self):
+        installed = {'host-power-tools': '7.3.0.0', 'scsitools': '0.12-3'}
+        packages = ['host-power-tools', 'scsitools', 'multipath-tools-boot']
+
+        self.assertEqual(
+            pkgstate.missing_packages(packages, {}, installed),
+            ['multipath-tools-boot'])
+        self.assertEqual(
+            pkgstate.missing_packages(
+                packages, {'host-power-tools': '7.3.0.0'}, installed),
+            ['multipath-tools-boot'])
+        self.assertEqual(
+            pkgstate.missing_packages(
+                packages, {'host-power-tools': '7.4.0.0'}, installed),
+            ['host-power-tools', 'multipath-tools-boot'])
+
+    def test_package_spec(self):
+        self.assertEqual(pkgstate.package_spec('scsitools'), 'scsitools')
+        self.assertEqual(pkgstate.package_spec('host-power-tools', '7.3'),
+                         'host-power-tools=7.3')
+
+    def test_source_fingerprint(self):
+        with open('unit_tests/repo-key.asc') as f:
+            key = f.read()
+        source = 'deb https://repo.infinidat.com/packages focal main'
+
+        # an armored key is identified by its OpenPGP fingerprint
+        self.assertEqual(
+            pkgstate.source_fingerprint(source, key),
+            pkgstate.source_fingerprint(
+                source, '8A3EFA6959D7A4B7534DB9A17A6D83FE3D394584'))
+        self.assertNotEqual(
+            pkgstate.source_fingerprint(source, key),
+            pkgstate.source_fingerprint(source, None))
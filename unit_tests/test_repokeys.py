@@ -0,0 +1,118 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import repokeys
+
+# a throwaway key, not the Infinidat one
+TEST_KEY = 'unit_tests/repo-key.asc'
+TEST_KEY_FINGERPRINT = '8A3EFA6959D7A4B7534DB9A17A6D83FE3D394584'
+
+
+class TestRepoKeys(unittest.TestCase):
+
+    def setUp(self):
+        with open(TEST_KEY) as f:
+            self.key = f.read()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def test_source_needs_key(self):
+        self.assertTrue(repokeys.source_needs_key(
+            'deb https://repo.infinidat.com/packages/main-stable/apt/'
+            'linux-ubuntu focal main'))
+        self.assertTrue(repokeys.source_needs_key(
+            'http://mirror.local/infinidat focal main'))
+        self.assertFalse(repokeys.source_needs_key('ppa:myteam/ppa'))
+        self.assertFalse(repokeys.source_needs_key('cloud:focal-victoria'))
+        self.assertFalse(repokeys.source_needs_key(''))
+
+    def test_openpgp_fingerprint(self):
+        self.assertEqual(repokeys.openpgp_fingerprint(self.key),
+                         TEST_KEY_FINGERPRINT)
+        self.assertIsNone(repokeys.openpgp_fingerprint('not a key'))
+
+    @mock.patch('urllib.request.urlopen')
+    def test_cached_key(self, urlopen):
+        provider = repokeys.KeyProvider(fingerprint=TEST_KEY_FINGERPRINT,
+                                        cache_dir=self.cache_dir)
+        os.makedirs(self.cache_dir)
+        shutil.copy(TEST_KEY, provider.cache_path)
+        self.assertEqual(provider.get(), self.key)
+        urlopen.assert_not_called()
+
+    @mock.patch('urllib.request.urlopen')
+    def test_download_and_cache(self, urlopen):
+        response = mock.MagicMock()
+        response.__enter__.return_value.read.return_value = \
+            self.key.encode()
+        urlopen.side_effect = [OSError('timed out'), response]
+
+        provider = repokeys.KeyProvider(
+            mirror_url='http://mirror.local/gpg.key',
+            fingerprint=TEST_KEY_FINGERPRINT,
+            cache_dir=self.cache_dir, timeout=5)
+        self.assertEqual(provider.get(), self.key)
+        urlopen.assert_has_calls([
+            mock.call('http://mirror.local/gpg.key', timeout=5),
+            mock.call(repokeys.DEFAULT_REPO_KEY_URL, timeout=5),
+        ], any_order=True)
+
+        # the key is now served from the cache
+        urlopen.reset_mock()
+        self.assertEqual(provider.get(), self.key)
+        urlopen.assert_not_called()
+
+    @mock.patch('urllib.request.urlopen')
+    def test_fingerprint_mismatch(self, urlopen):
+        response = mock.MagicMock()
+        response.__enter__.return_value.read.return_value = \
+            self.key.replace('mQENBFESDRIB', 'mQENBFESDRIC').encode()
+        urlopen.return_value = response
+
+        provider = repokeys.KeyProvider(
+            mirror_url='http://mirror.local/gpg.key', url=None,
+            fingerprint=TEST_KEY_FINGERPRINT, cache_dir=self.cache_dir)
+        self.assertRaises(repokeys.RepoKeyNotFound, provider.get)
+        # keys with another fingerprint are not cached
+        self.assertFalse(os.path.exists(provider.cache_path))
+
+    @mock.patch('urllib.request.urlopen')
+    def test_unpinned(self, urlopen):
+        response = mock.MagicMock()
+        response.__enter__.return_value.read.side_effect = [
+            b'<html>not found</html>', self.key.encode()]
+        urlopen.return_value = response
+
+        # any valid key is used when no fingerprint is pinned
+        provider = repokeys.KeyProvider(
+            mirror_url='http://mirror.local/gpg.key',
+            cache_dir=self.cache_dir)
+        self.assertEqual(provider.get(), self.key)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_dir, 'unpinned.asc')))
+
+        # pins are compared regardless of spacing and case
+        pinned = repokeys.KeyProvider(
+            url=None, cache_dir=self.cache_dir, fingerprint='8a3e fa69 59d7 '
+            'a4b7 534d  b9a1 7a6d 83fe 3d39 4584')
+        self.assertRaises(repokeys.RepoKeyNotFound, pinned.get)
+        shutil.copy(TEST_KEY, pinned.cache_path)
+        self.assertEqual(pinned.get(), self.key)
@@ -0,0 +1,144 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rescan
+from discovery import ScsiDevice, StorageTopology
+from rescan import Device, ScsiTarget
+from unit_tests.sysfs import FakeSysfs
+
+
+class TestRescan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.tree = FakeSysfs(self.tmpdir)
+
+    def _add_rport(self, name, port_name, target_id, roles='FCP Target'):
+        rport = os.path.join('class', 'fc_remote_ports', name)
+        self.tree.write(os.path.join(rport, 'port_name'), port_name)
+        self.tree.write(os.path.join(rport, 'roles'), roles)
+        self.tree.write(os.path.join(rport, 'scsi_target_id'), target_id)
+
+    def _add_session(self, name, host, targetname):
+        device = os.path.join(self.tmpdir, 'devices', 'platform', host, name)
+        os.makedirs(device)
+        session = os.path.join('class', 'iscsi_session', name)
+        self.tree.write(os.path.join(session, 'targetname'), targetname)
+        os.symlink(device, os.path.join(self.tmpdir, session, 'device'))
+
+    def test_parse_luns(self):
+        self.assertIsNone(rescan.parse_luns(''))
+        self.assertIsNone(rescan.parse_luns(None))
+        self.assertEqual(rescan.parse_luns('10, 2 2,1'), ['1', '2', '10'])
+        with self.assertRaises(ValueError):
+            rescan.parse_luns('1,two')
+
+    def test_infinibox_targets(self):
+        topology = StorageTopology([
+            ScsiDevice('0:0:0:0', 'ATA', 'Samsung SSD', 'running', 'sda',
+                       'none', '32'),
+            ScsiDevice('3:0:1:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       'none', '32'),
+            ScsiDevice('5:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdc',
+                       'none', '32')], [])
+        # a target without LUNs yet, an unbound port, an initiator and
+        # another array
+        self._add_rport('rport-3:0-0', '0x5742b0f000750111', '0')
+        self._add_rport('rport-3:0-1', '0x5742b0f000750121', '-1')
+        self._add_rport('rport-4:0-0', '0x5742b0f000750131', '0',
+                        roles='FCP Initiator')
+        self._add_rport('rport-4:0-1', '0x500507680b2155e4', '1')
+        self._add_session('session1', 'host5',
+                          'iqn.2009-11.com.infinidat:storage:infinibox-sn-1')
+        self._add_session('session2', 'host6', 'iqn.1992-08.com.netapp:1')
+
+        targets = rescan.infinibox_targets(topology, self.tmpdir)
+        self.assertEqual(targets, [
+            ScsiTarget('3', '0', '0'),
+            ScsiTarget('3', '0', '1'),
+            ScsiTarget('5', '-', '-'),
+        ])
+        self.assertTrue(targets[2].matches('5:0:0:1'))
+        self.assertFalse(targets[0].matches('3:0:1:1'))
+
+    def test_scan(self):
+        for host in ('host3', 'host5'):
+            self.tree.write(os.path.join('class', 'scsi_host', host, 'scan'))
+        targets = [ScsiTarget('3', '0', '1'), ScsiTarget('5', '-', '-'),
+                   ScsiTarget('9', '0', '0')]
+
+        errors = rescan.scan_targets(targets, ['1', '2'], jobs=2,
+                                     sysfs=self.tmpdir)
+        self.assertEqual(list(errors), ['9:0:0'])
+        # sysfs files keep the last write, the kernel scans each of them
+        with open(os.path.join(self.tmpdir, 'class', 'scsi_host', 'host3',
+                               'scan')) as f:
+            self.assertEqual(f.read(), '0 1 2')
+
+        rescan.scan_targets(targets[1:2], sysfs=self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'class', 'scsi_host', 'host5',
+                               'scan')) as f:
+            self.assertEqual(f.read(), '- - -')
+
+    def test_rescan_devices(self):
+        self.tree.write(os.path.join('class', 'scsi_device', '3:0:1:1',
+                                     'device', 'rescan'))
+        errors = rescan.rescan_devices(['3:0:1:1', '3:0:1:2'],
+                                       sysfs=self.tmpdir)
+        self.assertEqual(list(errors), ['3:0:1:2'])
+
+    def test_target_devices(self):
+        self.tree.write(os.path.join('block', 'sdb', 'size'), '2097152')
+        topology = StorageTopology([
+            ScsiDevice('3:0:1:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       'none', '32'),
+            ScsiDevice('3:0:1:2', 'NFINIDAT', 'InfiniBox', 'running', None,
+                       '', '32'),
+            ScsiDevice('3:0:2:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdd',
+                       'none', '32')], [])
+        targets = [ScsiTarget('3', '0', '1')]
+        self.assertEqual(
+            rescan.target_devices(topology, targets, sysfs=self.tmpdir), {
+                '3:0:1:1': Device('sdb', 'running', 1 << 30),
+                '3:0:1:2': Device(None, 'running', 0),
+            })
+        self.assertEqual(list(rescan.target_devices(
+            topology, targets, ['2'], sysfs=self.tmpdir)), ['3:0:1:2'])
+
+    def test_compare(self):
+        before = {
+            '3:0:1:1': Device('sdb', 'running', 1 << 30),
+            '3:0:1:2': Device('sdc', 'running', 1 << 30),
+            '3:0:1:3': Device('sdd', 'running', 1 << 30),
+        }
+        after = {
+            '3:0:1:1': Device('sdb', 'running', 2 << 30),
+            '3:0:1:2': Device('sdc', 'offline', 1 << 30),
+            '3:0:1:10': Device('sdf', 'running', 1 << 30),
+            '3:0:1:4': Device('sde', 'running', 1 << 30),
+        }
+        changes = rescan.compare(before, after)
+        self.assertEqual(changes.new, ['3:0:1:4 (sde)', '3:0:1:10 (sdf)'])
+        self.assertEqual(changes.removed, ['3:0:1:2 (sdc)', '3:0:1:3 (sdd)'])
+        self.assertEqual(changes.resized, [
+            '3:0:1:1 (sdb): 1073741824 -> 2147483648 bytes'])
+        self.assertEqual(rescan.affected_blocks(before, after),
+                         ['sdb', 'sde', 'sdf'])
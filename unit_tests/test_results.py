@@ -0,0 +1,78 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from infinihost import CheckResult, InfinihostReport
+from results import ResultsStore
+
+REPORT = InfinihostReport(1, [
+    CheckResult('SCSI', 'Checking that parted is installed', 'ok'),
+    CheckResult('Multipath', 'Checking global parameters', 'fail'),
+])
+
+
+class TestResultsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _output(self, n, mtime=None):
+        path = os.path.join(self.tmpdir, 'infinihost-out-{0}'.format(n))
+        with open(path, 'w') as f:
+            f.write('output {0}\n'.format(n))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_add_compress_and_retention(self):
+        store = ResultsStore(self.tmpdir, keep_count=3)
+        now = time.time()
+        for n in range(5):
+            store.add(self._output(n), REPORT, timestamp=now + n)
+
+        entries = store.entries()
+        self.assertEqual([e['file'] for e in entries], [
+            'infinihost-out-2.gz', 'infinihost-out-3.gz', 'infinihost-out-4'])
+        self.assertEqual(entries[-1]['exit-code'], 1)
+        self.assertEqual(entries[-1]['summary'],
+                         {'ok': 1, 'fail': 1, 'skip': 0})
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), [
+            'index.json', 'infinihost-out-2.gz', 'infinihost-out-3.gz',
+            'infinihost-out-4'])
+        with gzip.open(os.path.join(self.tmpdir,
+                                    'infinihost-out-3.gz'), 'rt') as f:
+            self.assertEqual(f.read(), 'output 3\n')
+
+    def test_max_age_and_unindexed_files(self):
+        now = time.time()
+        # written before the index existed
+        self._output('old', mtime=now - 40 * 86400)
+        self._output('recent', mtime=now - 86400)
+
+        store = ResultsStore(self.tmpdir, max_age=30)
+        store.add(self._output('new'), REPORT)
+
+        entries = store.entries()
+        self.assertEqual([e['file'] for e in entries], [
+            'infinihost-out-recent.gz', 'infinihost-out-new'])
+        self.assertIsNone(entries[0]['exit-code'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'infinihost-out-old')))
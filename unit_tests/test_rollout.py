@@ -0,0 +1,79 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import rollout
+from rollout import Grant
+
+
+class TestRollout(unittest.TestCase):
+
+    def test_request_id(self):
+        first = rollout.new_request_id(1000.0)
+        self.assertTrue(first.startswith('000000001000000-'))
+        self.assertLess(first, rollout.new_request_id(1000.5))
+
+    def test_grants_roundtrip(self):
+        grants = {'app/0': Grant('1-a', 100.0)}
+        self.assertEqual(rollout.load_grants(
+            {'grants': rollout.dump_grants(grants)}), grants)
+        self.assertEqual(rollout.load_grants({}), {})
+
+    def test_schedule_concurrency(self):
+        requests = {'app/0': '3-c', 'app/1': '1-a', 'app/2': '2-b'}
+        grants, last_release = rollout.schedule(
+            requests, {}, {}, concurrency=2, backoff=60, last_release=None,
+            now=100)
+        # oldest requests first
+        self.assertEqual(grants, {'app/1': Grant('1-a', 100),
+                                  'app/2': Grant('2-b', 100)})
+        self.assertIsNone(last_release)
+
+        # nothing changed
+        self.assertEqual(rollout.schedule(
+            requests, {}, grants, 2, 60, None, now=110), (grants, None))
+
+    def test_schedule_backoff(self):
+        grants = {'app/1': Grant('1-a', 100)}
+        requests = {'app/0': '3-c', 'app/1': ''}
+        done = {'app/1': '1-a'}
+
+        # released, the next unit waits for the backoff
+        grants, last_release = rollout.schedule(
+            requests, done, grants, 1, 60, None, now=200)
+        self.assertEqual((grants, last_release), ({}, 200))
+        self.assertEqual(rollout.schedule(
+            requests, done, grants, 1, 60, last_release, now=259),
+            ({}, 200))
+        self.assertEqual(rollout.schedule(
+            requests, done, grants, 1, 60, last_release, now=260),
+            ({'app/0': Grant('3-c', 260)}, 200))
+
+    def test_schedule_revoke(self):
+        grants = {'app/1': Grant('1-a', 100), 'app/2': Grant('2-b', 100)}
+        now = 100 + rollout.GRANT_TIMEOUT + 1
+        # app/1 left, app/2 did not report back in time
+        requests = {'app/2': '2-b', 'app/3': '3-c'}
+        self.assertEqual(rollout.schedule(
+            requests, {}, grants, 1, 0, None, now=now),
+            ({'app/3': Grant('3-c', now)}, now))
+        self.assertEqual(rollout.schedule(
+            {'app/2': '2-b'}, {}, grants, 1, 0, None, now=now),
+            ({'app/2': Grant('2-b', now)}, now))
+
+    def test_describe_pending(self):
+        self.assertEqual(rollout.describe_pending(
+            [rollout.OP_UDEV_TRIGGER, rollout.OP_MULTIPATHD_RESTART]),
+            'waiting for rollout: multipathd restart, udev trigger')
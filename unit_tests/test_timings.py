@@ -0,0 +1,72 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import unittest
+from unittest import mock
+
+from timings import PhaseTimer, add_run, histogram, phase_summary
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_phase_timer(self):
+        timer = PhaseTimer()
+        with mock.patch('time.monotonic', side_effect=[0, 10, 10, 13]):
+            with timer.phase('apt-update'):
+                pass
+            with timer.phase('apt-update'):
+                pass
+        self.assertEqual(timer.phases['apt-update'][0], 13)
+
+        # subprocess time is accounted once the child is reaped
+        with timer.phase('sh'):
+            subprocess.check_call(
+                ['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do '
+                             'i=$((i+1)); done'])
+        self.assertGreater(timer.phases['sh'][1], 0)
+
+        # exceptions are timed too
+        with self.assertRaises(ValueError):
+            with timer.phase('fail'):
+                raise ValueError()
+        self.assertIn('fail', timer.phases)
+
+    def test_add_run(self):
+        runs = []
+        for i in range(5):
+            runs = add_run(runs, 'config-changed', {'apt-update': (i, 0)},
+                           timestamp=i, keep=3)
+        self.assertEqual([r['timestamp'] for r in runs], [2, 3, 4])
+        self.assertEqual(runs[0]['phases'], {'apt-update': [2, 0]})
+
+    def test_histogram(self):
+        self.assertEqual(histogram([0.5, 0.9, 3, 700], buckets=(1, 10)),
+                         '<1s=2 <10s=1 >=10s=1')
+
+    def test_phase_summary(self):
+        runs = []
+        for wall in (1, 2, 3, 4, 100):
+            runs = add_run(runs, 'install', {'infinihost': (wall, 0.5),
+                                             'initrd': (20, 10)})
+        runs = add_run(runs, 'config-changed', {'initrd': (40, 30)})
+
+        summary = phase_summary(runs)
+        self.assertEqual(summary['infinihost'], {
+            'count': 5, 'min': 1, 'median': 3, 'p90': 100, 'max': 100,
+            'subprocess': 0.5,
+            'histogram': '<1s=0 <5s=4 <30s=0 <120s=1 <600s=0 >=600s=0'})
+        self.assertEqual(summary['initrd']['count'], 6)
+        self.assertEqual(summary['initrd']['subprocess'], 13.33)
+        self.assertEqual(phase_summary([]), {})
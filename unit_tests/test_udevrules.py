@@ -0,0 +1,95 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from discovery import DmDevice, ScsiDevice, StorageTopology
+from udevrules import (
+    queue_mismatches,
+    render_rules,
+    target_devices,
+    validate_queue_settings,
+)
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+
+class TestUdevRules(unittest.TestCase):
+
+    def test_validate(self):
+        self.assertEqual(validate_queue_settings({
+            'scheduler': 'mq-deadline', 'nr_requests': '256',
+            'read_ahead_kb': '', 'rq_affinity': '2',
+            'max_sectors_kb': None}), [])
+        self.assertEqual(validate_queue_settings({
+            'scheduler': 'none"; RUN+="x', 'nr_requests': '-1',
+            'rq_affinity': '3'}), [
+                'invalid scheduler "none"; RUN+="x"',
+                'nr_requests must be a number',
+                'rq_affinity must be 0, 1 or 2'])
+
+    def test_render(self):
+        data = render_rules(TEMPLATES, {
+            'read_ahead_kb': 4096, 'scheduler': 'none', 'nr_requests': '',
+            'rq_affinity': '0'})
+        rules = [line for line in data.splitlines()
+                 if not line.startswith('#')]
+
+        self.assertEqual(rules, [
+            'ACTION=="add|change", SUBSYSTEM=="block", KERNEL=="sd*[!0-9]", '
+            'ATTRS{vendor}=="NFINIDAT*", ATTR{queue/scheduler}="none", '
+            'ATTR{queue/read_ahead_kb}="4096", ATTR{queue/rq_affinity}="0"',
+            'ACTION=="add|change", SUBSYSTEM=="block", KERNEL=="dm-*", '
+            'ENV{DM_UUID}=="mpath-36742b0f*", ATTR{queue/scheduler}="none", '
+            'ATTR{queue/read_ahead_kb}="4096", ATTR{queue/rq_affinity}="0"',
+        ])
+        self.assertTrue(data.endswith('"0"\n'))
+
+        # nothing managed
+        data = render_rules(TEMPLATES, {'scheduler': ''})
+        self.assertTrue(all(line.startswith('#')
+                            for line in data.splitlines()))
+
+    def test_target_devices(self):
+        topology = StorageTopology([
+            ScsiDevice('0:0:0:0', 'ATA', 'SSD', 'running', 'sda', '', ''),
+            ScsiDevice('1:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       '', ''),
+            ScsiDevice('1:0:0:2', 'NFINIDAT', 'InfiniBox', 'running', None,
+                       '', ''),
+        ], [
+            DmDevice('dm-0', 'mpatha', 'mpath-36742b0f000001', '', ['sdb']),
+            DmDevice('dm-1', 'vg-lv', 'LVM-1', '', ['dm-0']),
+        ])
+        self.assertEqual(target_devices(topology), ['sdb', 'dm-0'])
+
+    def test_queue_mismatches(self):
+        sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sysfs)
+        queue = os.path.join(sysfs, 'block', 'sdb', 'queue')
+        os.makedirs(queue)
+        for attr, value in (('scheduler', '[mq-deadline] none'),
+                            ('nr_requests', '64'), ('read_ahead_kb', '128')):
+            with open(os.path.join(queue, attr), 'w') as f:
+                f.write(value + '\n')
+
+        settings = {'scheduler': 'none', 'nr_requests': '64',
+                    'read_ahead_kb': '4096', 'rq_affinity': ''}
+        self.assertEqual(queue_mismatches(['sdb'], settings, sysfs), [
+            'sdb: scheduler=mq-deadline (expected none)',
+            'sdb: read_ahead_kb=128 (expected 4096)',
+        ])
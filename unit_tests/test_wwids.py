@@ -0,0 +1,68 @@
+# Copyright 2022 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import subprocess
+import unittest
+from unittest import mock
+
+import wwids
+from discovery import DmDevice, ScsiDevice, StorageTopology
+
+LOCAL = '3600508b1001c5c0a0000000000000001'
+WWID1 = '36742b0f0000004780000000000012345'
+WWID2 = '36742b0f0000004780000000000012346'
+GONE = '36742b0f000000478000000000000dead'
+
+
+class TestWwids(unittest.TestCase):
+
+    def test_parse_render(self):
+        text = wwids.render_wwids([LOCAL, WWID1])
+        self.assertTrue(text.startswith(wwids.HEADER))
+        self.assertEqual(wwids.parse_wwids(text), [LOCAL, WWID1])
+        self.assertEqual(wwids.parse_wwids(
+            '/{0}/\n  /{0}/\n//\n{1}\n/{1}/ \n'.format(LOCAL, WWID1)),
+            [LOCAL, WWID1])
+
+    def test_infinibox_wwids(self):
+        topology = StorageTopology([
+            ScsiDevice('0:0:0:0', 'ATA', 'Samsung SSD', 'running', 'sda',
+                       'none', '32', LOCAL),
+            ScsiDevice('1:0:0:1', 'NFINIDAT', 'InfiniBox', 'running', 'sdb',
+                       'none', '32', WWID1),
+            # no wwid attribute, known from its multipath device
+            ScsiDevice('1:0:0:2', 'NFINIDAT', 'InfiniBox', 'running', 'sdc',
+                       'none', '32')],
+            [DmDevice('dm-0', WWID2, 'mpath-' + WWID2, 'none', ['sdc'])])
+        self.assertEqual(wwids.infinibox_wwids(topology), [WWID1, WWID2])
+
+    def test_update_wwids(self):
+        update = wwids.update_wwids([GONE, LOCAL, WWID1], [WWID2, WWID1])
+        self.assertEqual(update.wwids, [LOCAL, WWID1, WWID2])
+        self.assertEqual(update.added, [WWID2])
+        self.assertEqual(update.removed, [GONE])
+
+        update = wwids.update_wwids(update.wwids, [WWID1, WWID2])
+        self.assertEqual(update.wwids, [LOCAL, WWID1, WWID2])
+        self.assertEqual((update.added, update.removed), ([], []))
+
+    @mock.patch('subprocess.check_output')
+    def test_add_maps(self, check_output):
+        check_output.side_effect = [
+            'ok\n', 'fail\n',
+            subprocess.CalledProcessError(1, 'multipathd')]
+        self.assertEqual(wwids.add_maps([WWID1, WWID2, GONE]), [WWID2, GONE])
+        self.assertEqual(check_output.call_args_list[0][0][0],
+                         ['multipathd', 'add', 'map', WWID1])